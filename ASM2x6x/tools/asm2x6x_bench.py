@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# asm2x6x_bench.py - Benchmark the transfer paths of ASM2x6x and RTL921x devices.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import argparse
+import datetime
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import asm2x6x_tool
+import transport
+
+
+READ_STRIDES = (1, 16, 32, 64, 128, 192, 255)
+FLASH_READ_STRIDES = (16, 64, 128, 256, 512, 1024, 2048, 4096)
+FLASH_DUMP_LENGTHS = (0x80, 0x1000, 0x10000, 0x80000)
+RTL921X_READ_STRIDES = (64, 256, 1024, 4096, 16384)
+PCIE_DWORDS = 64
+
+
+# Each benchmark is a function that takes the parsed arguments and a device,
+# and yields (params, byte_count, run) tuples, where "run()" does the work to be
+# timed once.
+
+def bench_read(args, dev):
+    length = args.length
+    buf = bytearray(length)
+    for stride in READ_STRIDES:
+        yield ({"stride": stride}, length, lambda stride=stride: dev.readinto(args.address, buf, stride))
+
+def bench_flash_read(args, dev):
+    length = args.length
+    buf = bytearray(length)
+    for stride in FLASH_READ_STRIDES:
+        yield ({"stride": stride}, length, lambda stride=stride: dev.flash_readinto(0, buf, stride))
+
+def bench_flash_dump(args, dev):
+    for length in FLASH_DUMP_LENGTHS:
+        buf = bytearray(length)
+        yield ({"length": length}, length, lambda buf=buf: dev.flash_dump_into(buf))
+
+def bench_pcie(args, dev):
+    bus, dev_num, fn = asm2x6x_tool.parse_bdf(args.bdf)
+    cfgreq_type = 1 if bus != 0 else 0
+    # The same DWORD over and over, so only the per-request latency is measured.
+    def run():
+        for _ in range(PCIE_DWORDS):
+            dev.pcie_cfg_req(0, bus=bus, dev=dev_num, fn=fn, cfgreq_type=cfgreq_type)
+    yield ({"bdf": args.bdf, "dwords": PCIE_DWORDS}, 4 * PCIE_DWORDS, run)
+
+def bench_pcie_cfg_dump(args, dev):
+    bus, dev_num, fn = asm2x6x_tool.parse_bdf(args.bdf)
+    cfgreq_type = 1 if bus != 0 else 0
+    def run():
+        for addr in range(0, 4096, 4):
+            dev.pcie_cfg_req(addr, bus=bus, dev=dev_num, fn=fn, cfgreq_type=cfgreq_type)
+    yield ({"bdf": args.bdf}, 4096, run)
+
+def bench_rtl921x_read(args, dev):
+    length = args.rtl921x_length
+    buf = bytearray(length)
+    for stride in RTL921X_READ_STRIDES:
+        yield ({"stride": stride}, length, lambda stride=stride: dev.readinto(args.rtl921x_address, buf, stride))
+
+# Name: (benchmark, device, required method)
+BENCHMARKS = {
+    "read": (bench_read, "asm2x6x", "readinto"),
+    "flash_read": (bench_flash_read, "asm2x6x", "flash_readinto"),
+    "flash_dump": (bench_flash_dump, "asm2x6x", "flash_dump_into"),
+    "pcie": (bench_pcie, "asm2x6x", "pcie_cfg_req"),
+    "pcie_cfg_dump": (bench_pcie_cfg_dump, "asm2x6x", "pcie_cfg_req"),
+    "rtl921x_read": (bench_rtl921x_read, "rtl921x", "readinto"),
+}
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=Path(__file__).resolve().parent,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment(args, devices):
+    env = {
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "git_revision": git_revision(),
+        "repeat": args.repeat,
+        "queue_depth": args.queue_depth,
+        "devices": {},
+    }
+    for kind, (path, dev) in devices.items():
+        info = {"path": path, "class": type(dev).__name__}
+        if kind == "asm2x6x":
+            info["firmware"] = asm2x6x_tool.fw_version_bytes_to_string(dev.get_fw_version_data())
+        env["devices"][kind] = info
+    return env
+
+def run_benchmark(name, bench, args, dev, counter):
+    results = []
+    for params, byte_count, run in bench(args, dev):
+        times = []
+        commands = 0
+        for _ in range(args.repeat):
+            start_commands = counter.commands
+            start_ns = time.perf_counter_ns()
+            run()
+            times.append(time.perf_counter_ns() - start_ns)
+            commands = counter.commands - start_commands
+
+        best = min(times)
+        result = {
+            "name": name,
+            "params": params,
+            "bytes": byte_count,
+            "commands": commands,
+            "seconds_min": best / 1e9,
+            "seconds_median": statistics.median(times) / 1e9,
+            "bytes_per_second": int(byte_count * 1e9) // max(best, 1),
+            "seconds_per_command": best / 1e9 / commands if commands else None,
+        }
+        results.append(result)
+        print("{:<14} {:<36} {:>8} commands {:>12.6f} s {:>12} B/s".format(
+            name, json.dumps(params, sort_keys=True), commands, result["seconds_min"], result["bytes_per_second"]))
+    return results
+
+def result_key(result):
+    return (result["name"], json.dumps(result["params"], sort_keys=True))
+
+# Compares the results with a baseline and returns the results that are slower
+# than the baseline by more than "threshold" (a fraction), along with their
+# slowdowns. The fastest time of each is compared, since it's the least noisy.
+def find_regressions(results, baseline, threshold):
+    baseline_by_key = {result_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        base = baseline_by_key.get(result_key(result))
+        if base is None or not base["seconds_min"]:
+            continue
+        slowdown = result["seconds_min"] / base["seconds_min"] - 1
+        if slowdown > threshold:
+            regressions.append((result, base, slowdown))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queue-depth", type=int, default=8, help="The maximum number of SCSI commands to keep in flight at once. Min: 1, Max: 16, Default: 8")
+    parser.add_argument("-d", "--device", type=str, default="auto", help="The ASM2x6x SCSI/SG_IO device to benchmark, \"sim[:<chip>]\" for the simulator, or \"none\". Default: auto")
+    parser.add_argument("--rtl921x-device", type=str, default="none", help="The RTL921x SCSI/SG_IO device to benchmark, \"sim\" for the simulator, or \"none\". Default: none")
+    parser.add_argument("-b", "--benchmark", type=str, action='append', choices=BENCHMARKS.keys(), help="A benchmark to run. Can be given more than once. Default: all benchmarks the devices support")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="The number of times to run each benchmark. Default: 3")
+    parser.add_argument("-a", "--address", type=lambda x: int(x, 16), default=0x0000, help="The XDATA address to read from, in hexadecimal. Default: 0")
+    parser.add_argument("-l", "--length", type=int, default=4096, help="The number of bytes to read in the \"read\" and \"flash_read\" benchmarks. Default: 4096")
+    parser.add_argument("-s", "--bdf", type=str, default="00:00.0", help="The PCI address to send Configuration Requests to. Default: 00:00.0")
+    parser.add_argument("--rtl921x-address", type=lambda x: int(x, 16), default=0xac004000, help="The RTL921x address to read from, in hexadecimal. Default: ac004000")
+    parser.add_argument("--rtl921x-length", type=int, default=0x10000, help="The number of bytes to read in the \"rtl921x_read\" benchmark. Default: 65536")
+    parser.add_argument("-o", "--output", type=str, default=None, help="The file to write the results to, as JSON. Default: None")
+    parser.add_argument("--baseline", type=str, default=None, help="A results file to compare against. Default: None")
+    parser.add_argument("-t", "--threshold", type=float, default=0.1, help="How much slower than the baseline a result must be to count as a regression, as a fraction. Default: 0.1")
+    args = parser.parse_args()
+
+    devices = {}
+    counters = {}
+    if args.device != "none":
+        dev = asm2x6x_tool.get_asm2x6x_dev(args.device, args.queue_depth, wrap=transport.CountingTransport)
+        if not dev:
+            print("Error: Failed to open ASM2x6x device \"{}\".".format(args.device), file=sys.stderr)
+            return 1
+        devices["asm2x6x"] = (args.device, dev)
+        counters["asm2x6x"] = dev._transport
+    if args.rtl921x_device != "none":
+        # The RTL921x tool lives in "RTL921x", which has to be on the module
+        # search path to benchmark it.
+        try:
+            import rtl921x_tool
+        except ModuleNotFoundError as e:
+            print("Error: Failed to import \"{}\". Please add the \"RTL921x\" directory to PYTHONPATH to benchmark an RTL921x device.".format(e.name), file=sys.stderr)
+            return 1
+        counter = transport.CountingTransport(rtl921x_tool.open_transport(args.rtl921x_device, args.queue_depth))
+        devices["rtl921x"] = (args.rtl921x_device, rtl921x_tool.Rtl921x(counter))
+        counters["rtl921x"] = counter
+
+    names = args.benchmark or BENCHMARKS.keys()
+
+    results = []
+    for name in names:
+        bench, kind, method = BENCHMARKS[name]
+        if kind not in devices:
+            continue
+        dev = devices[kind][1]
+        if not hasattr(dev, method):
+            print("Skipping \"{}\": {} doesn't support it.".format(name, type(dev).__name__))
+            continue
+        results += run_benchmark(name, bench, args, dev, counters[kind])
+
+    report = {
+        "environment": environment(args, devices),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print("Wrote results to \"{}\".".format(args.output))
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        for kind, info in report["environment"]["devices"].items():
+            base_info = baseline.get("environment", {}).get("devices", {}).get(kind)
+            if base_info is not None and base_info["class"] != info["class"]:
+                print("Warning: The baseline's {} device is a {}, but this one is a {}.".format(kind, base_info["class"], info["class"]), file=sys.stderr)
+        regressions = find_regressions(results, baseline, args.threshold)
+        for result, base, slowdown in regressions:
+            print("Regression: {} {}: {:.6f} s, baseline {:.6f} s ({:+.1f}%).".format(
+                result["name"], json.dumps(result["params"], sort_keys=True),
+                result["seconds_min"], base["seconds_min"], slowdown * 100))
+        if regressions:
+            return 1
+        print("No regressions against \"{}\".".format(args.baseline))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
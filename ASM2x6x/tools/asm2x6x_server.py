@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# asm2x6x_server.py - Keep ASM2x6x devices open and serve requests over a socket.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Protocol: Newline-delimited JSON. Each request is an object with an "op" key,
+# an optional "device" key (the device name, defaulting to the first device),
+# an optional "id" key that is echoed back, and op-specific arguments:
+#
+# - {"op": "devices"}
+# - {"op": "info"}
+# - {"op": "read", "address": 0x07f0, "length": 6, "stride": 255}
+# - {"op": "write", "address": 0x07f0, "data": "ff"}
+# - {"op": "flash_read", "address": 0, "length": 128, "stride": 128}
+# - {"op": "pcie", "address": 0x10, "size": 4, "bdf": "00:00.0", "value": null}
+# - {"op": "pcie_update", "address": 0x04, "size": 2, "bdf": "00:00.0", "clear": 0x0, "set": 0x6}
+# - {"op": "reload"}
+#
+# Config space reads are served from a per-function cache that lives as long as
+# the server, so scripts that read a register, change a few bits, and write it
+# back only cost one round trip to the device per write. Status registers are
+# always read from the device, and writes and reloads invalidate what they
+# could have changed.
+#
+# Each response is an object with "ok" set to true and the op's results, or
+# "ok" set to false and an "error" string. Binary data is hex-encoded.
+
+
+import argparse
+import cmd
+import json
+import os
+import shlex
+import socket
+import socketserver
+import stat
+import sys
+import threading
+
+
+DEFAULT_SOCKET = os.path.join(os.environ.get("XDG_RUNTIME_DIR", "/tmp"), "asm2x6x.sock")
+
+
+class DeviceHandle:
+    def __init__(self, name, path, dev):
+        self.name = name
+        self.path = path
+        self.dev = dev
+        self.lock = threading.Lock()
+
+# The ops only run in the server, which has already loaded "asm2x6x_tool" to
+# open its devices. The client and REPL never import it, so they don't need
+# the tool's dependencies.
+def op_devices(server, handle, req):
+    return {"devices": [{"name": h.name, "path": h.path, "model": type(h.dev).__name__} for h in server.handles.values()]}
+
+def op_info(server, handle, req):
+    import asm2x6x_tool
+    return {"version": asm2x6x_tool.fw_version_bytes_to_string(handle.dev.get_fw_version_data())}
+
+def op_read(server, handle, req):
+    data = handle.dev.read(req["address"], req.get("length", 1), req.get("stride", 255))
+    return {"data": data.hex()}
+
+def op_write(server, handle, req):
+    handle.dev.write(req["address"], bytes.fromhex(req["data"]))
+    return {}
+
+def op_flash_read(server, handle, req):
+    data = handle.dev.flash_read(req["address"], req.get("length", 1), req.get("stride", 128))
+    return {"data": data.hex()}
+
+def op_pcie(server, handle, req):
+    import asm2x6x_tool
+    size = req.get("size", 4)
+    value = req.get("value")
+    bdf = req.get("bdf")
+    if bdf:
+        config = handle.dev.pcie_config_space(*asm2x6x_tool.parse_bdf(bdf))
+        if value is None:
+            result = config.read(req["address"], size)
+        else:
+            result = config.write(req["address"], value, size)
+    else:
+        result = handle.dev.pcie_mem_req(req["address"], value, size)
+    return {"value": result}
+
+def op_pcie_update(server, handle, req):
+    import asm2x6x_tool
+    config = handle.dev.pcie_config_space(*asm2x6x_tool.parse_bdf(req["bdf"]))
+    return {"value": config.update(req["address"], req.get("clear", 0), req.get("set", 0), req.get("size", 4))}
+
+def op_reload(server, handle, req):
+    handle.dev.reload()
+    return {}
+
+OPS = {
+    "devices": op_devices,
+    "info": op_info,
+    "read": op_read,
+    "write": op_write,
+    "flash_read": op_flash_read,
+    "pcie": op_pcie,
+    "pcie_update": op_pcie_update,
+    "reload": op_reload,
+}
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+
+            req = {}
+            try:
+                req = json.loads(line)
+                resp = self.server.dispatch(req)
+            except Exception as e:
+                resp = {"ok": False, "error": "{}: {}".format(type(e).__name__, e)}
+
+            if "id" in req:
+                resp["id"] = req["id"]
+
+            self.wfile.write(json.dumps(resp).encode('utf-8') + b"\n")
+            self.wfile.flush()
+
+class Asm2x6xServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, handles):
+        self.handles = handles
+        super().__init__(socket_path, RequestHandler)
+
+    def dispatch(self, req):
+        op = OPS.get(req.get("op"))
+        if op is None:
+            raise ValueError("Unknown op \"{}\". Supported: {}".format(req.get("op"), ", ".join(OPS.keys())))
+
+        name = req.get("device")
+        if name is None:
+            name = next(iter(self.handles))
+        handle = self.handles.get(name)
+        if handle is None:
+            raise ValueError("Unknown device \"{}\".".format(name))
+
+        # Each device only runs one request at a time, but different devices
+        # can be used in parallel.
+        with handle.lock:
+            result = op(self, handle, req)
+
+        result["ok"] = True
+        return result
+
+class Asm2x6xClient:
+    def __init__(self, socket_path=DEFAULT_SOCKET, device=None):
+        self.device = device
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(socket_path)
+        self._rfile = self._sock.makefile('rb')
+        self._next_id = 0
+
+    def request(self, op, **kwargs):
+        req = {"op": op, "id": self._next_id}
+        self._next_id += 1
+        if self.device is not None:
+            req["device"] = self.device
+        req.update(kwargs)
+
+        self._sock.sendall(json.dumps(req).encode('utf-8') + b"\n")
+        resp = json.loads(self._rfile.readline())
+        if not resp.get("ok"):
+            raise Exception(resp.get("error", "Unknown error"))
+        return resp
+
+    def read(self, address, length=1, stride=255):
+        return bytes.fromhex(self.request("read", address=address, length=length, stride=stride)["data"])
+
+    def write(self, address, data):
+        self.request("write", address=address, data=bytes(data).hex())
+
+    def flash_read(self, address, length=1, stride=128):
+        return bytes.fromhex(self.request("flash_read", address=address, length=length, stride=stride)["data"])
+
+    def pcie(self, address, size=4, value=None, bdf=None):
+        return self.request("pcie", address=address, size=size, value=value, bdf=bdf)["value"]
+
+    # Clears the bits in "clear" and sets the bits in "set" in a config space
+    # register, and returns the new value.
+    def pcie_update(self, bdf, address, clear=0, set=0, size=4):
+        return self.request("pcie_update", bdf=bdf, address=address, clear=clear, set=set, size=size)["value"]
+
+    def close(self):
+        self._rfile.close()
+        self._sock.close()
+
+PCIE_ACCESS_SIZES = {"": 4, "b": 1, "w": 2, "l": 4}
+
+# Parses "<address>[.B|.W|.L]" into (address, size), like "parse_pcie_address"
+# in "asm2x6x_tool.py".
+def parse_pcie_address(address):
+    addr, _, suffix = address.partition('.')
+    size = PCIE_ACCESS_SIZES.get(suffix.lower())
+    if size is None:
+        raise ValueError("Invalid address specifier \"{}\"".format(address))
+    return (int(addr, 16), size)
+
+class Repl(cmd.Cmd):
+    intro = "Type \"help\" for a list of commands."
+    prompt = "asm2x6x> "
+
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+
+    def onecmd(self, line):
+        try:
+            return super().onecmd(line)
+        except Exception as e:
+            print("Error: {}".format(e))
+
+    def emptyline(self):
+        pass
+
+    def do_devices(self, arg):
+        "devices: List the devices held open by the server."
+        for dev in self.client.request("devices")["devices"]:
+            print("{}: {} ({})".format(dev["name"], dev["path"], dev["model"]))
+
+    def do_use(self, arg):
+        "use <device>: Send the following commands to the named device."
+        self.client.device = arg.strip() or None
+
+    def do_info(self, arg):
+        "info: Print the firmware version."
+        print("Firmware version: {}".format(self.client.request("info")["version"]))
+
+    def do_read(self, arg):
+        "read <address> [length]: Read XDATA. The address is in hexadecimal."
+        args = shlex.split(arg)
+        address = int(args[0], 16)
+        length = int(args[1], 0) if len(args) > 1 else 1
+        data = self.client.read(address, length)
+        print("XDATA[0x{:04X}]: {}".format(address, data.hex()))
+
+    def do_write(self, arg):
+        "write <address> <data...>: Write hexadecimal bytes to XDATA."
+        args = shlex.split(arg)
+        self.client.write(int(args[0], 16), b"".join(bytes.fromhex(x) for x in args[1:]))
+
+    def do_flash_read(self, arg):
+        "flash_read <address> [length]: Read SPI flash. The address is in hexadecimal."
+        args = shlex.split(arg)
+        address = int(args[0], 16)
+        length = int(args[1], 0) if len(args) > 1 else 1
+        print("FLASH[0x{:04X}]: {}".format(address, self.client.flash_read(address, length).hex()))
+
+    def do_pcie(self, arg):
+        "pcie [-s <bdf>] <address>[.B|.W|.L] [value]: Send a PCIe memory or configuration request."
+        args = shlex.split(arg)
+        bdf = None
+        if args and args[0] == "-s":
+            bdf = args[1]
+            args = args[2:]
+        address, size = parse_pcie_address(args[0])
+        value = int(args[1], 16) if len(args) > 1 else None
+        result = self.client.pcie(address, size, value, bdf)
+        if value is None:
+            print({1: "0x{:02x}", 2: "0x{:04x}", 4: "0x{:08x}"}[size].format(result))
+
+    def do_pcie_update(self, arg):
+        "pcie_update <bdf> <address>[.B|.W|.L] <clear> <set>: Clear and set bits in a config space register."
+        args = shlex.split(arg)
+        address, size = parse_pcie_address(args[1])
+        result = self.client.pcie_update(args[0], address, int(args[2], 16), int(args[3], 16), size)
+        print({1: "0x{:02x}", 2: "0x{:04x}", 4: "0x{:08x}"}[size].format(result))
+
+    def do_reload(self, arg):
+        "reload: Reset the device's CPU."
+        self.client.request("reload")
+
+    def do_quit(self, arg):
+        "quit: Exit the REPL."
+        return True
+
+    do_EOF = do_quit
+
+# Returns True if a server is listening on the Unix socket at "path".
+def socket_in_use(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        return False
+    finally:
+        sock.close()
+    return True
+
+def serve(args):
+    # Check the socket before opening any devices, so a second server doesn't
+    # steal the socket out from under the first one.
+    try:
+        mode = os.lstat(args.socket).st_mode
+    except FileNotFoundError:
+        mode = None
+    if mode is not None:
+        if not stat.S_ISSOCK(mode):
+            sys.stderr.write("Error: \"{}\" exists and is not a socket.\n".format(args.socket))
+            return 1
+        if socket_in_use(args.socket):
+            sys.stderr.write("Error: A server is already listening on \"{}\".\n".format(args.socket))
+            return 1
+
+    import asm2x6x_tool
+
+    handles = {}
+    for i, path in enumerate(args.device):
+        dev = asm2x6x_tool.get_asm2x6x_dev(path, args.queue_depth)
+        if not dev:
+            sys.stderr.write("Error: Failed to open device \"{}\".\n".format(path))
+            return 1
+        if args.shadow_regs:
+            dev.enable_shadow()
+        name = "dev{}".format(i)
+        handles[name] = DeviceHandle(name, path, dev)
+        print("Opened {} at \"{}\" as \"{}\".".format(type(dev).__name__, path, name))
+
+    # The socket is left behind by a server that didn't exit cleanly.
+    if mode is not None:
+        os.unlink(args.socket)
+
+    # Create the socket with only owner access, rather than changing its mode
+    # after it's already been bound.
+    old_umask = os.umask(0o177)
+    try:
+        server = Asm2x6xServer(args.socket, handles)
+    finally:
+        os.umask(old_umask)
+    print("Listening on \"{}\".".format(args.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+    return 0
+
+def client(args):
+    c = Asm2x6xClient(args.socket, args.target)
+    ret = 0
+    for line in args.request or sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            req = json.loads(line)
+        except ValueError as e:
+            print("Error: Invalid JSON request {!r}: {}".format(line.strip(), e), file=sys.stderr)
+            ret = 1
+            continue
+        if not isinstance(req, dict) or "op" not in req:
+            print("Error: Requests must be JSON objects with an \"op\" key, e.g. '{{\"op\": \"read\", \"address\": 1024}}'. Got: {}".format(line.strip()), file=sys.stderr)
+            ret = 1
+            continue
+        try:
+            print(json.dumps(c.request(req.pop("op"), **req)))
+        except Exception as e:
+            print("Error: {}".format(e), file=sys.stderr)
+            ret = 1
+    c.close()
+
+    return ret
+
+def repl(args):
+    c = Asm2x6xClient(args.socket, args.target)
+    Repl(c).cmdloop()
+    c.close()
+
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-S", "--socket", type=str, default=DEFAULT_SOCKET, help="The path of the server's Unix socket. Default: {}".format(DEFAULT_SOCKET))
+
+    subparsers = parser.add_subparsers(dest="command", required=True, help="Subcommands.")
+
+    parser_serve = subparsers.add_parser("serve")
+    parser_serve.add_argument("--queue-depth", type=int, default=8, help="The maximum number of SCSI commands to keep in flight at once. Min: 1, Max: 16, Default: 8")
+    parser_serve.add_argument("--shadow-regs", action='store_true', default=False, help="Skip register writes that wouldn't change a register's last written value. Default: False")
+    parser_serve.add_argument("device", type=str, nargs="*", default=["auto"], help="The paths to the ASM2x6x SCSI/SG_IO devices to keep open, or \"sim[:<chip>]\". Default: auto")
+    parser_serve.set_defaults(func=serve)
+
+    parser_client = subparsers.add_parser("client")
+    parser_client.add_argument("-t", "--target", type=str, default=None, help="The name of the device to send requests to. Default: the first device")
+    parser_client.add_argument("request", type=str, nargs="*", help="JSON requests to send. Default: read requests from standard input, one per line")
+    parser_client.set_defaults(func=client)
+
+    parser_repl = subparsers.add_parser("repl")
+    parser_repl.add_argument("-t", "--target", type=str, default=None, help="The name of the device to send commands to. Default: the first device")
+    parser_repl.set_defaults(func=repl)
+
+    args = parser.parse_args()
+
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,330 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# asm2x6x_sim.py - A software model of an ASM2x6x USB-to-PCIe bridge.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import struct
+import time
+from collections import Counter
+
+from transport import CheckConditionError, Transport, check_sgio_types
+from xdata_map import ASM2364_MAP, RAM, ZERO
+
+
+CHIPS = {
+    # Chip: (XDATA size, E4/E5 address prefix, default firmware version)
+    "ASM2362": (0x10000, 0x00, bytes.fromhex("221108000000")),
+    "ASM2364": (0x10000, 0x00, bytes.fromhex("221108000000")),
+    "ASM2464": (0x20000, 0x50, bytes.fromhex("240129850000")),
+}
+
+FLASH_SIZE = 512 * 1024
+
+# Flash controller registers.
+FLASH_CON_ADDR_LO = 0xC8A1
+FLASH_CON_ADDR_MD = 0xC8A2
+FLASH_CON_DATA_LEN = 0xC8A3
+FLASH_CON_CSR = 0xC8A9
+FLASH_CON_ADDR_HI = 0xC8AB
+FLASH_CON_BUF_OFFSET = 0xC8AE
+FLASH_BUFFER = 0x7000
+
+# A free-running counter that stands in for the timers, so that the timer block
+# reads differently from one command to the next, like it does on hardware.
+TIMER_COUNTER = 0xCC00
+
+# PCIe TLP engine registers.
+PCIE_TLP_HEADER = 0xB210
+PCIE_DATA = 0xB220
+PCIE_COMPLETION = 0xB224
+PCIE_B284 = 0xB284
+PCIE_CSR = 0xB296
+
+PCIE_CSR_TIMEOUT = 0x01
+PCIE_CSR_DONE = 0x02
+PCIE_CSR_READY = 0x04
+
+
+def default_config_space():
+    # A generic NVMe SSD with a small capability chain.
+    cfg = bytearray(4096)
+    struct.pack_into('<HH', cfg, 0x00, 0x144d, 0xa808)  # Vendor ID, Device ID
+    struct.pack_into('<HH', cfg, 0x04, 0x0000, 0x0010)  # Command, Status (capability list)
+    struct.pack_into('<I', cfg, 0x08, 0x01080200)  # Class code (NVMe), revision 0
+    struct.pack_into('<I', cfg, 0x10, 0x00000004)  # BAR0: 64-bit memory
+    struct.pack_into('<HH', cfg, 0x2c, 0x144d, 0xa801)  # Subsystem IDs
+    cfg[0x34] = 0x40  # Capabilities pointer
+    cfg[0x3d] = 0x01  # Interrupt pin
+    # Power Management capability
+    cfg[0x40:0x48] = bytes([0x01, 0x50, 0x03, 0x00, 0x08, 0x00, 0x00, 0x00])
+    # MSI capability
+    cfg[0x50:0x58] = bytes([0x05, 0x70, 0x80, 0x00, 0x00, 0x00, 0x00, 0x00])
+    # PCI Express capability (endpoint): Link capabilities Gen 3 x4, link
+    # status Gen 3 x4.
+    cfg[0x70:0x74] = bytes([0x10, 0x00, 0x02, 0x00])
+    struct.pack_into('<I', cfg, 0x7c, 0x00400043)
+    struct.pack_into('<H', cfg, 0x82, 0x0043)
+    # AER extended capability
+    struct.pack_into('<I', cfg, 0x100, 0x00010001)
+    return cfg
+
+class PcieFunction:
+    BAR_SIZES = {
+        0x10: 0x4000,
+    }
+
+    def __init__(self, config=None):
+        self.config = bytearray(config if config is not None else default_config_space())
+
+    def cfg_read(self, addr):
+        return struct.unpack_from('<I', self.config, addr)[0]
+
+    def cfg_write(self, addr, value, byte_enable):
+        for i in range(4):
+            if not (byte_enable >> i) & 1:
+                continue
+            offset = addr + i
+            # Vendor/device ID and class code are read-only.
+            if offset < 0x04 or 0x08 <= offset < 0x0c:
+                continue
+            self.config[offset] = (value >> (8 * i)) & 0xff
+        bar_size = self.BAR_SIZES.get(addr)
+        if bar_size:
+            bar = struct.unpack_from('<I', self.config, addr)[0]
+            struct.pack_into('<I', self.config, addr, (bar & ~(bar_size - 1) & 0xfffffff0) | 0x4)
+
+class Asm2x6xSimulator(Transport):
+    def __init__(self, chip="ASM2364", flash_image=None, latency=0.0, busy_polls=1):
+        if chip not in CHIPS:
+            raise ValueError("Unknown chip \"{}\". Supported: {}".format(chip, ", ".join(CHIPS.keys())))
+        self.chip = chip
+        xdata_size, self._addr_prefix, fw_version = CHIPS[chip]
+
+        # Seconds to sleep for each command, to model the USB round trip.
+        self.latency = latency
+        # The number of status reads that the flash controller and TLP engine
+        # report "busy" for before they finish.
+        self.busy_polls = busy_polls
+
+        self.command_counts = Counter()
+
+        self.xdata = bytearray(xdata_size)
+        self._page_map = self._build_page_map(xdata_size)
+        self.xdata[0x07f0:0x07f6] = fw_version
+
+        self.flash = bytearray(b'\xff' * FLASH_SIZE)
+        if flash_image is not None:
+            self.flash[:len(flash_image)] = flash_image
+
+        self.pcie_functions = {
+            (0, 0, 0): PcieFunction(),
+        }
+        self.pcie_memory = {}
+
+        self._reset_mmio()
+
+    @staticmethod
+    def _build_page_map(xdata_size):
+        page_map = [(RAM, page) for page in range(xdata_size >> 8)]
+        for start, end, kind, mirror_of in ASM2364_MAP:
+            for page in range(start >> 8, end >> 8):
+                base = page
+                if mirror_of is not None:
+                    base = (mirror_of >> 8) + (page - (start >> 8))
+                page_map[page] = (kind, base)
+        return page_map
+
+    def _reset_mmio(self):
+        self._flash_busy = 0
+        self._ticks = 0
+        self._pcie_busy = 0
+        self._pcie_csr = PCIE_CSR_READY
+
+    def _resolve(self, addr):
+        kind, base = self._page_map[addr >> 8]
+        return kind, (base << 8) | (addr & 0xff)
+
+    def xdata_read(self, addr):
+        kind, real = self._resolve(addr)
+        if kind == ZERO:
+            return 0
+        if real == TIMER_COUNTER:
+            return self._ticks & 0xff
+        if real == FLASH_CON_CSR:
+            if self._flash_busy:
+                self._flash_busy -= 1
+                return self.xdata[real] | 0x01
+            return self.xdata[real] & 0xfe
+        if real == PCIE_CSR:
+            value = self._pcie_csr
+            if self._pcie_busy:
+                self._pcie_busy -= 1
+                value &= ~PCIE_CSR_DONE
+                if not self._pcie_busy:
+                    self._pcie_csr |= PCIE_CSR_DONE
+            return value
+        return self.xdata[real]
+
+    def xdata_write(self, addr, value):
+        kind, real = self._resolve(addr)
+        if kind == ZERO:
+            return
+        if real == FLASH_CON_CSR:
+            self.xdata[real] = value
+            if value & 0x01:
+                self._flash_start()
+            return
+        if real == PCIE_CSR:
+            # The timeout and done bits are write-1-to-clear.
+            self._pcie_csr &= ~(value & (PCIE_CSR_TIMEOUT | PCIE_CSR_DONE))
+            if value & PCIE_CSR_READY:
+                self._pcie_send()
+            return
+        self.xdata[real] = value
+
+    def _flash_start(self):
+        x = self.xdata
+        flash_addr = x[FLASH_CON_ADDR_LO] | (x[FLASH_CON_ADDR_MD] << 8) | (x[FLASH_CON_ADDR_HI] << 16)
+        length = struct.unpack_from('>H', x, FLASH_CON_DATA_LEN)[0]
+        buf_offset = struct.unpack_from('>H', x, FLASH_CON_BUF_OFFSET)[0]
+        length = min(length, 0x1000 - buf_offset)
+        for i in range(length):
+            x[FLASH_BUFFER + buf_offset + i] = self.flash[(flash_addr + i) % len(self.flash)]
+        self._flash_busy = self.busy_polls
+
+    def _mem_page(self, address):
+        page = self.pcie_memory.get(address >> 12)
+        if page is None:
+            page = bytearray(4096)
+            self.pcie_memory[address >> 12] = page
+        return page
+
+    def _pcie_send(self):
+        header = struct.unpack_from('>III', self.xdata, PCIE_TLP_HEADER)
+        fmt_type = header[0] >> 24
+        byte_enable = header[1] & 0xf
+        address = header[2]
+        data = struct.unpack_from('>I', self.xdata, PCIE_DATA)[0]
+        enabled = bin(byte_enable).count("1")
+
+        self._pcie_csr &= ~PCIE_CSR_DONE
+
+        if fmt_type & 0xbe == 0x04:
+            # Configuration Request
+            bus = address >> 24
+            dev = (address >> 19) & 0x1f
+            fn = (address >> 16) & 0x7
+            reg = address & 0xffc
+            if fmt_type & 0x01 == 0:
+                bus = 0
+            function = self.pcie_functions.get((bus, dev, fn))
+            status = 0b001
+            has_data = 0
+            if function is not None:
+                status = 0b000
+                if fmt_type & 0x40:
+                    function.cfg_write(reg, data, byte_enable)
+                else:
+                    has_data = 1
+                    struct.pack_into('>I', self.xdata, PCIE_DATA, function.cfg_read(reg))
+            self._complete(status, 4, has_data)
+        elif fmt_type & 0xdf == 0x40:
+            # Posted Memory Write
+            page = self._mem_page(address)
+            for i in range(4):
+                if (byte_enable >> i) & 1:
+                    page[(address & 0xffc) + i] = (data >> (8 * i)) & 0xff
+            self._pcie_csr |= PCIE_CSR_DONE
+        elif fmt_type & 0xdf == 0x00:
+            # Memory Read
+            page = self._mem_page(address)
+            value = struct.unpack_from('<I', page, address & 0xffc)[0]
+            struct.pack_into('>I', self.xdata, PCIE_DATA, value)
+            self._complete(0b000, enabled, 1)
+        else:
+            self._complete(0b001, 0, 0)
+
+    def _complete(self, status, byte_count, has_data):
+        fmt_type = 0x4a if has_data else 0x0a
+        struct.pack_into('>III', self.xdata, PCIE_COMPLETION,
+            (fmt_type << 24) | has_data,
+            (status << 13) | (byte_count & 0xfff),
+            0x00000000,
+        )
+        self.xdata[PCIE_B284] = (self.xdata[PCIE_B284] & 0xfe) | has_data
+        self._pcie_busy = self.busy_polls
+        if not self._pcie_busy:
+            self._pcie_csr |= PCIE_CSR_DONE
+
+    def _xdata_addr(self, cdb):
+        prefix = cdb[2]
+        if self._addr_prefix:
+            if prefix & 0xfe != self._addr_prefix:
+                raise CheckConditionError("Invalid XDATA address prefix 0x{:02x}".format(prefix))
+            return ((prefix & 0x01) << 16) | (cdb[3] << 8) | cdb[4]
+        if prefix != 0:
+            raise CheckConditionError("Invalid XDATA address prefix 0x{:02x}".format(prefix))
+        return (cdb[3] << 8) | cdb[4]
+
+    def execute(self, cdb, data_out, data_in):
+        check_sgio_types(cdb, data_out, data_in)
+        opcode = cdb[0]
+        self.command_counts[opcode] += 1
+        self._ticks += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        if opcode == 0xe0:
+            # Read configuration data.
+            data_in[:0x80] = self.flash[0:0x80]
+        elif opcode == 0xe1:
+            # Write configuration data.
+            self.flash[0:0x80] = data_out
+        elif opcode == 0xe2:
+            # Flash read.
+            read_len = struct.unpack_from('>I', cdb, 2)[0]
+            start = 0xff00 if cdb[1] == 0xd0 else 0
+            data_in[:read_len] = self.flash[start:start+read_len]
+        elif opcode == 0xe3:
+            # Firmware write.
+            write_len = struct.unpack_from('>I', cdb, 2)[0]
+            self.flash[0x80:0x80+write_len] = bytes(data_out[:write_len])
+        elif opcode == 0xe4:
+            # XDATA read.
+            read_len = cdb[1]
+            addr = self._xdata_addr(cdb)
+            if addr + read_len > len(self.xdata):
+                raise CheckConditionError("XDATA read out of range")
+            for i in range(read_len):
+                data_in[i] = self.xdata_read(addr + i)
+        elif opcode == 0xe5:
+            # XDATA write.
+            addr = self._xdata_addr(cdb)
+            if addr >= len(self.xdata):
+                raise CheckConditionError("XDATA write out of range")
+            self.xdata_write(addr, cdb[1])
+        elif opcode == 0xe6:
+            # NVMe Admin Command: Only the data length is modeled.
+            if data_in is not None:
+                data_in[:] = bytes(len(data_in))
+        elif opcode == 0xe8:
+            # Reset
+            self._reset_mmio()
+        else:
+            raise CheckConditionError("Unsupported opcode 0x{:02x}".format(opcode))
+
+        return 0
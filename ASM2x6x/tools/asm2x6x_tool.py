@@ -19,84 +19,301 @@
 
 
 import argparse
+import collections
+import copy
+import io
+import json
 import os
+import re
 import struct
 import sys
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 
-try:
-    import sgio
-except ModuleNotFoundError:
-    sys.stderr.write("Error: Failed to import \"sgio\". Please install \"cython-sgio\", then try running this script again.\n")
-    sys.exit(1)
+import dumpio
+import scsi_trace
+import transport
+
+
+XDATA_CDB = struct.Struct('>BBBHB')
+
+# Register write policies for the shadow register cache.
+REG_CACHEABLE = "cacheable"  # Plain storage with no side effects, so redundant writes can be skipped.
+REG_W1C = "write-1-to-clear"  # Writing a bit clears it, so every write must be sent.
+REG_VOLATILE = "volatile"  # Changed by hardware or has side effects, so every write must be sent.
+
+# Registers not listed here are treated as volatile.
+ASM236X_REGISTER_POLICIES = {
+    # Flash controller
+    0xC8A9: REG_VOLATILE,  # FLASH_CON_CSR
+    0xC8AC: REG_CACHEABLE,  # FLASH_CON_ADDR_LEN_MAYBE
+    0xC8AD: REG_CACHEABLE,  # FLASH_CON_MODE
+    0xC8AE: REG_CACHEABLE,  # FLASH_CON_BUF_OFFSET (high byte)
+    0xC8AF: REG_CACHEABLE,  # FLASH_CON_BUF_OFFSET (low byte)
+
+    # PCIe TLP engine
+    **{addr: REG_CACHEABLE for addr in range(0xB210, 0xB21C)},  # TLP header
+    0xB220: REG_VOLATILE,  # TLP data, overwritten by completions
+    0xB221: REG_VOLATILE,
+    0xB222: REG_VOLATILE,
+    0xB223: REG_VOLATILE,
+    0xB254: REG_CACHEABLE,
+    0xB296: REG_W1C,  # TLP engine CSR
+}
+
+
+class RegisterShadow:
+    def __init__(self, policies):
+        self._policies = policies
+        self._values = {}
+        self.sent = 0
+        self.elided = 0
+
+    # Returns the (address, value) pairs from a write that actually need to be
+    # sent. Nothing is recorded until "commit" is called with them, once they've
+    # been sent successfully.
+    def filter(self, start_addr, data):
+        writes = []
+        for offset, value in enumerate(data):
+            addr = start_addr + offset
+            if self._policies.get(addr, REG_VOLATILE) == REG_CACHEABLE and self._values.get(addr) == value:
+                self.elided += 1
+                continue
+            writes.append((addr, value))
+        self.sent += len(writes)
+        return writes
+
+    # Records the new values of the cacheable registers in "writes".
+    def commit(self, writes):
+        for addr, value in writes:
+            if self._policies.get(addr, REG_VOLATILE) == REG_CACHEABLE:
+                self._values[addr] = value
+
+    # Forgets the registers in "writes" after they failed to send, since any of
+    # them may or may not have been written.
+    def discard(self, writes):
+        for addr, _ in writes:
+            self._values.pop(addr, None)
+
+    def invalidate(self, addr=None):
+        if addr is None:
+            self._values.clear()
+        else:
+            self._values.pop(addr, None)
+
+
+class PollTimeout(Exception):
+    pass
+
+class PollCancelled(Exception):
+    pass
+
+class PollPolicy:
+    def __init__(self, timeout=5.0, spin=16, sleep=0.0001, max_sleep=0.01):
+        # Give up after "timeout" seconds. The first "spin" polls are sent back
+        # to back, after which the poller sleeps between polls, starting at
+        # "sleep" seconds and doubling up to "max_sleep" seconds.
+        self.timeout = timeout
+        self.spin = spin
+        self.sleep = sleep
+        self.max_sleep = max_sleep
+
+class PollStats:
+    def __init__(self):
+        self.sites = {}
+
+    def record(self, site, iterations, elapsed_ns, timed_out):
+        stats = self.sites.get(site)
+        if stats is None:
+            stats = {"calls": 0, "iterations": 0, "max_iterations": 0, "wall_ns": 0, "max_wall_ns": 0, "timeouts": 0}
+            self.sites[site] = stats
+        stats["calls"] += 1
+        stats["iterations"] += iterations
+        stats["max_iterations"] = max(stats["max_iterations"], iterations)
+        stats["wall_ns"] += elapsed_ns
+        stats["max_wall_ns"] = max(stats["max_wall_ns"], elapsed_ns)
+        stats["timeouts"] += int(timed_out)
+
+    def export(self):
+        return {site: dict(stats) for site, stats in self.sites.items()}
+
+class Poller:
+    def __init__(self, policy=None, cancel_event=None):
+        self.policy = policy or PollPolicy()
+        # A threading.Event that aborts any poll in progress when set.
+        self.cancel_event = cancel_event
+        self.stats = PollStats()
+
+    # Calls "read" until "predicate" is true for the value it returns, then
+    # returns that value. Each call is a round trip to the device, so the
+    # number of them is recorded per call site.
+    def until(self, site, read, predicate):
+        policy = self.policy
+        start_ns = time.perf_counter_ns()
+        deadline_ns = start_ns + int(policy.timeout * 1e9)
+        sleep = policy.sleep
+        iterations = 0
+        while True:
+            value = read()
+            iterations += 1
+            if predicate(value):
+                self.stats.record(site, iterations, time.perf_counter_ns() - start_ns, False)
+                return value
+
+            if self.cancel_event is not None and self.cancel_event.is_set():
+                self.stats.record(site, iterations, time.perf_counter_ns() - start_ns, False)
+                raise PollCancelled("Polling \"{}\" was cancelled.".format(site))
+
+            now_ns = time.perf_counter_ns()
+            if now_ns >= deadline_ns:
+                self.stats.record(site, iterations, now_ns - start_ns, True)
+                raise PollTimeout("Timed out after {} polls of \"{}\".".format(iterations, site))
+
+            if iterations >= policy.spin:
+                time.sleep(min(sleep, (deadline_ns - now_ns) / 1e9))
+                sleep = min(sleep * 2, policy.max_sleep)
 
 
 class Asm2x6x:
-    def __init__(self, dev_path):
-        self._file = os.fdopen(os.open(dev_path, os.O_RDWR | os.O_NONBLOCK))
+    # The name of the built-in XDATA map in "xdata_map.py" for the chip, if it
+    # has one.
+    xdata_map_name = None
+
+    def __init__(self, transport):
+        self._transport = transport
+        self.shadow = None
+        self.poller = Poller()
+        self._pcie_configs = {}
+
+    # Opt in to skipping writes that wouldn't change the value of a register.
+    def enable_shadow(self, policies=None):
+        if policies is None:
+            policies = ASM236X_REGISTER_POLICIES
+        self.shadow = RegisterShadow(policies)
 
     def get_fw_version_data(self):
         return self.read(0x07f0, 6)
 
+    # Splits an XDATA address into the high byte and low word of an E4/E5 CDB.
+    # The ASM236x's 64 KiB of XDATA fit in the low word, so the high byte is
+    # zero. Chips with more XDATA override this.
+    def _xdata_cdb_addr(self, addr):
+        assert addr >> 16 == 0
+        return (0x00, addr)
+
+    @scsi_trace.operation("read")
+    def readinto(self, start_addr, buf, stride=255):
+        view = memoryview(buf).cast('B')
+        read_len = len(view)
+
+        # The transport consumes each CDB before asking for the next one, so a
+        # single CDB buffer can be reused, and each chunk of data is read
+        # directly into its place in the destination buffer.
+        cdb = bytearray(XDATA_CDB.size)
+        def commands():
+            for i in range(0, read_len, stride):
+                buf_len = min(stride, read_len - i)
+                addr_hi, addr_lo = self._xdata_cdb_addr(start_addr + i)
+                XDATA_CDB.pack_into(cdb, 0, 0xe4, buf_len, addr_hi, addr_lo, 0x00)
+                yield (cdb, None, view[i:i+buf_len])
+
+        for ret in self._transport.execute_many(commands()):
+            assert ret == 0
+
+        return read_len
+
+    def read(self, start_addr, read_len, stride=255):
+        data = bytearray(read_len)
+        self.readinto(start_addr, data, stride)
+        return bytes(data)
+
 class Asm236x(Asm2x6x):
-    def __init__(self, dev_path):
-        super().__init__(dev_path)
+    xdata_size = 0x10000
+    xdata_map_name = "ASM2364"
+
+    def __init__(self, transport):
+        super().__init__(transport)
 
     def flash_dump(self, read_len):
         data = bytearray(read_len)
+        self.flash_dump_into(data)
+        return bytes(data)
+
+    @scsi_trace.operation("flash_dump")
+    def flash_dump_into(self, buf):
+        view = memoryview(buf).cast('B')
 
-        cdb = struct.pack('>BBI', 0xe2, 0x00, read_len)
+        cdb = struct.pack('>BBI', 0xe2, 0x00, len(view))
 
-        ret = sgio.execute(self._file, cdb, None, data)
+        # Unlike "execute", "execute_many" can read straight into a view of the
+        # destination, which may be an mmap.
+        (ret,) = self._transport.execute_many([(cdb, None, view)])
         assert ret == 0
 
-        return bytes(data)
+        return len(view)
 
+    @scsi_trace.operation("config_write")
     def config_write(self, config_data):
         assert len(config_data) == 128
 
         cdb = struct.pack('>B15x', 0xe1)
 
-        ret = sgio.execute(self._file, cdb, config_data, None)
+        ret = self._transport.execute(cdb, config_data, None)
         assert ret == 0
 
+    @scsi_trace.operation("fw_write")
     def fw_write(self, fw_data):
         cdb = struct.pack('>BBI', 0xe3, 0x00, len(fw_data))
 
-        ret = sgio.execute(self._file, cdb, fw_data, None)
+        ret = self._transport.execute(cdb, fw_data, None)
         assert ret == 0
 
-    def read(self, start_addr, read_len, stride=255):
-        data = bytearray(read_len)
-
-        for i in range(0, read_len, stride):
-            remaining = read_len - i
-            buf_len = min(stride, remaining)
-
-            cdb = struct.pack('>BBBHB', 0xe4, buf_len, 0x00, start_addr + i, 0x00)
-
-            buf = bytearray(buf_len)
-            ret = sgio.execute(self._file, cdb, None, buf)
-            assert ret == 0
+    @scsi_trace.operation("write")
+    def write(self, start_addr, data):
+        if self.shadow is not None:
+            writes = self.shadow.filter(start_addr, data)
+        else:
+            writes = enumerate(data, start_addr)
 
-            data[i:i+buf_len] = buf
+        cdb = bytearray(XDATA_CDB.size)
+        def commands():
+            for addr, value in writes:
+                XDATA_CDB.pack_into(cdb, 0, 0xe5, value, 0x00, addr, 0x00)
+                yield (cdb, None, None)
 
-        return bytes(data)
+        try:
+            for ret in self._transport.execute_many(commands()):
+                assert ret == 0
+        except BaseException:
+            if self.shadow is not None:
+                self.shadow.discard(writes)
+            raise
 
-    def write(self, start_addr, data):
-        for offset, value in enumerate(data):
-            cdb = struct.pack('>BBBHB', 0xe5, value, 0x00, start_addr + offset, 0x00)
-            ret = sgio.execute(self._file, cdb, None, None)
-            assert ret == 0
+        if self.shadow is not None:
+            self.shadow.commit(writes)
 
+    @scsi_trace.operation("reload")
     def reload(self):
         cdb = bytes.fromhex("e8 00 00 00 00 00 00 00 00 00 00 00")
-        ret = sgio.execute(self._file, cdb, None, None)
+        ret = self._transport.execute(cdb, None, None)
         assert ret == 0
 
+        # The reset puts the registers back to their defaults.
+        if self.shadow is not None:
+            self.shadow.invalidate()
+        self.invalidate_pcie_configs()
+
     def flash_read(self, start_addr, read_len, stride=128):
         data = bytearray(read_len)
+        self.flash_readinto(start_addr, data, stride)
+        return bytes(data)
+
+    @scsi_trace.operation("flash_read")
+    def flash_readinto(self, start_addr, buf, stride=128):
+        view = memoryview(buf).cast('B')
+        read_len = len(view)
 
         for i in range(0, read_len, stride):
             remaining = read_len - i
@@ -128,15 +345,13 @@ class Asm236x(Asm2x6x):
             self.write(0xC8A9, bytes([0x01]))
 
             # Wait for read to finish.
-            while self.read(0xC8A9, 1)[0] & 1:
-                continue
+            self.poller.until("flash_read.busy", lambda: self.read(0xC8A9, 1)[0], lambda csr: not csr & 1)
 
-            buf = self.read(0x7000, buf_len)
+            self.readinto(0x7000, view[i:i+buf_len])
 
-            data[i:i+buf_len] = buf
-
-        return bytes(data)
+        return read_len
 
+    @scsi_trace.operation("pcie_cfg_req")
     def pcie_cfg_req(self, byte_addr, bus=1, dev=0, fn=0, cfgreq_type=1, value=None, size=4):
         assert byte_addr >> 12 == 0
 
@@ -155,6 +370,7 @@ class Asm236x(Asm2x6x):
 
         return self.pcie_gen_req(fmt_type, address, value, size)
 
+    @scsi_trace.operation("pcie_mem_req")
     def pcie_mem_req(self, address, value=None, size=4):
         fmt_type = 0x00
         if value is not None:
@@ -162,6 +378,7 @@ class Asm236x(Asm2x6x):
 
         return self.pcie_gen_req(fmt_type, address, value, size)
 
+    @scsi_trace.operation("pcie_gen_req")
     def pcie_gen_req(self, fmt_type, address, value=None, size=4):
         assert fmt_type >> 8 == 0
         assert size > 0 and size <= 4
@@ -190,40 +407,49 @@ class Asm236x(Asm2x6x):
         # Unknown
         self.write(0xB254, bytes([0x0f]))
 
-        # Wait for PCIe to become ready.
-        while self.read(0xB296, 1)[0] & 4 == 0:
-            continue
-
-        # Write to CSR bit 2 to send the TLP.
-        self.write(0xB296, bytes([0x04]))
+        self._pcie_send_tlp()
 
         if ((fmt_type & 0b11011111) == 0b01000000) or ((fmt_type & 0b10111000) == 0b00110000):
             # This is a posted transaction, so there's no completion and we can return early.
             return
 
+        self._pcie_wait_completion()
+
+        b284 = self.read(0xB284, 1)[0]
+        #print("0xB284: 0x{:02x}".format(b284))
+
+        completion = struct.unpack('>III', self.read(0xB224, 12))
+        #print("Completion TLP: 0x{:08x} 0x{:08x} 0x{:08x}".format(*completion))
+        self._pcie_check_completion(fmt_type, value, size, completion, b284)
+
+        if value is None:
+            full_value = struct.unpack('>I', self.read(0xB220, 4))[0]
+            shifted_value = full_value >> (8 * offset)
+            masked_value = shifted_value & ((1 << (8 * size)) - 1)
+            return masked_value
+
+    def _pcie_send_tlp(self):
+        # Wait for PCIe to become ready.
+        self.poller.until("pcie.ready", lambda: self.read(0xB296, 1)[0], lambda csr: csr & 4)
+
+        # Write to CSR bit 2 to send the TLP.
+        self.write(0xB296, bytes([0x04]))
+
+    def _pcie_wait_completion(self):
         # Wait for completion.
-        while self.read(0xB296, 1)[0] & 2 == 0:
-            if self.read(0xB296, 1)[0] & 1:
-                # Clear timeout bit.
-                self.write(0xB296, bytes([0x01]))
+        csr = self.poller.until("pcie.completion", lambda: self.read(0xB296, 1)[0], lambda csr: csr & 3)
+        if csr & 2 == 0:
+            # Clear timeout bit.
+            self.write(0xB296, bytes([0x01]))
 
-                raise Exception("PCIe timeout!")
+            raise Exception("PCIe timeout!")
 
         # Clear done bit.
         self.write(0xB296, bytes([0x02]))
 
-        b284 = self.read(0xB284, 1)[0]
-        #print("0xB284: 0x{:02x}".format(b284))
+    def _pcie_check_completion(self, fmt_type, value, size, completion, b284):
         b284_bit_0 = b284 & 0x01
 
-        completion = struct.unpack('>III', self.read(0xB224, 12))
-        #print("Completion TLP: 0x{:08x} 0x{:08x} 0x{:08x}".format(*completion))
-        if (fmt_type & 0xbe == 0x04):
-            # Completion TLPs for configuration requests always have a byte count of 4.
-            assert completion[1] & 0xfff == 4
-        else:
-            assert completion[1] & 0xfff == size
-
         status_map = {
             0b000: "Successful Completion (SC)",
             0b001: "Unsupported Request (UR)",
@@ -232,20 +458,207 @@ class Asm236x(Asm2x6x):
         }
         status = (completion[1] >> 13) & 0x7
         if status or ((fmt_type & 0xbe == 0x04) and (((value is None) and (not b284_bit_0)) or ((value is not None) and b284_bit_0))):
-            raise Exception("Completion status: {}, 0xB284 bit 0: {}".format(
-                status_map.get(status, "Reserved (0b{:03b})".format(status)), b284_bit_0))
+            raise transport.PcieCompletionError("Completion status: {}, 0xB284 bit 0: {}".format(
+                status_map.get(status, "Reserved (0b{:03b})".format(status)), b284_bit_0), status)
 
-        if value is None:
-            full_value = struct.unpack('>I', self.read(0xB220, 4))[0]
-            shifted_value = full_value >> (8 * offset)
-            masked_value = shifted_value & ((1 << (8 * size)) - 1)
-            return masked_value
+        if (fmt_type & 0xbe == 0x04):
+            # Completion TLPs for configuration requests always have a byte count of 4.
+            expected_count = 4
+        else:
+            expected_count = size
+        if completion[1] & 0xfff != expected_count:
+            raise transport.PcieCompletionError("Completion byte count: {}, expected {}".format(
+                completion[1] & 0xfff, expected_count), status)
+
+    # Sends "count" non-posted read TLPs of type "fmt_type" for consecutive
+    # DWORDs starting at "address", and passes each DWORD to "emit" as four
+    # little-endian bytes. The whole header is only programmed once. After that,
+    # only the address bytes that change between TLPs get rewritten.
+    def _pcie_read_dwords(self, fmt_type, address, count, emit):
+        header = bytearray(struct.pack('>III', 0x00000001 | (fmt_type << 24), 0x0000000f, address))
+        self.write(0xB210, header)
+
+        # Clear timeout bit.
+        self.write(0xB296, bytes([0x01]))
+
+        # Unknown
+        self.write(0xB254, bytes([0x0f]))
+
+        # The data (0xB220), completion header (0xB224), and status (0xB284)
+        # registers are fetched with one read.
+        status_len = 0xB284 + 1 - 0xB220
+
+        dword = bytearray(4)
+        for dword_addr in range(address, address + 4 * count, 4):
+            new_addr = struct.pack('>I', dword_addr)
+            for i in range(4):
+                if header[8+i] != new_addr[i]:
+                    header[8+i] = new_addr[i]
+                    self.write(0xB218 + i, new_addr[i:i+1])
+
+            self._pcie_send_tlp()
+            self._pcie_wait_completion()
+
+            regs = self.read(0xB220, status_len)
+            completion = struct.unpack_from('>III', regs, 0xB224 - 0xB220)
+            self._pcie_check_completion(fmt_type, None, 4, completion, regs[0xB284 - 0xB220])
+
+            struct.pack_into('<I', dword, 0, struct.unpack_from('>I', regs, 0)[0])
+            emit(dword)
+
+    # Sends a posted write TLP of type "fmt_type" for each DWORD of "data" (a
+    # multiple of four little-endian bytes), starting at the DWORD-aligned
+    # "address". Like "_pcie_read_dwords", the header is only programmed once,
+    # and after that only the address and data register bytes that change
+    # between TLPs get rewritten. Posted writes have no completion, so the only
+    # thing waited on is the engine being ready to send the next TLP.
+    def _pcie_write_dwords(self, fmt_type, address, data):
+        view = memoryview(data).cast('B')
+        assert len(view) & 0x3 == 0
+
+        header = bytearray(struct.pack('>III', 0x00000001 | (fmt_type << 24), 0x0000000f, address))
+        self.write(0xB210, header)
+
+        # Clear timeout bit.
+        self.write(0xB296, bytes([0x01]))
+
+        # Unknown
+        self.write(0xB254, bytes([0x0f]))
+
+        # The data register holds the DWORD in big-endian order.
+        data_reg = None
+        for offset in range(0, len(view), 4):
+            new_data = bytes(view[offset:offset+4])[::-1]
+            if data_reg is None:
+                data_reg = bytearray(new_data)
+                self.write(0xB220, new_data)
+            elif data_reg != new_data:
+                changed = [i for i in range(4) if data_reg[i] != new_data[i]]
+                first, last = changed[0], changed[-1] + 1
+                data_reg[first:last] = new_data[first:last]
+                self.write(0xB220 + first, new_data[first:last])
+
+            new_addr = struct.pack('>I', address + offset)
+            for i in range(4):
+                if header[8+i] != new_addr[i]:
+                    header[8+i] = new_addr[i]
+                    self.write(0xB218 + i, new_addr[i:i+1])
+
+            self._pcie_send_tlp()
+
+    @scsi_trace.operation("pcie_cfg_read_block")
+    def pcie_cfg_read_block(self, byte_addr, count, bus=1, dev=0, fn=0, cfgreq_type=1):
+        # Reads "count" consecutive config space DWORDs, starting at the
+        # DWORD-aligned "byte_addr", and returns them as little-endian bytes.
+        assert byte_addr & 0x3 == 0
+        assert byte_addr + 4 * count <= 0x1000
+
+        assert bus >> 8 == 0
+        assert dev >> 5 == 0
+        assert fn >> 3 == 0
+
+        assert cfgreq_type >> 1 == 0
+
+        data = bytearray()
+        address = (bus << 24) | (dev << 19) | (fn << 16) | byte_addr
+        self._pcie_read_dwords(0x04 | cfgreq_type, address, count, data.extend)
+
+        return bytes(data)
+
+    # Returns the caching config space accessor for a function, creating it on
+    # first use. Config writes made through "pcie_cfg_req" directly bypass it,
+    # so use "invalidate_pcie_configs" after mixing the two.
+    def pcie_config_space(self, bus=1, dev=0, fn=0):
+        bdf = (bus, dev, fn)
+        config = self._pcie_configs.get(bdf)
+        if config is None:
+            cfgreq_type = 1 if bus != 0 else 0
+
+            def read_block(offset, count):
+                return self.pcie_cfg_read_block(offset, count, bus=bus, dev=dev, fn=fn, cfgreq_type=cfgreq_type)
+
+            def write(offset, value, size):
+                self.pcie_cfg_req(offset, bus=bus, dev=dev, fn=fn, cfgreq_type=cfgreq_type, value=value, size=size)
+
+            import pcie_config
+            config = self._pcie_configs[bdf] = pcie_config.ConfigSpace(read_block, write)
+        return config
+
+    def invalidate_pcie_configs(self):
+        for config in self._pcie_configs.values():
+            config.invalidate()
+
+    @scsi_trace.operation("pcie_mem_read_block")
+    def pcie_mem_read_block(self, address, length, out=None, flush_len=4096):
+        # Reads "length" bytes of PCIe memory. The data is returned, or, if
+        # "out" is given, written to it in pieces of "flush_len" bytes as it
+        # arrives.
+        data = bytearray()
+
+        def emit(chunk):
+            data.extend(chunk)
+            if out is not None and len(data) >= flush_len:
+                out.write(data)
+                data.clear()
+
+        end = address + length
+
+        # Leading bytes up to the first DWORD boundary.
+        while address < end and address & 0x3:
+            emit(bytes([self.pcie_mem_req(address, size=1)]))
+            address += 1
+
+        aligned_end = address + (((end - address) // 4) * 4)
+        if address < aligned_end:
+            self._pcie_read_dwords(0x00, address, (aligned_end - address) // 4, emit)
+            address = aligned_end
+
+        # Trailing bytes after the last DWORD boundary.
+        while address < end:
+            emit(bytes([self.pcie_mem_req(address, size=1)]))
+            address += 1
+
+        if out is not None:
+            out.write(data)
+            return None
+
+        return bytes(data)
+
+    @scsi_trace.operation("pcie_mem_write_block")
+    def pcie_mem_write_block(self, address, data):
+        # Writes "data" to PCIe memory at "address" with posted Memory Write
+        # TLPs. Bytes before the first and after the last DWORD boundary are
+        # written with partial byte enables.
+        view = memoryview(data).cast('B')
+        assert address + len(view) <= 1 << 32
+
+        head_len = min(-address & 0x3, len(view))
+        if head_len:
+            self.pcie_mem_req(address, int.from_bytes(view[:head_len], 'little'), head_len)
+
+        aligned_end = head_len + ((len(view) - head_len) & ~0x3)
+        if head_len < aligned_end:
+            self._pcie_write_dwords(0x40, address + head_len, view[head_len:aligned_end])
+
+        if aligned_end < len(view):
+            self.pcie_mem_req(address + aligned_end, int.from_bytes(view[aligned_end:], 'little'), len(view) - aligned_end)
 
 class Asm246x(Asm2x6x):
-    def __init__(self, dev_path):
-        super().__init__(dev_path)
+    xdata_size = 0x20000
+
+    def __init__(self, transport):
+        super().__init__(transport)
 
     def flash_dump(self, read_len):
+        data = bytearray(read_len)
+        self.flash_dump_into(data)
+        return bytes(data)
+
+    @scsi_trace.operation("flash_dump")
+    def flash_dump_into(self, buf):
+        view = memoryview(buf).cast('B')
+        read_len = len(view)
+
         first_read_len = read_len
         second_read_len = 0
         if read_len > 0x10000:
@@ -253,84 +666,231 @@ class Asm246x(Asm2x6x):
             second_read_len = read_len - first_read_len
 
         cdb = struct.pack('>BBI', 0xe2, 0x50, first_read_len)
-        first_data = bytearray(first_read_len)
-        ret = sgio.execute(self._file, cdb, None, first_data)
+        (ret,) = self._transport.execute_many([(cdb, None, view[:first_read_len])])
         assert ret == 0
 
         time.sleep(1)
 
-        data = bytes(first_data)
         if second_read_len:
             cdb = struct.pack('>BBI', 0xe2, 0xd0, second_read_len)
-            second_data = bytearray(second_read_len)
-            ret = sgio.execute(self._file, cdb, None, second_data)
+            (ret,) = self._transport.execute_many([(cdb, None, view[first_read_len:])])
             assert ret == 0
 
             time.sleep(1)
 
-            data += bytes(second_data)
-
-        return data
-
-    def read(self, start_addr, read_len, stride=255):
-        data = bytearray(read_len)
+        return read_len
+
+    def _xdata_cdb_addr(self, addr):
+        assert addr >> 17 == 0
+        addr &= 0x01ffff
+        addr |= 0x500000
+
+        return (addr >> 16, addr & 0xffff)
+
+
+# The target address of a vendor CDB, for traces.
+def cdb_address(cdb):
+    opcode = cdb[0]
+    if opcode in (0xe4, 0xe5):
+        return (cdb[2] << 16) | (cdb[3] << 8) | cdb[4]
+    if opcode in (0xe0, 0xe1, 0xe2, 0xe3):
+        # Config and flash reads and writes always start at the beginning.
+        return 0
+    return None
+
+def open_transport(device, queue_depth=8):
+    # "sim" or "sim:<chip>" selects the software simulator instead of a real device.
+    if device == "sim" or device.startswith("sim:"):
+        import asm2x6x_sim
+        chip = device.partition(":")[2] or "ASM2364"
+        return asm2x6x_sim.Asm2x6xSimulator(chip.upper())
+
+    # "replay:<file>" plays back a recording as fast as possible, and
+    # "replay-realtime:<file>" takes as long as the recorded session did.
+    if device.startswith("replay:") or device.startswith("replay-realtime:"):
+        import scsi_record
+        if device.startswith("replay:"):
+            return scsi_record.ReplayTransport(device.partition(":")[2])
+        return scsi_record.ReplayTransport(device.partition(":")[2], realtime=True)
+
+    return transport.SgioTransport(device, queue_depth)
+
+# Touched by the udev rule in "etc/99-asm2x6x.rules" whenever an ASM2x6x device
+# is added or removed.
+HOTPLUG_STAMP = Path("/run/asm2x6x/hotplug")
+
+SCSI_DEVICES = Path("/sys/bus/scsi/devices")
+
+def cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return Path(cache_home, "asm2x6x")
+
+def discovery_cache_path():
+    return cache_dir().joinpath("devices.json")
+
+def pcie_topology_cache_path():
+    return cache_dir().joinpath("pcie_topology.json")
+
+def discovery_stamp():
+    # The cache is only valid while none of these have changed. "/dev" is
+    # included because device nodes get created and removed there even when
+    # the udev rule isn't installed.
+    stamp = []
+    for path in (HOTPLUG_STAMP, Path("/dev")):
+        try:
+            stamp.append(path.stat().st_mtime_ns)
+        except OSError:
+            stamp.append(None)
+    return stamp
+
+def usb_serial(sysfs_path):
+    # Walk up from the SCSI device to the USB device that it belongs to.
+    for parent in Path(sysfs_path).resolve().parents:
+        if parent.joinpath("idVendor").exists():
+            try:
+                return open(parent.joinpath("serial"), "r").read().strip()
+            except FileNotFoundError:
+                return ""
+    return ""
+
+def chip_class_for_model(model):
+    if model.startswith("ASM236"):
+        return Asm236x
+    if model.startswith("ASM246"):
+        return Asm246x
+    return None
+
+def scan_asm2x6x_devs():
+    devs = []
+    for path in SCSI_DEVICES.iterdir():
+        try:
+            vendor = open(path.joinpath("vendor"), "rb").read()
+            if not vendor.startswith(b"ASMT"):
+                continue
 
-        for i in range(0, read_len, stride):
-            remaining = read_len - i
-            buf_len = min(stride, remaining)
+            model = open(path.joinpath("model"), "rb").read()
+            if not (model.startswith(b"ASM236") or model.startswith(b"ASM246")):
+                continue
 
-            current_addr = start_addr + i
-            assert current_addr >> 17 == 0
-            current_addr &= 0x01ffff
-            current_addr |= 0x500000
+            for sg in path.joinpath("scsi_generic").iterdir():
+                devs.append({
+                    "sysfs": str(path),
+                    "model": model.split(b' ')[0].decode('utf-8'),
+                    "device": str(Path("/dev", sg.parts[-1])),
+                    "serial": usb_serial(path),
+                })
+                break
+        except FileNotFoundError:
+            continue
 
-            cdb = struct.pack('>BBBHB', 0xe4, buf_len, current_addr >> 16, current_addr & 0xffff, 0x00)
+    return devs
 
-            buf = bytearray(buf_len)
-            ret = sgio.execute(self._file, cdb, None, buf)
-            assert ret == 0
+def load_discovery_cache():
+    try:
+        cache = json.load(open(discovery_cache_path(), 'r'))
+    except (OSError, ValueError):
+        return None
 
-            data[i:i+buf_len] = buf
+    if cache.get("stamp") != discovery_stamp():
+        return None
 
-        return bytes(data)
+    devs = cache.get("devices", [])
+    for dev in devs:
+        if not (os.path.exists(dev["sysfs"]) and os.path.exists(dev["device"])):
+            return None
 
+    return devs
 
-def get_asm2x6x_dev(device="auto"):
+def save_discovery_cache(devs):
+    path = discovery_cache_path()
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump({"stamp": discovery_stamp(), "devices": devs}, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+def find_asm2x6x_devs(use_cache=True):
+    # Returns a list of (sysfs path, model, SG device path) tuples.
+    devs = None
+    if use_cache:
+        devs = load_discovery_cache()
+    if devs is None:
+        devs = scan_asm2x6x_devs()
+        save_discovery_cache(devs)
+
+    return [(Path(dev["sysfs"]), dev["model"], dev["device"]) for dev in devs]
+
+def usb_root_hub(sysfs_path):
+    # The root hub is the "usbN" component of the device's sysfs path.
+    for part in Path(sysfs_path).resolve().parts:
+        if re.fullmatch(r'usb\d+', part):
+            return part
+
+    return "unknown"
+
+# The root hub of a device given by its path, like "/dev/sg2" or "/dev/sdb".
+def device_root_hub(device):
+    name = Path(device).name
+    for class_dir in ("/sys/class/scsi_generic", "/sys/class/block"):
+        sysfs_path = Path(class_dir, name, "device")
+        if sysfs_path.exists():
+            return usb_root_hub(sysfs_path)
+
+    return "unknown"
+
+def get_asm2x6x_dev(device="auto", queue_depth=8, wrap=None, use_cache=True):
+    chip_class = None
     if device == "auto":
         # Search for devices
-        for path in Path("/sys/bus/scsi/devices").iterdir():
-            try:
-                vendor = open(path.joinpath("vendor"), "rb").read()
-                if not vendor.startswith(b"ASMT"):
-                    continue
-
-                model = open(path.joinpath("model"), "rb").read()
-                if not (model.startswith(b"ASM236") or model.startswith(b"ASM246")):
-                    continue
+        devs = find_asm2x6x_devs(use_cache)
+        if not devs:
+            return None
 
-                for sg in path.joinpath("scsi_generic").iterdir():
-                    device = str(Path("/dev", sg.parts[-1]))
-                    sys.stderr.write("Using {} device at \"{}\".\n".format(model.split(b' ')[0].decode('utf-8'), device))
-                    break
+        _, model, device = devs[0]
+        sys.stderr.write("Using {} device at \"{}\".\n".format(model, device))
+        chip_class = chip_class_for_model(model)
+    elif use_cache and not device.startswith(("sim", "replay")):
+        cached = load_discovery_cache() or []
+        for dev_info in cached:
+            if dev_info["device"] == device:
+                chip_class = chip_class_for_model(dev_info["model"])
+                break
 
-                if device != "auto":
-                    break
-            except FileNotFoundError:
-                continue
+    # Initialize the device object.
+    dev_transport = open_transport(device, queue_depth)
+    if wrap is not None:
+        dev_transport = wrap(dev_transport)
 
-        if device == "auto":
-            return None
+    if chip_class is not None:
+        dev = chip_class(dev_transport)
+        dev.device = device
+        return dev
 
-    # Initialize the device object.
-    dev = Asm236x(device)
+    # The model is unknown, so probe for it.
+    dev = Asm236x(dev_transport)
     try:
         # This will fail if the device is an ASM246x
         dev.get_fw_version_data()
-    except sgio.CheckConditionError:
-        dev = Asm246x(device)
+    except transport.CheckConditionError:
+        dev = Asm246x(dev_transport)
 
+    dev.device = device
     return dev
 
+# A stable name for the bridge behind a device path, for keying caches of what's
+# behind it: its USB serial number if it has one, or else the path itself.
+def bridge_key(device):
+    if device.startswith(("sim", "replay")):
+        return device
+    devs = load_discovery_cache() or scan_asm2x6x_devs()
+    for dev_info in devs:
+        if dev_info["device"] == device and dev_info.get("serial"):
+            return "usb:{}".format(dev_info["serial"])
+    return device
+
 def fw_version_bytes_to_string(version):
     return "{:02X}{:02X}{:02X}_{:02X}_{:02X}_{:02X}".format(*version)
 
@@ -375,68 +935,422 @@ def parse_bdf(bdf):
 
     return (bus, dev, fn)
 
+def parse_pcie_address(address):
+    # <address>[.B|.W|.L]
+    size = 4
+
+    addr_parts = address.split('.')
+    if len(addr_parts) == 2:
+        size = {
+            'b': 1,
+            'w': 2,
+            'l': 4,
+        }.get(addr_parts[-1].lower())
+        if not size:
+            raise ValueError("Invalid address specifier \"{}\"".format(address))
+    elif len(addr_parts) > 2:
+        raise ValueError("Invalid address specifier \"{}\"".format(address))
+
+    return (int(addr_parts[0], 16), size)
+
+VERIFY_BLOCK_SIZE = 4096
+NONZERO_RUN = re.compile(rb'[^\x00]+')
+
+# Compares two equal-length buffers and returns the ranges where they differ,
+# as [start, end, count] lists, where "end" is exclusive and "count" is the
+# number of differing bytes in the range. Equal blocks are skipped with a single
+# comparison, and the differing bytes in a block are found by XORing the block
+# as one big integer. Ranges closer together than "merge_gap" bytes are merged.
+def find_mismatches(expected, actual, merge_gap=16):
+    expected = memoryview(expected).cast('B')
+    actual = memoryview(actual).cast('B')
+    assert len(expected) == len(actual)
+
+    ranges = []
+    for block_start in range(0, len(expected), VERIFY_BLOCK_SIZE):
+        a = expected[block_start:block_start+VERIFY_BLOCK_SIZE]
+        b = actual[block_start:block_start+VERIFY_BLOCK_SIZE]
+        if a == b:
+            continue
+
+        diff = (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
+        for match in NONZERO_RUN.finditer(diff):
+            start = block_start + match.start()
+            end = block_start + match.end()
+            if ranges and start - ranges[-1][1] < merge_gap:
+                ranges[-1][1] = end
+                ranges[-1][2] += end - start
+            else:
+                ranges.append([start, end, end - start])
+
+    return ranges
+
+# Prints the ranges from "find_mismatches()" with addresses offset by "base",
+# followed by a summary. Returns the number of differing bytes.
+def report_mismatches(ranges, expected, actual, base=0, label="address", max_ranges=32):
+    errors = sum(count for _, _, count in ranges)
+    if not ranges:
+        return errors
+
+    for start, end, count in ranges[:max_ranges]:
+        if end - start == 1:
+            print(" + Mismatch at {} 0x{:08x}: Expected 0x{:02x}, read 0x{:02x}.".format(
+                label, base + start, expected[start], actual[start]))
+        else:
+            print(" + Mismatch at {} 0x{:08x}-0x{:08x}: {} of {} bytes differ.".format(
+                label, base + start, base + end - 1, count, end - start))
+    if len(ranges) > max_ranges:
+        print(" + ...and {} more ranges.".format(len(ranges) - max_ranges))
+
+    first = ranges[0][0]
+    last = ranges[-1][1] - 1
+    print(" + {} bytes differ in {} ranges. First: {} 0x{:08x} (expected 0x{:02x}, read 0x{:02x}), last: {} 0x{:08x} (expected 0x{:02x}, read 0x{:02x}).".format(
+        errors, len(ranges),
+        label, base + first, expected[first], actual[first],
+        label, base + last, expected[last], actual[last]))
+
+    return errors
+
+def dump_with_map(args, dev):
+    import xdata_map
+
+    size, regions = xdata_map.load_map(args.map)
+    plan = xdata_map.plan_dump(regions, args.read_mmio)
+    stride = 255
+    chunk_len = 16 * stride
+
+    read_ranges = [(start, end - start) for start, end, _, _, action in plan if action == xdata_map.READ]
+
+    params = {"command": "dump", "length": size, "chunk": chunk_len, "map": xdata_map.to_json(args.map, size, regions)["regions"], "read_mmio": args.read_mmio}
+    journal = dumpio.Journal(args.dump_file, params, resume=args.resume)
+    writer = dumpio.DumpWriter(args.dump_file, size, progress=not args.quiet, resume=journal.resumed)
+
+    def read_chunk(offset, view, chunk_stride):
+        dev.readinto(offset, view, chunk_stride)
+
+    start_ns = time.perf_counter_ns()
+    count = dumpio.read_chunks(writer, journal, size, chunk_len, stride, read_chunk, args.retries, ranges=read_ranges)
+
+    # Fill in everything that wasn't read, in address order so that mirrors of
+    # mirrors are copied after the regions they're copied from.
+    for start, end, _, mirror_of, action in plan:
+        if action == xdata_map.COPIED:
+            writer.write_at(start, writer.read_at(mirror_of, end - start))
+        elif action != xdata_map.READ:
+            writer.write_at(start, bytes(end - start))
+
+    end_ns = time.perf_counter_ns()
+    writer.close()
+    journal.complete()
+    elapsed = end_ns - start_ns
+    print("Read {} of {} bytes in {:.6f} seconds ({} bytes per second).".format(
+        count, size, elapsed/1e9, int(count*1e9) // elapsed))
+
+    manifest_path = args.dump_file + ".regions.json"
+    with open(manifest_path, 'w') as f:
+        json.dump({
+            "map": args.map,
+            "size": size,
+            "regions": [{"start": start, "end": end, "kind": kind, "mirror_of": mirror_of, "action": action}
+                for start, end, kind, mirror_of, action in plan],
+        }, f, indent=2)
+        f.write("\n")
+    print("Wrote region manifest to \"{}\".".format(manifest_path))
+
+    return 0
+
 def dump(args, dev):
+    if args.map:
+        return dump_with_map(args, dev)
+
     start_addr = 0x0000
     read_len = 1 << 16
     stride = 128
+    chunk_len = 32 * stride
+
+    params = {"command": "dump", "start": start_addr, "length": read_len, "chunk": chunk_len}
+    journal = dumpio.Journal(args.dump_file, params, resume=args.resume)
+    writer = dumpio.DumpWriter(args.dump_file, read_len, progress=not args.quiet, resume=journal.resumed)
+
+    def read_chunk(offset, view, chunk_stride):
+        dev.readinto(start_addr + offset, view, chunk_stride)
 
     start_ns = time.perf_counter_ns()
-    data = dev.read(start_addr, read_len, stride)
+    count = dumpio.read_chunks(writer, journal, read_len, chunk_len, stride, read_chunk, args.retries)
     end_ns = time.perf_counter_ns()
+    writer.close()
+    journal.complete()
     elapsed = end_ns - start_ns
     print("Read {} bytes in {:.6f} seconds ({} bytes per second).".format(
-        len(data), elapsed/1e9, int(len(data)*1e9) // elapsed))
-
-    open(args.dump_file, 'wb').write(data)
+        count, elapsed/1e9, int(count*1e9) // elapsed))
 
     return 0
 
 def flash_dump(args, dev):
+    import flash_manifest
+
     read_len = args.length
 
+    chunk_len = args.chunk_size
+    if args.resume and not chunk_len:
+        chunk_len = 4096
+
+    if chunk_len:
+        # Read through the flash controller in chunks that can be journaled,
+        # retried, and resumed.
+        if not hasattr(dev, "flash_readinto"):
+            print("Error: Chunked flash dumps are not supported on this device.", file=sys.stderr)
+            return 1
+
+        params = {"command": "flash_dump", "length": read_len, "chunk": chunk_len}
+        journal = dumpio.Journal(args.flash_dump_file, params, resume=args.resume)
+        writer = dumpio.DumpWriter(args.flash_dump_file, read_len, progress=not args.quiet, resume=journal.resumed)
+
+        def read_chunk(offset, view, chunk_stride):
+            dev.flash_readinto(offset, view, chunk_stride)
+
+        start_ns = time.perf_counter_ns()
+        count = dumpio.read_chunks(writer, journal, read_len, chunk_len, 128, read_chunk, args.retries)
+        end_ns = time.perf_counter_ns()
+        writer.close()
+        journal.complete()
+    else:
+        writer = dumpio.DumpWriter(args.flash_dump_file, read_len, progress=not args.quiet)
+
+        # The whole dump is a single command, so receive it directly into the
+        # mapped output file instead of a buffer.
+        start_ns = time.perf_counter_ns()
+        view = writer.map(0, read_len)
+        attempt = 0
+        while True:
+            try:
+                dev.flash_dump_into(view)
+                break
+            except Exception as e:
+                attempt += 1
+                if attempt > args.retries:
+                    raise
+                sys.stderr.write("Warning: Flash read failed ({}: {}), retrying ({}/{})...\n".format(
+                    type(e).__name__, e, attempt, args.retries))
+        view.release()
+        writer.mapped(read_len)
+        end_ns = time.perf_counter_ns()
+        writer.close()
+        count = read_len
+
+    elapsed = end_ns - start_ns
+    print("Read {} bytes in {:.6f} seconds ({} bytes per second).".format(
+        count, elapsed/1e9, int(count*1e9) // elapsed))
+
+    if args.manifest:
+        manifest = flash_manifest.build(open(args.flash_dump_file, 'rb').read())
+        flash_manifest.save(args.manifest, manifest)
+        print("Wrote manifest to \"{}\".".format(args.manifest))
+
+    return 0
+
+def flash_update(args, dev):
+    import flash_manifest
+
+    if not hasattr(dev, "flash_readinto"):
+        print("Error: Incremental flash dumps are not supported on this device.", file=sys.stderr)
+        return 1
+
+    image = bytearray(open(args.previous, 'rb').read())
+    if args.previous_manifest:
+        manifest = flash_manifest.load(args.previous_manifest)
+    else:
+        manifest = flash_manifest.build(image, args.block_size)
+    if manifest["length"] != len(image):
+        print("Error: Manifest is for a {}-byte image, but the previous image is {} bytes.".format(manifest["length"], len(image)), file=sys.stderr)
+        return 1
+
+    block_size = manifest["block_size"]
+    hashes = list(manifest["blocks"])
+    buf = bytearray(block_size)
+
+    def device_read(offset, length):
+        data = bytearray(length)
+        dev.flash_readinto(offset, data, args.stride)
+        return data
+
     start_ns = time.perf_counter_ns()
-    data = dev.flash_dump(read_len)
+
+    # Every block is checked, using a single dump of the whole flash, which is
+    # much faster than reading each block with the flash controller. With
+    # "--fast", if the firmware's size, version, magic, and checksum are all
+    # unchanged, only the blocks holding the config and the firmware header and
+    # trailer are read, with the flash controller, so corruption anywhere else
+    # goes unnoticed.
+    flash = None
+    order = None
+    if args.fast:
+        device_fingerprint = flash_manifest.fingerprint(device_read)
+        if flash_manifest.firmware_fingerprint_matches(device_fingerprint, manifest["fingerprint"]):
+            order = flash_manifest.priority_blocks(manifest)
+    if order is None:
+        flash = bytearray(len(image))
+        dev.flash_dump_into(flash)
+        order = range(len(hashes))
+
+    changed = []
+    records = []
+    for index in order:
+        offset = index * block_size
+        length = min(block_size, len(image) - offset)
+        if flash is not None:
+            view = memoryview(flash)[offset:offset+length]
+        else:
+            view = memoryview(buf)[:length]
+            dev.flash_readinto(offset, view, args.stride)
+        block_hash = flash_manifest.block_hash(view)
+        previous_hash = hashes[index]
+        if previous_hash is None:
+            # Not read by the update that wrote the manifest.
+            previous_hash = flash_manifest.block_hash(image[offset:offset+len(view)])
+        if block_hash != previous_hash:
+            changed.append(index)
+            hashes[index] = block_hash
+            image[offset:offset+len(view)] = view
+            records.append((offset, bytes(view)))
+
     end_ns = time.perf_counter_ns()
     elapsed = end_ns - start_ns
-    print("Read {} bytes in {:.6f} seconds ({} bytes per second).".format(
-        len(data), elapsed/1e9, int(len(data)*1e9) // elapsed))
 
-    open(args.flash_dump_file, 'wb').write(data)
+    print("Checked {} of {} blocks in {:.6f} seconds.".format(len(order), len(hashes), elapsed/1e9))
+    if len(order) < len(hashes):
+        print("The firmware fingerprint is unchanged, so the other {} blocks were not read. Run without \"--fast\" to check them.".format(
+            len(hashes) - len(order)))
+    if changed:
+        for index in sorted(changed):
+            print("Changed: block {} (flash 0x{:06x}-0x{:06x})".format(
+                index, index * block_size, min((index + 1) * block_size, len(image)) - 1))
+    elif len(order) < len(hashes):
+        print("No changes in the blocks that were read.")
+    else:
+        print("No changes.")
+
+    if args.output:
+        open(args.output, 'wb').write(image)
+        print("Wrote updated image to \"{}\".".format(args.output))
+
+    if args.delta:
+        flash_manifest.write_delta(args.delta, manifest, records)
+        print("Wrote {} changed blocks to \"{}\".".format(len(records), args.delta))
+
+    if args.manifest:
+        new_manifest = dict(manifest)
+        # Blocks that weren't read have no known hash, so a later update
+        # always reads them.
+        verified = set(order)
+        new_manifest["blocks"] = [block_hash if index in verified else None for index, block_hash in enumerate(hashes)]
+        new_manifest["fingerprint"] = flash_manifest.fingerprint(lambda offset, length: image[offset:offset+length])
+        new_manifest["verified_blocks"] = sorted(order)
+        flash_manifest.save(args.manifest, new_manifest)
+        print("Wrote manifest to \"{}\".".format(args.manifest))
 
     return 0
 
+FLASH_READER_DUMP_LEN = 0x1000
+
+# Returns a "read(offset, length)" function for the device's flash that uses
+# whichever read is cheapest: data near the start of the flash is sliced out of
+# a single E2 dump that's made the first time it's needed and then kept, and
+# anything else is read with the flash controller.
+def flash_reader(dev):
+    dump = [b""]
+
+    def read(offset, length):
+        end = offset + length
+        if end <= FLASH_READER_DUMP_LEN or not hasattr(dev, "flash_read"):
+            if end > len(dump[0]):
+                dump[0] = dev.flash_dump(max(end, FLASH_READER_DUMP_LEN))
+            return memoryview(dump[0])[offset:end]
+        return dev.flash_read(offset, length)
+    return read
+
+FW_WRITE_SAMPLES = 16
+FW_WRITE_SAMPLE_LEN = 64
+
+# Checks whether the flash already holds "config_data" (if any) and "fw_data"
+# at 0x80, without reading the whole firmware back. The config, firmware size,
+# BCD version, magic, and checksum are compared first, and only if those all
+# match is the firmware body confirmed, either by comparing evenly-spaced
+# samples of it or by reading all of it.
+def flash_matches_firmware(dev, config_data, fw_data, check="sample"):
+    import flash_manifest
+    import fw_image
+
+    read = flash_reader(dev)
+
+    expected = bytearray(b'\xff' * fw_image.CONFIG_LEN) + fw_data
+    if config_data:
+        expected[:len(config_data)] = config_data
+    expected_fp = flash_manifest.fingerprint(lambda offset, length: expected[offset:offset+length])
+
+    header = read(0, fw_image.FLASH_CODE_OFFSET)
+    if config_data and header[4:len(config_data)] != config_data[4:]:
+        return False
+
+    device_fp = flash_manifest.fingerprint(read)
+    if not flash_manifest.firmware_fingerprint_matches(device_fp, expected_fp):
+        return False
+
+    if check == "full":
+        # A single E2 dump, like the readback after a write.
+        return memoryview(dev.flash_dump(0x80 + len(fw_data)))[0x80:] == fw_data
+
+    fw_view = memoryview(fw_data)
+    step = max(len(fw_data) // FW_WRITE_SAMPLES, 1)
+    for offset in range(0, len(fw_data), step):
+        sample = fw_view[offset:offset+FW_WRITE_SAMPLE_LEN]
+        if read(0x80 + offset, len(sample)) != sample:
+            return False
+
+    return True
+
 def fw_write(args, dev):
-    fw_file = open(args.fw_file, 'rb').read()
+    import fw_image
 
-    config_data = b''
-    fw_data = fw_file
-    if not args.raw:
-        config_data = b'\xff' * 4 + fw_file[4:0x80]
-        fw_data = fw_file[0x80:]
+    if args.fw_file == "-":
+        fw_file = sys.stdin.buffer.read()
+    else:
+        fw_file = open(args.fw_file, 'rb').read()
 
-    if config_data:
-        config_magic = config_data[-2]
-        if config_magic != 0x5a:
-            print("Error: Bad config magic. Expected 0x5a, got 0x{:02x}.".format(fw_magic))
+    try:
+        image = fw_image.Asm236xImage(fw_file, has_config=not args.raw)
+    except ValueError as e:
+        print("Error: {}".format(e))
+        return 1
+
+    config_data = b''
+    if image.config is not None:
+        config = image.config
+        if config.magic != fw_image.CONFIG_MAGIC:
+            print("Error: Bad config magic. Expected 0x{:02x}, got 0x{:02x}.".format(fw_image.CONFIG_MAGIC, config.magic))
             return 1
-        config_checksum = config_data[-1]
-        config_checksum_calc = sum(config_data[4:-1]) & 0xff
-        if config_checksum_calc != config_checksum:
-            print("Error: Bad config checksum. Expected 0x{:02x}, calculated 0x{:02x}.".format(config_checksum, config_checksum_calc))
+        if not config.checksum_ok():
+            print("Error: Bad config checksum. Expected 0x{:02x}, calculated 0x{:02x}.".format(config.checksum, config.calculated_checksum()))
             return 1
+        config_data = b'\xff' * 4 + config.data[4:]
 
-    fw_size = struct.unpack_from('<H', fw_data, 0)[0]
-    fw_data = fw_data[:fw_size+8]
-    fw_magic = fw_data[2+fw_size+0]
-    if fw_magic not in (0x4b, 0x5a):
-        print("Error: Bad FW magic. Expected 0x4b or 0x5a, got 0x{:02x}.".format(fw_magic))
+    body = image.body
+    fw_data = bytes(body.data[:body.size+8])
+    if body.magic not in fw_image.BODY_MAGICS:
+        print("Error: Bad FW magic. Expected 0x4b or 0x5a, got 0x{:02x}.".format(body.magic))
         return 1
-    fw_checksum_calc = sum(fw_data[2:2+fw_size]) & 0xff
-    fw_checksum = fw_data[2+fw_size+1]
-    if fw_checksum_calc != fw_checksum:
-        print("Error: Bad FW checksum. Expected 0x{:02x}, calculated 0x{:02x}.".format(fw_checksum, fw_checksum_calc))
+    if not body.checksum_ok():
+        print("Error: Bad FW checksum. Expected 0x{:02x}, calculated 0x{:02x}.".format(body.checksum, body.calculated_checksum()))
         return 1
 
+    if not args.force:
+        start_ns = time.perf_counter_ns()
+        matches = flash_matches_firmware(dev, config_data, fw_data, args.check)
+        end_ns = time.perf_counter_ns()
+        if matches:
+            print("The flash already contains this firmware, so it was not rewritten (checked in {:.6f} seconds).".format((end_ns - start_ns)/1e9))
+            return 0
+
     if config_data:
         start_ns = time.perf_counter_ns()
         data = dev.config_write(config_data)
@@ -460,21 +1374,19 @@ def fw_write(args, dev):
         len(rb_data), elapsed/1e9, int(len(rb_data)*1e9) // elapsed))
 
     errors = 0
+    rb_view = memoryview(rb_data)
     if config_data:
-        for i in range(4, len(config_data)):
-            rb_byte = rb_data[i]
-            config_byte = config_data[i]
-            if rb_byte != config_byte:
-                errors += 1
-                print("Error: Bad data at flash address 0x{:08x} (config offset 0x{:08x}): Expected 0x{:02x}, read 0x{:02x}.".format(
-                    i, i, config_byte, rb_byte))
-
-    for i in range(len(fw_data)):
-        rb_byte = rb_data[0x80:][i]
-        fw_byte = fw_data[i]
-        if rb_byte != fw_byte:
-            errors += 1
-            print("Error: Bad data at flash address 0x{:08x} (firmware offset 0x{:08x}): Expected 0x{:02x}, read 0x{:02x}.".format(0x80 + i, i, fw_byte, rb_byte))
+        # The first four bytes of the config are always written as 0xff.
+        config_ranges = find_mismatches(config_data[4:], rb_view[4:len(config_data)])
+        if config_ranges:
+            print("Error: Bad config data:")
+            errors += report_mismatches(config_ranges, config_data[4:], rb_view[4:len(config_data)], base=4, label="flash address")
+
+    fw_rb = rb_view[0x80:0x80+len(fw_data)]
+    fw_ranges = find_mismatches(fw_data, fw_rb)
+    if fw_ranges:
+        print("Error: Bad firmware data:")
+        errors += report_mismatches(fw_ranges, fw_data, fw_rb, base=0x80, label="flash address")
 
     if errors > 0:
         print("Error: Verification failed with {} errors!".format(errors))
@@ -579,20 +1491,18 @@ def memtest(args, dev):
         ("Zeros 2", zeros),
     )
 
+    before = bytearray(test_len)
+    after = bytearray(test_len)
     for test_name, test_data in tests:
         print("Running test \"{}\"...".format(test_name))
 
-        before = dev.read(start_addr, test_len, stride)
+        dev.readinto(start_addr, before, stride)
         dev.write(start_addr, test_data)
-        after = dev.read(start_addr, test_len, stride)
+        dev.readinto(start_addr, after, stride)
 
         if after != test_data:
             print("Error: Failed test \"{}\"!".format(test_name))
-            for i in range(test_len):
-                if after[i] != test_data[i]:
-                    print(" + Mismatch at address 0x{:04x}: Expected 0x{:02x}, got 0x{:02x} instead.".format(
-                        start_addr + i, test_data[i], after[i]))
-                    break
+            report_mismatches(find_mismatches(test_data, after), test_data, after, base=start_addr)
 
             if after == before:
                 print(" + Write had no effect--this is likely read-only memory.")
@@ -601,6 +1511,46 @@ def memtest(args, dev):
 
     return 0
 
+def parse_range(arg):
+    # <start>-<end>, inclusive, in hexadecimal
+    start, _, end = arg.partition('-')
+    return (int(start, 16), int(end or start, 16) + 1)
+
+def memmap(args, dev):
+    import xdata_map
+
+    size = args.size if args.size else dev.xdata_size
+    write = not args.read_only
+    if write and not hasattr(dev, "write"):
+        print("Warning: This device doesn't support XDATA writes, so only a read-only probe will be done.", file=sys.stderr)
+        write = False
+
+    # Writing a signature into the firmware's variables or a hardware register
+    # can crash the firmware or trigger side effects, so the RAM and MMIO
+    # regions of the chip's built-in map are left alone unless asked for.
+    exclude = list(args.exclude)
+    map_name = (args.chip or dev.xdata_map_name or "").upper()
+    if write and not args.write_known and map_name in xdata_map.BUILTIN_MAPS:
+        protected = xdata_map.protected_ranges(xdata_map.BUILTIN_MAPS[map_name][1])
+        exclude += protected
+        print("Note: Not writing to the {} RAM and MMIO regions of the built-in {} map. Use \"--write-known\" to probe them too.".format(
+            len(protected), map_name), file=sys.stderr)
+
+    start_ns = time.perf_counter_ns()
+    regions = xdata_map.probe(dev, size, args.page_size, args.probe_offset, exclude, write)
+    end_ns = time.perf_counter_ns()
+
+    for region in regions:
+        print(xdata_map.region_to_string(region))
+    print("Probed {} bytes in {:.6f} seconds.".format(size, (end_ns - start_ns)/1e9))
+
+    if args.output:
+        chip = args.chip or type(dev).__name__
+        xdata_map.save(args.output, chip, size, regions, args.page_size)
+        print("Wrote memory map to \"{}\".".format(args.output))
+
+    return 0
+
 def flash_read(args, dev):
     start_addr = int(args.address, 16)
     read_len = args.length
@@ -622,67 +1572,154 @@ def flash_read(args, dev):
 
     return 0
 
+def cfg_readers(dev):
+    def read_block(bdf, offset, count):
+        bus, dev_num, fn = bdf
+        return dev.pcie_cfg_read_block(offset, count, bus=bus, dev=dev_num, fn=fn, cfgreq_type=1 if bus != 0 else 0)
+
+    def read_dword(bdf, offset):
+        return struct.unpack('<I', read_block(bdf, offset, 1))[0]
+
+    return (read_block, read_dword)
+
+BDF_PATTERN = re.compile(r'[0-9a-fA-F]{0,2}(:[0-9a-fA-F]{0,2})?(\.[0-7]?)?')
+
+# Turns a BDF, or the name or vendor:device IDs of a function that "pcie_scan"
+# found behind this bridge, into a (bus, device, function) tuple. Named
+# functions are looked up in the cached topology, and their IDs are read back
+# to make sure the topology hasn't changed since it was cached.
+def resolve_bdf(dev, spec):
+    import pcie_topology
+
+    if BDF_PATTERN.fullmatch(spec):
+        return parse_bdf(spec)
+
+    key = bridge_key(dev.device)
+    functions = pcie_topology.load_cache(pcie_topology_cache_path()).get(key)
+    if functions is None:
+        raise ValueError("No PCIe topology has been cached for \"{}\". Run \"pcie_scan\" first.".format(key))
+    function = pcie_topology.find(functions, spec)
+    if function is None:
+        raise ValueError("No function named \"{}\" was found behind \"{}\". Known: {}".format(
+            spec, key, ", ".join(f["name"] for f in functions)))
+
+    bdf = parse_bdf(function["bdf"])
+    _, read_dword = cfg_readers(dev)
+    try:
+        ids = read_dword(bdf, 0)
+    except transport.PcieCompletionError as e:
+        if e.status != transport.PcieCompletionError.UNSUPPORTED_REQUEST:
+            raise
+        ids = 0xffffffff
+    if ids != (function["device_id"] << 16) | function["vendor_id"]:
+        raise ValueError("{} ({}) is no longer {:04x}:{:04x}. Run \"pcie_scan\" again.".format(
+            spec, function["bdf"], function["vendor_id"], function["device_id"]))
+
+    return bdf
+
+def pcie_scan(args, dev):
+    import pcie_topology
+
+    cache_path = pcie_topology_cache_path()
+    cache = pcie_topology.load_cache(cache_path)
+    key = bridge_key(dev.device)
+
+    if args.cached:
+        functions = cache.get(key)
+        if functions is None:
+            print("Error: No PCIe topology has been cached for \"{}\".".format(key), file=sys.stderr)
+            return 1
+    else:
+        read_block, read_dword = cfg_readers(dev)
+        start_ns = time.perf_counter_ns()
+        functions = pcie_topology.scan(read_block, read_dword, walk_all=args.capabilities)
+        elapsed = time.perf_counter_ns() - start_ns
+        print("Found {} functions in {:.6f} seconds.".format(len(functions), elapsed/1e9))
+
+        cache[key] = functions
+        pcie_topology.save_cache(cache_path, cache)
+
+    for function in functions:
+        for line in pcie_topology.function_to_lines(function):
+            print(line)
+
+    return 0
+
 def pcie(args, dev):
     value = None
     if args.value:
         value = int(args.value, 16)
 
-    size = 4
+    mask = None
+    if args.mask:
+        mask = int(args.mask, 16)
 
-    addr_parts = args.address.split('.')
-    if len(addr_parts) == 2:
-        size = {
-            'b': 1,
-            'w': 2,
-            'l': 4,
-        }.get(addr_parts[-1].lower())
-        if not size:
-            raise ValueError("Invalid address specifier \"{}\"".format(args.address))
-    elif len(addr_parts) > 2:
-        raise ValueError("Invalid address specifier \"{}\"".format(args.address))
-    byte_addr = int(addr_parts[0], 16)
+    addresses = [parse_pcie_address(address) for address in args.address]
+
+    if value is not None and len(addresses) > 1:
+        print("Error: Only one address can be written to at a time.", file=sys.stderr)
+        return 1
+    if mask is not None and (value is None or not args.bdf):
+        print("Error: A mask can only be used when writing to config space.", file=sys.stderr)
+        return 1
 
     if args.bdf:
         mem_type = "CFG"
+        addr_fmt = "0x{:04X}"
 
-        bdf = parse_bdf(args.bdf)
-
-        cfgreq_type = 0
-        if bdf[0] != 0:
-            cfgreq_type = 1
+        try:
+            bdf = resolve_bdf(dev, args.bdf)
+        except ValueError as e:
+            print("Error: {}".format(e), file=sys.stderr)
+            return 1
 
-        addr_str = "0x{:04X}".format(byte_addr)
+        config = dev.pcie_config_space(*bdf)
 
-        data = dev.pcie_cfg_req(byte_addr, bus=bdf[0], dev=bdf[1], fn=bdf[2], cfgreq_type=cfgreq_type, value=value, size=size)
+        if value is None:
+            # All of the registers are read together, so adjacent ones share
+            # block reads and narrow ones in the same DWORD share a read.
+            results = config.read_many(addresses)
+        else:
+            byte_addr, size = addresses[0]
+            if mask is None:
+                config.write(byte_addr, value, size)
+            else:
+                config.update(byte_addr, clear=mask, set=value & mask, size=size)
 
     else:
         mem_type = "MEM"
+        addr_fmt = "0x{:08X}"
 
-        addr_str = "0x{:08X}".format(byte_addr)
-
-        data = dev.pcie_mem_req(byte_addr, value, size)
+        if value is None:
+            results = [dev.pcie_mem_req(byte_addr, None, size) for byte_addr, size in addresses]
+        else:
+            byte_addr, size = addresses[0]
+            dev.pcie_mem_req(byte_addr, value, size)
 
     if value is None:
-        data_str = {
-            1: "0x{:02x}",
-            2: "0x{:04x}",
-            4: "0x{:08x}",
-        }[size].format(data)
-        print("{}[{}]: {}".format(mem_type, addr_str, data_str))
+        for (byte_addr, size), data in zip(addresses, results):
+            data_str = {
+                1: "0x{:02x}",
+                2: "0x{:04x}",
+                4: "0x{:08x}",
+            }[size].format(data)
+            print("{}[{}]: {}".format(mem_type, addr_fmt.format(byte_addr), data_str))
 
     return 0
 
 def pcie_cfg_dump(args, dev):
-    bdf = parse_bdf(args.bdf)
+    try:
+        bdf = resolve_bdf(dev, args.bdf)
+    except ValueError as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        return 1
 
     cfgreq_type = 0
     if bdf[0] != 0:
         cfgreq_type = 1
 
-    buf = bytearray(4096)
     start_ns = time.perf_counter_ns()
-    for addr in range(0, len(buf), 4):
-        struct.pack_into('<I', buf, addr, dev.pcie_cfg_req(addr, bus=bdf[0], dev=bdf[1], fn=bdf[2], cfgreq_type=cfgreq_type))
+    buf = dev.pcie_cfg_read_block(0, 1024, bus=bdf[0], dev=bdf[1], fn=bdf[2], cfgreq_type=cfgreq_type)
     end_ns = time.perf_counter_ns()
     elapsed = end_ns - start_ns
     if args.output:
@@ -712,58 +1749,330 @@ def pcie_mem_dump(args, dev):
     else:
         length = int(args.length)
 
-    buf = bytearray(length)
-
-    start_ns = time.perf_counter_ns()
-
-    offset = start_addr & 0x3
-    unaligned_len = 0
-    if offset:
-        unaligned_len = 4 - offset
-        for i in range(unaligned_len):
-            buf[i] = dev.pcie_mem_req(start_addr + i, size=1)
+    chunk_len = 4096
 
-    aligned_len = ((len(buf) - unaligned_len) // 4) * 4
-    for i in range(0, aligned_len, 4):
-        buf_idx = unaligned_len + i
-        struct.pack_into('<I', buf, buf_idx, dev.pcie_mem_req(start_addr + buf_idx, size=4))
+    params = {"command": "pcie_mem_dump", "start": start_addr, "length": length, "chunk": chunk_len}
+    journal = dumpio.Journal(args.pcie_mem_dump_file, params, resume=args.resume)
+    dump = dumpio.DumpWriter(args.pcie_mem_dump_file, length, progress=not args.quiet, resume=journal.resumed)
 
-    remaining = len(buf) - unaligned_len - aligned_len
-    for i in range(remaining):
-        buf_idx = unaligned_len + aligned_len + i
-        buf[buf_idx] = dev.pcie_mem_req(start_addr + buf_idx, size=1)
+    def read_chunk(offset, view, stride):
+        view[:] = dev.pcie_mem_read_block(start_addr + offset, len(view))
 
+    start_ns = time.perf_counter_ns()
+    count = dumpio.read_chunks(dump, journal, length, chunk_len, 4, read_chunk, args.retries)
     end_ns = time.perf_counter_ns()
     elapsed = end_ns - start_ns
     print("Read {} bytes in {:.6f} seconds ({} bytes per second).".format(
-        len(buf), elapsed/1e9, int(len(buf)*1e9) // elapsed))
+        count, elapsed/1e9, int(count*1e9) // elapsed))
 
-    dump = open(args.pcie_mem_dump_file, 'wb')
-    dump.write(buf)
     dump.close()
+    journal.complete()
 
     print("Wrote memory dump to \"{}\".".format(args.pcie_mem_dump_file))
 
     return 0
 
+PCIE_LOAD_CHUNK_LEN = 4096
+PCIE_LOAD_SAMPLES = 16
+PCIE_LOAD_SAMPLE_LEN = 64
+
+def pcie_mem_load(args, dev):
+    start_addr = int(args.address, 16)
+
+    if args.pcie_mem_load_file == "-":
+        data = sys.stdin.buffer.read()
+    else:
+        data = open(args.pcie_mem_load_file, 'rb').read()
+    view = memoryview(data)
+
+    if start_addr + len(view) > 1 << 32:
+        print("Error: The data doesn't fit below 4 GiB: 0x{:08x} + 0x{:x} bytes.".format(start_addr, len(view)))
+        return 1
+
+    progress = None
+    if not args.quiet:
+        progress = dumpio.Progress(len(view), label="Wrote")
+
+    # Chunks end on chunk-aligned addresses, so only the first and last chunks
+    # can have partial DWORDs.
+    start_ns = time.perf_counter_ns()
+    offset = 0
+    while offset < len(view):
+        chunk_end = min(((start_addr + offset) // PCIE_LOAD_CHUNK_LEN + 1) * PCIE_LOAD_CHUNK_LEN - start_addr, len(view))
+        dev.pcie_mem_write_block(start_addr + offset, view[offset:chunk_end])
+        if progress is not None:
+            progress.update(chunk_end - offset)
+        offset = chunk_end
+    end_ns = time.perf_counter_ns()
+    if progress is not None:
+        progress.finish()
+    elapsed = max(end_ns - start_ns, 1)
+    print("Wrote {} bytes in {:.6f} seconds ({} bytes per second).".format(
+        len(view), elapsed/1e9, int(len(view)*1e9) // elapsed))
+
+    if args.verify == "none" or not view:
+        return 0
+
+    # Posted writes aren't acknowledged, so reading some of the data back is
+    # the only way to know it arrived.
+    if args.verify == "full":
+        samples = [(0, len(view))]
+    else:
+        step = max(len(view) // PCIE_LOAD_SAMPLES, PCIE_LOAD_SAMPLE_LEN)
+        samples = [(offset, min(PCIE_LOAD_SAMPLE_LEN, len(view) - offset)) for offset in range(0, len(view), step)]
+        # Always check the end, where the partial DWORD (if any) is.
+        sampled_end = samples[-1][0] + samples[-1][1]
+        if sampled_end < len(view):
+            last = max(len(view) - PCIE_LOAD_SAMPLE_LEN, sampled_end)
+            samples.append((last, len(view) - last))
+
+    errors = 0
+    checked = 0
+    for offset, length in samples:
+        expected = view[offset:offset+length]
+        actual = dev.pcie_mem_read_block(start_addr + offset, length)
+        checked += length
+        ranges = find_mismatches(expected, actual)
+        if ranges:
+            errors += report_mismatches(ranges, expected, actual, base=start_addr + offset)
+
+    if errors > 0:
+        print("Error: Verification failed with {} errors!".format(errors))
+        return 1
+
+    print("Verified {} of {} bytes.".format(checked, len(view)))
+
+    return 0
+
+def write_poll_stats(path, stats):
+    if path == "-":
+        json.dump(stats.export(), sys.stderr, indent=2)
+        sys.stderr.write("\n")
+    else:
+        with open(path, 'w') as f:
+            json.dump(stats.export(), f, indent=2)
+
+FLEET_COMMANDS = ("info", "dump", "flash_dump", "fw_write", "pcie_cfg_dump", "pcie_scan")
+
+# Sends each thread's output to its own buffer, so the output of devices that
+# are running in parallel doesn't get mixed together.
+class ThreadLocalStdout(io.TextIOBase):
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def capture(self):
+        self._local.buf = io.StringIO()
+        return self._local.buf
+
+    def write(self, s):
+        return getattr(self._local, "buf", self._default).write(s)
+
+    def flush(self):
+        getattr(self._local, "buf", self._default).flush()
+
+def fleet_args(args, label):
+    # Give each device its own output file by adding the device label to the
+    # file name, or by replacing "{device}" in it.
+    dev_args = copy.copy(args)
+    for attr in ("dump_file", "flash_dump_file", "output", "record", "poll_stats"):
+        path = getattr(args, attr, None)
+        if not path or path == "-":
+            continue
+        if "{device}" in path:
+            path = path.replace("{device}", label)
+        else:
+            p = Path(path)
+            path = str(p.with_name("{}-{}{}".format(p.stem, label, p.suffix)))
+        setattr(dev_args, attr, path)
+
+    return dev_args
+
+# Calls "run" with each (label, hub, device) target on up to "jobs" threads at
+# once, with at most "per_hub" of them running behind the same hub, and returns
+# the results in the same order as "targets". Targets are only handed to the
+# pool once their hub has a free slot, so a busy hub doesn't tie up workers
+# that targets on other hubs could use. Targets whose hub isn't known
+# (simulators, replays, and devices that aren't on USB) are only limited by
+# "jobs".
+def run_per_hub(targets, run, jobs, per_hub, cancel_event):
+    results = [None] * len(targets)
+    waiting = list(range(len(targets)))
+    running = {}
+    hub_running = collections.Counter()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        try:
+            while waiting or running:
+                for i in list(waiting):
+                    if len(running) >= jobs:
+                        break
+                    hub = targets[i][1]
+                    if hub != "unknown" and hub_running[hub] >= per_hub:
+                        continue
+                    waiting.remove(i)
+                    hub_running[hub] += 1
+                    running[pool.submit(run, targets[i])] = i
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = running.pop(future)
+                    hub_running[targets[i][1]] -= 1
+                    results[i] = future.result()
+        except KeyboardInterrupt:
+            cancel_event.set()
+            raise
+    return results
+
+def fleet(args):
+    if args.command not in FLEET_COMMANDS:
+        sys.stderr.write("Error: Command \"{}\" is not supported in fleet mode. Supported: {}\n".format(
+            args.command, ", ".join(FLEET_COMMANDS)))
+        return 1
+    if args.command == "fw_write" and args.fw_file == "-":
+        sys.stderr.write("Error: The firmware can't be read from stdin in fleet mode.\n")
+        return 1
+
+    # (label, hub, device path)
+    targets = []
+    if args.device == "auto":
+        for sysfs_path, model, device in find_asm2x6x_devs(not args.no_cache):
+            targets.append((Path(device).name, usb_root_hub(sysfs_path), device))
+    else:
+        for i, device in enumerate(args.device.split(",")):
+            label = Path(device).name
+            hub = "unknown"
+            if device.startswith("sim"):
+                label = "sim{}".format(i)
+            elif not device.startswith("replay"):
+                hub = device_root_hub(device)
+            targets.append((label, hub, device))
+
+    if not targets:
+        sys.stderr.write("Error: No ASM2x6x devices found.\n")
+        return 1
+
+    cancel_event = threading.Event()
+    stdout = ThreadLocalStdout(sys.stdout)
+    sys.stdout = stdout
+
+    def run(target):
+        label, hub, device = target
+        output = stdout.capture()
+        result = {"label": label, "hub": hub, "device": device, "model": "", "ret": None, "error": "", "bytes": 0, "elapsed": 0.0, "poll_stats": None}
+        dev_args = fleet_args(args, label)
+        counter = None
+        poller = None
+        recorders = []
+        start_ns = time.perf_counter_ns()
+        try:
+            dev_wrap, recorders = transport_wrapper(args, device, dev_args.record)
+            wrap = lambda inner: transport.CountingTransport(dev_wrap(inner))
+            dev = get_asm2x6x_dev(device, args.queue_depth, wrap=wrap, use_cache=not args.no_cache and not args.record)
+            counter = dev._transport
+            result["model"] = type(dev).__name__
+            if args.shadow_regs:
+                dev.enable_shadow()
+            dev.poller = poller = Poller(PollPolicy(timeout=args.poll_timeout, spin=args.poll_spin), cancel_event)
+            result["ret"] = args.func(dev_args, dev)
+        except Exception as e:
+            result["ret"] = 1
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+        finally:
+            result["elapsed"] = (time.perf_counter_ns() - start_ns) / 1e9
+            if counter is not None:
+                result["bytes"] = counter.bytes_in + counter.bytes_out
+                counter.close()
+            elif recorders:
+                recorders[0].writer.close()
+            if args.poll_stats and poller is not None:
+                # Standard error gets every device's statistics at the end.
+                if dev_args.poll_stats == "-":
+                    result["poll_stats"] = poller.stats.export()
+                else:
+                    write_poll_stats(dev_args.poll_stats, poller.stats)
+        result["output"] = output.getvalue()
+        return result
+
+    try:
+        results = run_per_hub(targets, run, args.jobs, args.per_hub, cancel_event)
+    finally:
+        sys.stdout = stdout._default
+
+    if args.poll_stats == "-":
+        json.dump({result["label"]: result["poll_stats"] for result in results if result["poll_stats"] is not None}, sys.stderr, indent=2)
+        sys.stderr.write("\n")
+
+    for result in results:
+        print("==> {} ({}) <==".format(result["label"], result["device"]))
+        sys.stdout.write(result["output"])
+        if result["error"]:
+            print("Error: {}".format(result["error"]))
+        print()
+
+    print("{:<10} {:<8} {:<10} {:<6} {:>12} {:>10} {:>14}".format("Device", "Hub", "Model", "Status", "Bytes", "Seconds", "Bytes/second"))
+    failed = 0
+    for result in results:
+        ok = result["ret"] == 0
+        failed += int(not ok)
+        throughput = int(result["bytes"] / result["elapsed"]) if result["elapsed"] else 0
+        print("{:<10} {:<8} {:<10} {:<6} {:>12} {:>10.3f} {:>14}".format(
+            result["label"], result["hub"], result["model"], "OK" if ok else "FAIL",
+            result["bytes"], result["elapsed"], throughput))
+
+    return 1 if failed else 0
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("-d", "--device", default="auto", help="The path to the ASM2x6x SCSI/SG_IO device. Default: auto")
+    parser.add_argument("--queue-depth", type=int, default=8, help="The maximum number of SCSI commands to keep in flight at once. Min: 1, Max: 16, Default: 8")
+    parser.add_argument("--shadow-regs", action='store_true', default=False, help="Skip register writes that wouldn't change a register's last written value. Default: False")
+    parser.add_argument("--poll-timeout", type=float, default=5.0, help="The number of seconds to wait for the hardware before giving up. Default: 5.0")
+    parser.add_argument("--poll-spin", type=int, default=16, help="The number of back-to-back status polls to send before sleeping between them. Default: 16")
+    parser.add_argument("--poll-stats", type=str, default=None, help="The file to write per-site polling statistics to, in JSON format (\"-\" for standard error). In fleet mode, each device gets its own file, like the output files, and standard error gets one object with every device's statistics. Default: None")
+    parser.add_argument("--trace", type=str, default=None, help="The file to write a trace of every SCSI command to, in the Chrome trace event format (for Perfetto or chrome://tracing). Default: None")
+    parser.add_argument("--profile", action='store_true', default=False, help="Print per-opcode and per-operation SCSI command latency histograms to standard error when done. Default: False")
+    parser.add_argument("--record", type=str, default=None, help="The file to record every SCSI command and response to, for replaying with \"-d replay:<file>\". Default: None")
+    parser.add_argument("--fleet", action='store_true', default=False, help="Run the command on every detected ASM2x6x device (or on each device in a comma-separated \"-d\" list) in parallel. Default: False")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="The maximum number of devices to operate on at once in fleet mode. Default: 4")
+    parser.add_argument("--per-hub", type=int, default=2, help="The maximum number of devices behind the same USB root hub to operate on at once in fleet mode. Devices whose root hub can't be found are only limited by \"--jobs\". Default: 2")
+    parser.add_argument("--no-cache", action='store_true', default=False, help="Rescan for devices instead of using the cached results of the last scan. Default: False")
+    parser.add_argument("-d", "--device", default="auto", help="The path to the ASM2x6x SCSI/SG_IO device, \"sim[:<chip>]\" to use the simulator, or \"replay:<file>\" (or \"replay-realtime:<file>\") to play back a recording. Default: auto")
 
     subparsers = parser.add_subparsers(dest="command", required=True, help="Subcommands.")
 
     parser_dump = subparsers.add_parser("dump")
+    parser_dump.add_argument("-q", "--quiet", action='store_true', default=False, help="Don't report progress while reading. Default: False")
+    parser_dump.add_argument("--resume", action='store_true', default=False, help="Continue an interrupted dump from its journal instead of starting over. Default: False")
+    parser_dump.add_argument("--retries", type=int, default=3, help="The number of times to retry a failed chunk before giving up. Default: 3")
+    parser_dump.add_argument("-m", "--map", type=str, default=None, help="Dump using a memory map: the name of a chip with a built-in map (e.g. ASM2364) or a JSON file from \"memmap\". Zero-filled regions are synthesized, mirrors are read once and copied, and MMIO is skipped. Default: None")
+    parser_dump.add_argument("--read-mmio", action='store_true', default=False, help="With \"--map\", read MMIO regions instead of skipping them. Default: False")
     parser_dump.add_argument("dump_file", help="The file to write the memory dump output to.")
     parser_dump.set_defaults(func=dump)
 
     parser_flash_dump = subparsers.add_parser("flash_dump")
     parser_flash_dump.add_argument("-l", "--length", type=int, default=512*1024, help="The total number of bytes to read from flash. Default: 524288")
+    parser_flash_dump.add_argument("-q", "--quiet", action='store_true', default=False, help="Don't report progress while reading. Default: False")
+    parser_flash_dump.add_argument("-c", "--chunk-size", type=int, default=0, help="Read the flash in chunks of this many bytes through the flash controller, which allows failed chunks to be retried and interrupted dumps to be resumed. Default: 0 (read the whole flash with one command, or 4096 with \"--resume\")")
+    parser_flash_dump.add_argument("--resume", action='store_true', default=False, help="Continue an interrupted dump from its journal instead of starting over. Default: False")
+    parser_flash_dump.add_argument("--retries", type=int, default=3, help="The number of times to retry a failed chunk before giving up. Default: 3")
+    parser_flash_dump.add_argument("-m", "--manifest", type=str, default=None, help="The file to write a per-block hash manifest of the dump to, for use with \"flash_update\". Default: None")
     parser_flash_dump.add_argument("flash_dump_file", help="The file to write the flash dump output to.")
     parser_flash_dump.set_defaults(func=flash_dump)
 
+    parser_flash_update = subparsers.add_parser("flash_update")
+    parser_flash_update.add_argument("-p", "--previous-manifest", type=str, default=None, help="The per-block hash manifest of the previous image. Default: computed from the previous image")
+    parser_flash_update.add_argument("-b", "--block-size", type=int, default=4096, help="The block size to use when computing a manifest for the previous image. Default: 4096")
+    parser_flash_update.add_argument("-s", "--stride", type=int, default=128, help="The number of bytes to read from flash with each internal flash command when only some blocks are read with \"--fast\". Min: 1, Max: 4096, Default: 128")
+    parser_flash_update.add_argument("--fast", action='store_true', default=False, help="If the firmware fingerprint is unchanged, only read the blocks holding the config and the firmware header and trailer, and leave the other blocks unchecked. Default: False")
+    parser_flash_update.add_argument("-o", "--output", type=str, default=None, help="The file to write the updated image to. Default: None")
+    parser_flash_update.add_argument("-d", "--delta", type=str, default=None, help="The file to write the changed blocks to. Default: None")
+    parser_flash_update.add_argument("-m", "--manifest", type=str, default=None, help="The file to write the updated manifest to. Default: None")
+    parser_flash_update.add_argument("previous", help="The previous flash dump of this device.")
+    parser_flash_update.set_defaults(func=flash_update)
+
     parser_fw_write = subparsers.add_parser("fw_write")
     parser_fw_write.add_argument("-r", "--raw", action='store_true', default=False, help="Write raw flash data, not a parsed firmware image. Default: False")
-    parser_fw_write.add_argument("fw_file", help="The firmware file to write to flash.")
+    parser_fw_write.add_argument("-f", "--force", action='store_true', default=False, help="Write the firmware even if the flash already contains it. Default: False")
+    parser_fw_write.add_argument("-c", "--check", type=str, choices=("sample", "full"), default="sample", help="How to confirm that the flash already contains the firmware once its header and trailer match: compare samples of it, or read all of it. Default: sample")
+    parser_fw_write.add_argument("fw_file", help="The firmware file to write to flash, or \"-\" to read it from stdin.")
     parser_fw_write.set_defaults(func=fw_write)
 
     parser_info = subparsers.add_parser("info")
@@ -791,6 +2100,17 @@ def main():
     parser_memtest.add_argument("length", type=int, default=1, help="The total number of bytes to test. Default: 1")
     parser_memtest.set_defaults(func=memtest)
 
+    parser_memmap = subparsers.add_parser("memmap")
+    parser_memmap.add_argument("-p", "--page-size", type=int, default=256, help="The size of the pages to classify, in bytes. Default: 256")
+    parser_memmap.add_argument("-s", "--size", type=lambda x: int(x, 0), default=None, help="The size of the XDATA space to probe. Default: the size of the chip's XDATA space")
+    parser_memmap.add_argument("--probe-offset", type=lambda x: int(x, 0), default=None, help="The offset in each page to write the two-byte signature to. Default: the last two bytes of the page")
+    parser_memmap.add_argument("-x", "--exclude", type=parse_range, action='append', default=[], help="A range of addresses to never write to, as \"<start>-<end>\" in hexadecimal. Can be given more than once. Default: None")
+    parser_memmap.add_argument("--write-known", action='store_true', default=False, help="Also write to the RAM and MMIO regions of the chip's built-in memory map, which hold the running firmware's variables and hardware registers. This can crash the firmware or trigger hardware side effects. Default: False (those regions are only read)")
+    parser_memmap.add_argument("-r", "--read-only", action='store_true', default=False, help="Only read from XDATA, so RAM and read-only memory can't be told apart. Default: False")
+    parser_memmap.add_argument("-c", "--chip", type=str, default=None, help="The chip name to record in the memory map. If it has a built-in map, that map's RAM and MMIO regions are only read. Default: the device class name, with the ASM2364 map for ASM236x devices")
+    parser_memmap.add_argument("-o", "--output", type=str, default=None, help="The file to write the memory map to, as JSON. Default: None")
+    parser_memmap.set_defaults(func=memmap)
+
     parser_flash_read = subparsers.add_parser("flash_read")
     parser_flash_read.add_argument("-s", "--stride", type=int, default=128, help="The number of bytes to read from flash with each internal flash command. Min: 1, Max: 4096, Default: 128")
     parser_flash_read.add_argument("-l", "--length", type=int, default=1, help="The total number of bytes to read from flash. Default: 1")
@@ -798,30 +2118,99 @@ def main():
     parser_flash_read.set_defaults(func=flash_read)
 
     parser_pcie_cfg_dump = subparsers.add_parser("pcie_cfg_dump")
-    parser_pcie_cfg_dump.add_argument("-s", "--bdf", type=str, default="00:00.0", help="The PCI address to dump the config space of. Default: 00:00.0")
+    parser_pcie_cfg_dump.add_argument("-s", "--bdf", type=str, default="00:00.0", help="The PCI address to dump the config space of, or the name or vendor:device IDs of a function found by \"pcie_scan\". Default: 00:00.0")
     parser_pcie_cfg_dump.add_argument("-o", "--output", type=str, default="", help="The file to write the PCI config space dump output to. Default: standard output")
     parser_pcie_cfg_dump.set_defaults(func=pcie_cfg_dump)
 
     parser_pcie_mem_dump = subparsers.add_parser("pcie_mem_dump")
+    parser_pcie_mem_dump.add_argument("-q", "--quiet", action='store_true', default=False, help="Don't report progress while reading. Default: False")
+    parser_pcie_mem_dump.add_argument("--resume", action='store_true', default=False, help="Continue an interrupted dump from its journal instead of starting over. Default: False")
+    parser_pcie_mem_dump.add_argument("--retries", type=int, default=3, help="The number of times to retry a failed chunk before giving up. Default: 3")
     parser_pcie_mem_dump.add_argument("address", type=str, help="The address to start the read from, in hexadecimal.")
     parser_pcie_mem_dump.add_argument("length", type=str, help="The number of bytes to read, in decimal (prefix with \"0x\" for hexadecimal).")
     parser_pcie_mem_dump.add_argument("pcie_mem_dump_file", help="The file to write the dump output to.")
     parser_pcie_mem_dump.set_defaults(func=pcie_mem_dump)
 
+    parser_pcie_mem_load = subparsers.add_parser("pcie_mem_load")
+    parser_pcie_mem_load.add_argument("-q", "--quiet", action='store_true', default=False, help="Don't report progress while writing. Default: False")
+    parser_pcie_mem_load.add_argument("-c", "--verify", type=str, choices=("none", "sample", "full"), default="sample", help="How to check the data after writing it: not at all, by reading back evenly-spaced samples of it, or by reading all of it back. Default: sample")
+    parser_pcie_mem_load.add_argument("address", type=str, help="The address to start the write to, in hexadecimal.")
+    parser_pcie_mem_load.add_argument("pcie_mem_load_file", help="The file to write to PCIe memory, or \"-\" to read it from standard input.")
+    parser_pcie_mem_load.set_defaults(func=pcie_mem_load)
+
+    parser_pcie_scan = subparsers.add_parser("pcie_scan")
+    parser_pcie_scan.add_argument("-c", "--capabilities", action='store_true', default=False, help="Walk the whole capability and extended capability lists of each function, instead of stopping at the PCI Express capability. Default: False")
+    parser_pcie_scan.add_argument("-C", "--cached", action='store_true', default=False, help="Print the topology cached by the last scan of this bridge instead of scanning again. Default: False")
+    parser_pcie_scan.set_defaults(func=pcie_scan)
+
     parser_pcie = subparsers.add_parser("pcie")
-    parser_pcie.add_argument("-s", "--bdf", type=str, default=None, help="The PCI address to send the Configuration Request to. Default: None (send Memory Request)")
+    parser_pcie.add_argument("-s", "--bdf", type=str, default=None, help="The PCI address to send the Configuration Request to, or the name or vendor:device IDs of a function found by \"pcie_scan\". Default: None (send Memory Request)")
     parser_pcie.add_argument("-v", "--value", type=str, default=None, help="The value to write. Default: None (Read)")
-    parser_pcie.add_argument("address", type=str, help="The address to read from or write to, in hexadecimal. To specify the width of the data to read/write, append \".B\" (1 byte), \".W\" (2 bytes), and \".L\" (4 bytes) to the address. The default width is 4 and the specifiers are case-insensitive.")
+    parser_pcie.add_argument("-m", "--mask", type=str, default=None, help="Only change the bits of the config register that are set in this mask, in hexadecimal, by reading the register and writing it back. Default: None (write the whole register)")
+    parser_pcie.add_argument("address", type=str, nargs="+", help="The address to read from or write to, in hexadecimal. To specify the width of the data to read/write, append \".B\" (1 byte), \".W\" (2 bytes), and \".L\" (4 bytes) to the address. The default width is 4 and the specifiers are case-insensitive. Several addresses can be given to read them all.")
     parser_pcie.set_defaults(func=pcie)
 
     args = parser.parse_args()
 
-    dev = get_asm2x6x_dev(args.device)
+    args.tracer = None
+    if args.trace or args.profile:
+        args.tracer = scsi_trace.Tracer(cdb_address, keep_records=bool(args.trace))
+        args.tracer.install()
+
+    if args.record:
+        import scsi_record
+        scsi_record.exit_on_signals()
+
+    try:
+        if args.fleet:
+            return fleet(args)
+        return run_command(args)
+    finally:
+        if args.tracer is not None:
+            args.tracer.uninstall()
+            if args.profile:
+                args.tracer.write_summary(sys.stderr)
+            if args.trace:
+                args.tracer.write_chrome_trace(args.trace)
+
+# Returns a function that wraps a device's transport in a recorder (if
+# "record_path" is set) and then a tracer (if tracing is on), along with a list
+# that the recorder is added to once it's created, so it can be closed.
+def transport_wrapper(args, device, record_path):
+    recorders = []
+    def wrap(inner):
+        if record_path:
+            import scsi_record
+            metadata = {"tool": "asm2x6x_tool", "device": device, "argv": sys.argv[1:], "time": time.time()}
+            inner = scsi_record.RecordingTransport(inner, record_path, metadata)
+            recorders.append(inner)
+        if args.tracer is not None:
+            inner = scsi_trace.TracingTransport(inner, args.tracer)
+        return inner
+    return wrap, recorders
+
+def run_command(args):
+    wrap, recorders = transport_wrapper(args, args.device, args.record)
+
+    # Recordings always start by probing the chip, instead of depending on the
+    # discovery cache, so they can be replayed without it.
+    dev = get_asm2x6x_dev(args.device, args.queue_depth, wrap=wrap, use_cache=not args.no_cache and not args.record)
     if not dev:
         sys.stderr.write("Error: Failed to auto-detect an ASM2x6x device. Please specify it manually using the \"-d\" flag.\n")
         return 1
 
-    return args.func(args, dev)
+    if args.shadow_regs:
+        dev.enable_shadow()
+
+    dev.poller.policy = PollPolicy(timeout=args.poll_timeout, spin=args.poll_spin)
+
+    try:
+        return args.func(args, dev)
+    finally:
+        if args.poll_stats:
+            write_poll_stats(args.poll_stats, dev.poller.stats)
+        for recorder in recorders:
+            recorder.writer.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,232 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# dumpio.py - Streaming output for memory and flash dumps.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import json
+import mmap
+import os
+import sys
+import time
+
+
+BLOCK_SIZE = 4096
+ZERO_BLOCK = bytes(BLOCK_SIZE)
+
+
+class Progress:
+    def __init__(self, total, label="Read", stream=sys.stderr, interval=0.5):
+        self.total = total
+        self.done = 0
+        self._label = label
+        self._stream = stream
+        self._interval_ns = int(interval * 1e9)
+        self._start_ns = time.perf_counter_ns()
+        self._last_ns = self._start_ns
+        self._shown_done = None
+
+    def update(self, count):
+        self.done += count
+        now_ns = time.perf_counter_ns()
+        if now_ns - self._last_ns >= self._interval_ns:
+            self._last_ns = now_ns
+            self._show(now_ns)
+
+    def _show(self, now_ns):
+        elapsed = max(now_ns - self._start_ns, 1)
+        percent = 100 * self.done // self.total if self.total else 100
+        self._stream.write("\r{} {}/{} bytes ({}%), {} bytes per second.".format(
+            self._label, self.done, self.total, percent, int(self.done*1e9) // elapsed))
+        self._stream.flush()
+        self._shown_done = self.done
+
+    def finish(self):
+        if self._shown_done is not None:
+            if self._shown_done != self.done:
+                self._show(time.perf_counter_ns())
+            self._stream.write("\n")
+            self._stream.flush()
+
+# Writes a dump of a known length to a file as the data arrives. The file is
+# extended to its full length up front, and blocks that are all zeros are
+# skipped so they stay holes in the (sparse) file. When resuming, the file
+# already holds data, so every block is written, zeros included: a skipped block
+# would leave whatever was there before. Only pass "resume" when the journal was
+# actually resumed ("Journal.resumed"), so a fresh dump always starts from an
+# empty file.
+class DumpWriter:
+    def __init__(self, path, length, progress=True, label="Read", resume=False):
+        self.path = path
+        self.length = length
+        self._sparse = not resume
+        flags = os.O_RDWR | os.O_CREAT
+        if not resume:
+            flags |= os.O_TRUNC
+        self._fd = os.open(path, flags, 0o666)
+        os.ftruncate(self._fd, length)
+        self._pos = 0
+        self._mmap = None
+        self.progress = Progress(length, label) if progress else None
+
+    def write_at(self, offset, data):
+        view = memoryview(data).cast('B')
+        end = len(view)
+        i = 0
+        while i < end:
+            # Align the blocks to the file offset, not the start of the data.
+            block_len = min(BLOCK_SIZE - ((offset + i) % BLOCK_SIZE), end - i)
+            block = view[i:i+block_len]
+            if not self._sparse:
+                os.pwrite(self._fd, view[i:], offset + i)
+                block_len = end - i
+            elif block != ZERO_BLOCK[:block_len]:
+                # Coalesce this block with any non-zero blocks after it.
+                j = i + block_len
+                while j < end:
+                    next_len = min(BLOCK_SIZE, end - j)
+                    if view[j:j+next_len] == ZERO_BLOCK[:next_len]:
+                        break
+                    j += next_len
+                os.pwrite(self._fd, view[i:j], offset + i)
+                block_len = j - i
+            i += block_len
+
+        if self.progress is not None:
+            self.progress.update(end)
+
+    # File-like sequential write.
+    def write(self, data):
+        self.write_at(self._pos, data)
+        self._pos += len(data)
+        return len(data)
+
+    # Returns a writable view of part of the file, so a single large transfer
+    # can be received directly into the page cache instead of a separate
+    # buffer. Blocks written through the view are not kept sparse.
+    def map(self, offset, length):
+        if self._mmap is None:
+            self._mmap = mmap.mmap(self._fd, self.length)
+        return memoryview(self._mmap)[offset:offset+length]
+
+    def read_at(self, offset, length):
+        return os.pread(self._fd, length, offset)
+
+    def mapped(self, count):
+        if self.progress is not None:
+            self.progress.update(count)
+
+    def close(self):
+        if self.progress is not None:
+            self.progress.finish()
+        if self._mmap is not None:
+            self._mmap.flush()
+            self._mmap.close()
+            self._mmap = None
+        os.close(self._fd)
+
+class JournalMismatchError(Exception):
+    pass
+
+# Records which chunks of a partial dump file are complete, so an interrupted
+# dump can be resumed. The journal is a JSON-lines file next to the dump: a
+# header describing the dump, then the offset of each completed chunk.
+class Journal:
+    def __init__(self, dump_path, params, resume=False):
+        self.path = dump_path + ".journal"
+        self.done = set()
+        # Whether an existing journal was picked up. If not, the dump starts
+        # over, whatever "resume" was.
+        self.resumed = False
+
+        if resume and os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                lines = f.read().splitlines()
+            header = json.loads(lines[0]) if lines else None
+            if header != params:
+                raise JournalMismatchError("Journal \"{}\" was written for a different dump: {}".format(self.path, header))
+            for line in lines[1:]:
+                try:
+                    self.done.add(json.loads(line)["done"])
+                except ValueError:
+                    # A line cut short by the interruption.
+                    break
+            self.resumed = True
+            self._file = open(self.path, 'a')
+        else:
+            self._file = open(self.path, 'w')
+            self._file.write(json.dumps(params) + "\n")
+            self._file.flush()
+
+    def mark_done(self, offset):
+        self.done.add(offset)
+        self._file.write(json.dumps({"done": offset}) + "\n")
+        self._file.flush()
+
+    def complete(self):
+        self._file.close()
+        os.unlink(self.path)
+
+    def close(self):
+        self._file.close()
+
+# Reads "length" bytes in chunks of "chunk_len" bytes with
+# "read_chunk(offset, view, stride)" and writes them with "writer", skipping
+# chunks that the journal says are already done. A chunk that fails is retried
+# up to "retries" times, halving the stride each time. If "ranges" is a list of
+# (start, length) tuples, only those ranges are read. Returns the number of
+# bytes read.
+def read_chunks(writer, journal, length, chunk_len, stride, read_chunk, retries=3, log=sys.stderr, ranges=None):
+    if ranges is None:
+        ranges = [(0, length)]
+
+    chunks = []
+    for start, range_len in ranges:
+        for offset in range(start, start + range_len, chunk_len):
+            chunks.append((offset, min(chunk_len, start + range_len - offset)))
+
+    buf = bytearray(max((chunk[1] for chunk in chunks), default=0))
+    read_count = 0
+
+    if writer.progress is not None:
+        writer.progress.done = sum(size for offset, size in chunks if offset in journal.done)
+
+    for offset, size in chunks:
+        if offset in journal.done:
+            continue
+
+        view = memoryview(buf)[:size]
+        chunk_stride = stride
+        attempt = 0
+        while True:
+            try:
+                read_chunk(offset, view, chunk_stride)
+                break
+            except KeyboardInterrupt:
+                raise
+            except Exception as e:
+                attempt += 1
+                if attempt > retries:
+                    raise
+                chunk_stride = max(1, chunk_stride // 2)
+                log.write("Warning: Chunk at offset 0x{:x} failed ({}: {}), retrying with stride {} ({}/{})...\n".format(
+                    offset, type(e).__name__, e, chunk_stride, attempt, retries))
+
+        writer.write_at(offset, view)
+        journal.mark_done(offset)
+        read_count += len(view)
+
+    return read_count
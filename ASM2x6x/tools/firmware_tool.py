@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-# firmware_tool.py - A tool to parse ASM236x firmware image files.
-# Copyright (C) 2022-2023  Forest Crossman <cyrozap@gmail.com>
+# firmware_tool.py - A tool to parse and index ASM2x6x firmware image files.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
 #
 # This program is free software: you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -19,13 +19,16 @@
 
 
 import argparse
+import hashlib
+import io
+import json
+import os
+import struct
 import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
 
-try:
-    import asm236x_fw
-except ModuleNotFoundError:
-    sys.stderr.write("Error: Failed to import \"asm236x_fw.py\". Please run \"make\" in this directory to generate that file, then try running this script again.\n")
-    sys.exit(1)
+import fw_image
 
 
 IDLE_TIMER_STRINGS = {
@@ -55,73 +58,78 @@ PCIE_LANES = {
     2: "4",
 }
 
-EXPECTED_HEADER_MAGIC = 0x5a
+# Version 1 indexes may hold summaries from before the string keys and the
+# missing-version handling were settled, so they're rebuilt from scratch.
+INDEX_VERSION = 2
 
-BODY_MAGICS = {
-    0x4b: "ASM2364",
-    0x5a: "ASM2362",
-}
+# Files bigger than this are too big to be firmware images, so "scan" doesn't
+# read them (unless they're zip archives).
+MAX_IMAGE_SIZE = 0x100000
 
 
 def fw_version_bytes_to_string(version):
     return "{:02X}{:02X}{:02X}_{:02X}_{:02X}_{:02X}".format(*version)
 
-def extract(filename=None, fw=None, **kwargs):
+def extract(filename=None, image=None, **kwargs):
     split = filename.split('.')
     basename = '.'.join(split[:-1])
     dest_name = "{}.code.bin".format(basename)
 
-    print("Extracting {} bytes of firmware code from \"{}\" and writing it to \"{}\"...".format(fw.body.size, filename, dest_name))
+    print("Extracting {} bytes of firmware code from \"{}\" and writing it to \"{}\"...".format(image.body.size, filename, dest_name))
 
     f = open(dest_name, "wb")
-    f.write(fw.body.firmware.code)
+    f.write(image.body.code)
     f.close()
 
     print("Done!")
 
     return 0
 
-def info(filename=None, fw=None, fw_bin=None, **kwargs):
-    version_string = fw_version_bytes_to_string(fw.body.firmware.version)
+def info(filename=None, image=None, **kwargs):
+    config = image.config
+    body = image.body
+
+    version = body.version
+    version_string = fw_version_bytes_to_string(version) if version is not None else "Unknown (the firmware is too small to have one)"
     print("Firmware version: {}".format(version_string))
 
-    usb_info = fw.header.usb_info
-    print("USB IDs: {:04x}:{:04x}".format(usb_info.id_vendor, usb_info.id_product))
-    print("USB Device Revision: {:04x}".format(usb_info.bcd_device))
-    print("EP0 Manufacturer String: {}".format(fw.header.ep0_manufacturer_string))
-    print("EP0 Product String: {}".format(fw.header.ep0_product_string))
-    print("T10 Manufacturer String: {}".format(fw.header.t10_manufacturer_string))
-    print("T10 Product String: {}".format(fw.header.t10_product_string))
-    print("Serial number: {}".format(fw.header.serial_number))
-    print("Idle timer: {}".format(IDLE_TIMER_STRINGS.get(fw.header.idle_timer, "Unknown value: 0x{:x}".format(fw.header.idle_timer))))
-    print("PCIe Lanes: {}".format(PCIE_LANES.get(fw.header.pcie_lane.value, "Default (varies by chip and firmware version)")))
-    print("PCIe Speed: Gen {} ({} GT/s)".format(*PCIE_SPEEDS.get(fw.header.pcie_speed.value, (3, "8"))))
+    print("USB IDs: {:04x}:{:04x}".format(config.get("id_vendor"), config.get("id_product")))
+    print("USB Device Revision: {:04x}".format(config.get("bcd_device")))
+    print("EP0 Manufacturer String: {}".format(config.get("ep0_manufacturer_string")))
+    print("EP0 Product String: {}".format(config.get("ep0_product_string")))
+    print("T10 Manufacturer String: {}".format(config.get("t10_manufacturer_string")))
+    print("T10 Product String: {}".format(config.get("t10_product_string")))
+    print("Serial number: {}".format(config.get("serial_number")))
+    idle_timer = config.get("idle_timer")
+    print("Idle timer: {}".format(IDLE_TIMER_STRINGS.get(idle_timer, "Unknown value: 0x{:x}".format(idle_timer))))
+    print("PCIe Lanes: {}".format(PCIE_LANES.get(config.get("pcie_lane"), "Default (varies by chip and firmware version)")))
+    print("PCIe Speed: Gen {} ({} GT/s)".format(*PCIE_SPEEDS.get(config.get("pcie_speed"), (3, "8"))))
 
     header_magic_messages = {
-        True: "OK (0x{:02x})".format(fw.header.magic),
-        False: "ERROR: Expected 0x{:02x}, got 0x{:02x}.".format(EXPECTED_HEADER_MAGIC, fw.header.magic),
+        True: "OK (0x{:02x})".format(config.magic),
+        False: "ERROR: Expected 0x{:02x}, got 0x{:02x}.".format(fw_image.CONFIG_MAGIC, config.magic),
     }
-    print("Header magic: {}".format(header_magic_messages[fw.header.magic == EXPECTED_HEADER_MAGIC]))
+    print("Header magic: {}".format(header_magic_messages[config.magic == fw_image.CONFIG_MAGIC]))
 
-    calculated_csum = sum(fw_bin[0x04:0x7f]) & 0xff
-    expected_csum = fw.header.checksum
+    calculated_csum = config.calculated_checksum()
+    expected_csum = config.checksum
     header_checksum_messages = {
         True: "OK (0x{:02x})".format(calculated_csum),
         False: "ERROR: Expected 0x{:02x}, calculated: 0x{:02x}.".format(expected_csum, calculated_csum),
     }
     print("Header checksum: {}".format(header_checksum_messages[expected_csum == calculated_csum]))
 
-    print("Image size: {} bytes".format(fw.body.size))
+    print("Image size: {} bytes".format(body.size))
 
-    formatted_magics = "[{}]".format(", ".join("0x{:02x}".format(x) for x in BODY_MAGICS.keys()))
+    formatted_magics = "[{}]".format(", ".join("0x{:02x}".format(x) for x in fw_image.BODY_MAGICS.keys()))
     image_magic_messages = {
-        True: "OK (0x{:02x}: {})".format(fw.body.magic, BODY_MAGICS.get(fw.body.magic, "Unknown")),
-        False: "ERROR: Expected one of {}, got 0x{:02x}.".format(formatted_magics, fw.body.magic),
+        True: "OK (0x{:02x}: {})".format(body.magic, fw_image.BODY_MAGICS.get(body.magic, "Unknown")),
+        False: "ERROR: Expected one of {}, got 0x{:02x}.".format(formatted_magics, body.magic),
     }
-    print("Image magic: {}".format(image_magic_messages[fw.body.magic in BODY_MAGICS.keys()]))
+    print("Image magic: {}".format(image_magic_messages[body.magic in fw_image.BODY_MAGICS.keys()]))
 
-    calculated_csum = sum(fw.body.firmware.code) & 0xff
-    expected_csum = fw.body.checksum
+    calculated_csum = body.calculated_checksum()
+    expected_csum = body.checksum
     firmware_checksum_messages = {
         True: "OK (0x{:02x})".format(calculated_csum),
         False: "ERROR: Expected 0x{:02x}, calculated: 0x{:02x}.".format(expected_csum, calculated_csum),
@@ -141,6 +149,279 @@ def unsupported(command=None, fw_type=None, **kwargs):
 
     return 1
 
+def guess_type(fw_bin):
+    threshold = 3
+    points = 0
+
+    # Is the serial number string present?
+    try:
+        bytes.fromhex(fw_bin[4:4+12].decode('ascii'))
+        points += 1
+    except Exception:
+        pass
+
+    # Is "ASMT" present?
+    try:
+        if fw_bin[0x3c:0x3c+4].decode('ascii') == "ASMT":
+            points += 1
+    except Exception:
+        pass
+
+    # Is the magic value present?
+    try:
+        if fw_bin[0x7e] == 0x5a:
+            points += 1
+    except Exception:
+        pass
+
+    # Are the exception vector long jump instructions all present?
+    try:
+        vector_offsets = (0x82, 0x85, 0x8d, 0x95)
+        vectors_present = 0
+        for offset in vector_offsets:
+            vectors_present += 1
+        if vectors_present == len(vector_offsets):
+            points += 1
+    except Exception:
+        pass
+
+    if points >= threshold:
+        return "image"
+    return "raw"
+
+# The type of firmware image in "fw_bin" for "scan", or None if it doesn't look
+# like one. An ASM2464 image is only a length and a magic byte around the body,
+# which plenty of unrelated files match by chance, so its checksum or CRC has to
+# be valid too. One of them is allowed to be wrong, so corrupted images are
+# still indexed (and reported as bad).
+def scan_type(fw_bin):
+    if len(fw_bin) >= 10:
+        body_len = struct.unpack_from('<I', fw_bin, 0)[0]
+        if 0 < body_len and 4 + body_len + 6 <= len(fw_bin) and fw_bin[4 + body_len] == fw_image.ASM2464_MAGIC:
+            image = fw_image.Asm2464Image(fw_bin)
+            if image.checksum_ok() or image.crc_ok():
+                return "asm2464"
+
+    if len(fw_bin) >= 0x84 and guess_type(fw_bin) == "image":
+        code_size = struct.unpack_from('<H', fw_bin, 0x80)[0]
+        if 0x82 + code_size + 2 <= len(fw_bin):
+            return "asm236x"
+
+    return None
+
+def asm236x_summary(image):
+    config = image.config
+    body = image.body
+    version = body.version
+    return {
+        "type": "asm236x",
+        "chip": fw_image.BODY_MAGICS.get(body.magic),
+        "version": fw_version_bytes_to_string(version) if version is not None else None,
+        "usb_ids": "{:04x}:{:04x}".format(config.get("id_vendor"), config.get("id_product")),
+        "usb_device_revision": "{:04x}".format(config.get("bcd_device")),
+        "strings": {
+            "serial_number": config.get("serial_number"),
+            "ep0_manufacturer": config.get("ep0_manufacturer_string"),
+            "ep0_product": config.get("ep0_product_string"),
+            "t10_manufacturer": config.get("t10_manufacturer_string"),
+            "t10_product": config.get("t10_product_string"),
+        },
+        "pcie_lane": fw_image.PCIE_LANE_NAMES[config.get("pcie_lane")],
+        "pcie_speed": fw_image.PCIE_SPEED_NAMES[config.get("pcie_speed")],
+        "size": body.size,
+        "header_magic_ok": config.magic == fw_image.CONFIG_MAGIC,
+        "header_checksum_ok": config.checksum_ok(),
+        "image_magic": body.magic,
+        "image_checksum_ok": body.checksum_ok(),
+    }
+
+def asm2464_summary(image):
+    return {
+        "type": "asm2464",
+        "chip": "ASM2464",
+        "size": image.body_len,
+        "image_magic": image.magic,
+        "image_checksum_ok": image.checksum_ok(),
+        "image_crc_ok": image.crc_ok(),
+    }
+
+# The hashes of the images that are already in the index, so the scan workers
+# don't parse them again.
+_known_hashes = frozenset()
+
+def _init_scan_worker(known_hashes):
+    global _known_hashes
+    _known_hashes = known_hashes
+
+# Returns (sha256, summary) for a firmware image, where "summary" is None if the
+# image is already in the index, or (None, None) if "fw_bin" isn't an image.
+def index_image(fw_bin):
+    kind = scan_type(fw_bin)
+    if kind is None:
+        return (None, None)
+
+    digest = hashlib.sha256(fw_bin).hexdigest()
+    if digest in _known_hashes:
+        return (digest, None)
+
+    try:
+        if kind == "asm2464":
+            summary = asm2464_summary(fw_image.Asm2464Image(fw_bin))
+        else:
+            summary = asm236x_summary(fw_image.Asm236xImage(fw_bin))
+    except Exception as e:
+        summary = {"type": kind, "error": "{}: {}".format(type(e).__name__, e)}
+
+    return (digest, summary)
+
+def _index_zip(zf, prefix, entries):
+    for info in zf.infolist():
+        if info.is_dir():
+            continue
+        member = prefix + info.filename
+        try:
+            if info.filename.lower().endswith(".zip"):
+                with zipfile.ZipFile(io.BytesIO(zf.read(info))) as inner:
+                    _index_zip(inner, member + "/", entries)
+            elif info.file_size <= MAX_IMAGE_SIZE:
+                digest, summary = index_image(zf.read(info))
+                if digest is not None:
+                    entries.append((member, digest, summary))
+        except (zipfile.BadZipFile, RuntimeError, NotImplementedError) as e:
+            # Encrypted members, unsupported compression methods, and so on.
+            entries.append((member, None, {"error": "{}: {}".format(type(e).__name__, e)}))
+
+# Runs in a worker process. Returns (entries, error), where "entries" is a list
+# of (member, sha256, summary) tuples for the images in a file or zip archive,
+# where "member" is the path of the image inside the archive, or None if the
+# file itself is the image. If the file can't be read at all, "entries" is
+# empty and "error" says why, so one bad file doesn't stop the whole scan.
+def index_file(path):
+    entries = []
+    try:
+        if zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as zf:
+                _index_zip(zf, "", entries)
+        elif os.path.getsize(path) <= MAX_IMAGE_SIZE:
+            with open(path, 'rb') as f:
+                digest, summary = index_image(f.read())
+            if digest is not None:
+                entries.append((None, digest, summary))
+    except (zipfile.BadZipFile, OSError) as e:
+        return ([], "{}: {}".format(type(e).__name__, e))
+    return (entries, None)
+
+# The index maps each scanned file's path to its size, modification time, and
+# the images in it, and each image's SHA-256 hash to a summary of its contents.
+def load_index(path):
+    try:
+        with open(path, 'r') as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return {"version": INDEX_VERSION, "files": {}, "images": {}}
+
+    version = index.get("version")
+    if isinstance(version, int) and version < INDEX_VERSION:
+        print("Warning: \"{}\" is a version {} firmware index, so every file will be scanned again.".format(path, version), file=sys.stderr)
+        return {"version": INDEX_VERSION, "files": {}, "images": {}}
+    if version != INDEX_VERSION:
+        raise ValueError("\"{}\" is not a version {} firmware index.".format(path, INDEX_VERSION))
+    return index
+
+def save_index(path, index):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+        f.write("\n")
+    os.replace(tmp_path, path)
+
+def walk_files(root, skip):
+    if not os.path.isdir(root):
+        yield root
+        return
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            if os.path.abspath(path) not in skip:
+                yield path
+
+def under_root(path, root):
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+def image_description(digest, summary):
+    if summary.get("error"):
+        return "{}  {}  ERROR: {}".format(digest[:16], summary.get("type") or "?", summary["error"])
+    problems = [key[:-3] for key, value in summary.items() if key.endswith("_ok") and not value]
+    return "{}  {:<7}  {:<16}  {}".format(digest[:16], summary["chip"] or "Unknown", summary.get("version") or "-",
+        "OK" if not problems else "BAD: {}".format(", ".join(problems)))
+
+def scan(args):
+    index = load_index(args.index)
+    files = index["files"]
+    images = index["images"]
+
+    roots = [os.path.normpath(root) for root in args.firmware]
+    skip = {os.path.abspath(args.index), os.path.abspath(args.index + ".tmp")}
+
+    # Only files whose size or modification time changed since the last scan
+    # are read again.
+    seen = set()
+    changed = []
+    for root in roots:
+        for path in walk_files(root, skip):
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                print("Warning: Skipping \"{}\": {}".format(path, e), file=sys.stderr)
+                continue
+            seen.add(path)
+            old = files.get(path)
+            if old is None or old["size"] != st.st_size or old["mtime_ns"] != st.st_mtime_ns:
+                changed.append((path, st))
+
+    new_images = {}
+    failed = 0
+    if changed:
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=_init_scan_worker, initargs=(frozenset(images),)) as pool:
+            results = pool.map(index_file, [path for path, _ in changed], chunksize=4)
+            for (path, st), (entries, error) in zip(changed, results):
+                if error is not None:
+                    # Not added to the index, so it's tried again next time.
+                    print("Warning: Skipping \"{}\": {}".format(path, error), file=sys.stderr)
+                    failed += 1
+                    continue
+                files[path] = {
+                    "size": st.st_size,
+                    "mtime_ns": st.st_mtime_ns,
+                    "images": [{"member": member, "sha256": digest} for member, digest, _ in entries if digest is not None],
+                }
+                for member, digest, summary in entries:
+                    source = path if member is None else "{}:{}".format(path, member)
+                    if digest is None:
+                        print("Warning: Skipping \"{}\": {}".format(source, summary["error"]), file=sys.stderr)
+                    elif summary is not None and digest not in images:
+                        images[digest] = summary
+                        new_images.setdefault(digest, source)
+
+    # Forget files that were deleted from the scanned directories, and images
+    # that are no longer in any file.
+    removed = [path for path in files if path not in seen and any(under_root(path, root) for root in roots)]
+    for path in removed:
+        del files[path]
+    referenced = {image["sha256"] for entry in files.values() for image in entry["images"]}
+    for digest in [digest for digest in images if digest not in referenced]:
+        del images[digest]
+
+    save_index(args.index, index)
+
+    for digest, source in new_images.items():
+        print("{}  {}".format(image_description(digest, images[digest]), source))
+    print("Scanned {} files ({} new or changed, {} unreadable, {} removed), found {} new images. The index \"{}\" has {} images.".format(
+        len(seen), len(changed), failed, len(removed), len(new_images), args.index, len(images)))
+
+    return 0
+
 def main():
     commands = {
         "extract": {
@@ -150,14 +431,24 @@ def main():
             "image": info,
             "raw": raw_info,
         },
+        "scan": {},
     }
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", "--type", choices=("auto", "image", "raw"), default="auto", help="The image type. Default: auto")
+    parser.add_argument("-i", "--index", type=str, default="firmware_index.json", help="The index file for the \"scan\" command. Default: firmware_index.json")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="The number of processes the \"scan\" command parses images in. Default: The number of CPUs")
     parser.add_argument("command", choices=commands.keys(), help="Subcommands.")
-    parser.add_argument("firmware", type=str, help="The firmware image file.")
+    parser.add_argument("firmware", type=str, nargs='+', help="The firmware image file. The \"scan\" command takes any number of image files, zip archives, and directories.")
     args = parser.parse_args()
 
+    if args.command == "scan":
+        return scan(args)
+
+    if len(args.firmware) != 1:
+        parser.error("the \"{}\" command takes exactly one firmware image file".format(args.command))
+    args.firmware = args.firmware[0]
+
     fw_bin = open(args.firmware, 'rb').read()
 
     fw_type = args.type
@@ -165,50 +456,16 @@ def main():
         print("Firmware type set to \"{}\".".format(fw_type))
     else:
         print("Trying to guess firmware type...")
-        threshold = 3
-        points = 0
-
-        # Is the serial number string present?
-        try:
-            bytes.fromhex(fw_bin[4:4+12].decode('ascii'))
-            points += 1
-        except Exception:
-            pass
-
-        # Is "ASMT" present?
-        try:
-            if fw_bin[0x3c:0x3c+4].decode('ascii') == "ASMT":
-                points += 1
-        except Exception:
-            pass
-
-        # Is the magic value present?
-        try:
-            if fw_bin[0x7e] == 0x5a:
-                points += 1
-        except Exception:
-            pass
-
-        # Are the exception vector long jump instructions all present?
-        try:
-            vector_offsets = (0x82, 0x85, 0x8d, 0x95)
-            vectors_present = 0
-            for offset in vector_offsets:
-                vectors_present += 1
-            if vectors_present == len(vector_offsets):
-                points += 1
-        except Exception:
-            pass
-
-        if points >= threshold:
-            fw_type = "image"
-        else:
-            fw_type = "raw"
+        fw_type = guess_type(fw_bin)
         print("Guessed firmware type is \"{}\".".format(fw_type))
 
     if fw_type == "image":
-        fw = asm236x_fw.Asm236xFw.from_bytes(fw_bin)
-        return commands[args.command].get(fw_type, unsupported)(command=args.command, filename=args.firmware, fw=fw, fw_bin=fw_bin, fw_type=fw_type)
+        try:
+            image = fw_image.Asm236xImage(fw_bin)
+        except ValueError as e:
+            print("Error: {}".format(e), file=sys.stderr)
+            return 1
+        return commands[args.command].get(fw_type, unsupported)(command=args.command, filename=args.firmware, image=image, fw_bin=fw_bin, fw_type=fw_type)
     elif fw_type == "raw":
         return commands[args.command].get(fw_type, unsupported)(command=args.command, filename=args.firmware, fw_bin=fw_bin, fw_type=fw_type)
     else:
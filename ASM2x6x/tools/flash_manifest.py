@@ -0,0 +1,107 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# flash_manifest.py - Per-block hash manifests and deltas for SPI flash dumps.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import hashlib
+import json
+import struct
+
+import fw_image
+
+
+DEFAULT_BLOCK_SIZE = 4096
+
+DELTA_MAGIC = b"ASMD"
+DELTA_HEADER = struct.Struct('<4sB3xII')  # Magic, version, block size, image length
+DELTA_RECORD = struct.Struct('<II')  # Offset, length
+
+
+def block_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+# A summary of the parts of the image that change whenever the firmware body
+# changes: its size, version, magic, and checksum. "read(offset, length)" reads
+# from either an image in memory or the device.
+def fingerprint(read):
+    config, code_size, version, trailer = fw_image.read_flash_fields(read)
+    return {
+        "config": block_hash(config),
+        "code_size": code_size,
+        "version": version.hex() if version is not None else "",
+        "trailer": trailer.hex(),
+    }
+
+def firmware_fingerprint_matches(a, b):
+    return all(a.get(key) == b.get(key) for key in ("code_size", "version", "trailer"))
+
+def build(image, block_size=DEFAULT_BLOCK_SIZE):
+    view = memoryview(image)
+    return {
+        "block_size": block_size,
+        "length": len(view),
+        "blocks": [block_hash(view[i:i+block_size]) for i in range(0, len(view), block_size)],
+        "fingerprint": fingerprint(lambda offset, length: view[offset:offset+length]),
+    }
+
+def load(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save(path, manifest):
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+        f.write("\n")
+
+# The indices of the blocks holding the config, firmware header, and firmware
+# trailer, which are where changes show up.
+def priority_blocks(manifest):
+    block_size = manifest["block_size"]
+    block_count = len(manifest["blocks"])
+    code_size = manifest["fingerprint"]["code_size"]
+
+    first = []
+    for offset in (0, fw_image.FLASH_VERSION_OFFSET, fw_image.FLASH_CODE_OFFSET + code_size):
+        index = offset // block_size
+        if index < block_count and index not in first:
+            first.append(index)
+
+    return first
+
+# Records of (offset, data) for changed blocks, in a simple binary format.
+def write_delta(path, manifest, records):
+    with open(path, 'wb') as f:
+        f.write(DELTA_HEADER.pack(DELTA_MAGIC, 1, manifest["block_size"], manifest["length"]))
+        for offset, data in records:
+            f.write(DELTA_RECORD.pack(offset, len(data)))
+            f.write(data)
+
+def apply_delta(path, image):
+    with open(path, 'rb') as f:
+        magic, version, block_size, length = DELTA_HEADER.unpack(f.read(DELTA_HEADER.size))
+        if magic != DELTA_MAGIC or version != 1:
+            raise ValueError("\"{}\" is not a flash delta file.".format(path))
+        if length != len(image):
+            raise ValueError("Delta is for a {}-byte image, but the image is {} bytes.".format(length, len(image)))
+        while True:
+            record = f.read(DELTA_RECORD.size)
+            if not record:
+                break
+            offset, data_len = DELTA_RECORD.unpack(record)
+            image[offset:offset+data_len] = f.read(data_len)
+
+    return image
@@ -0,0 +1,346 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# fw_image.py - Views of ASM2x6x firmware images that can be read and edited in place.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# The layouts here are the same as the ones in "asm236x_fw.ksy" and
+# "asm2464_fw.ksy", but the classes are thin views of a buffer: fields are only
+# decoded when they're read, edits are written straight into the buffer, and
+# checksums are updated from the bytes that changed instead of being summed
+# again. Images are serialized by writing out their "data" memoryview.
+
+
+import struct
+import zlib
+
+
+# ASM236x config header
+CONFIG_LEN = 0x80
+CONFIG_MAGIC = 0x5a
+CONFIG_MAGIC_OFFSET = 0x7e
+CONFIG_CHECKSUM_OFFSET = 0x7f
+# The checksum is the 8-bit sum of the bytes from 0x04 through 0x7e.
+CONFIG_CHECKSUM_START = 0x04
+
+# Name: (offset, size). Strings are padded with 0xff.
+CONFIG_STRINGS = {
+    "serial_number": (0x04, 20),
+    "ep0_manufacturer_string": (0x18, 36),
+    "t10_manufacturer_string": (0x3c, 8),
+    "ep0_product_string": (0x44, 32),
+    "t10_product_string": (0x64, 16),
+}
+
+# Name: offset. Little-endian.
+CONFIG_U16S = {
+    "id_vendor": 0x74,
+    "id_product": 0x76,
+    "bcd_device": 0x78,
+}
+
+# Name: (offset, shift, width)
+CONFIG_BITS = {
+    "lp_if_u3": (0x7a, 6, 2),
+    "lp_if_idle": (0x7a, 4, 2),
+    "idle_timer": (0x7a, 0, 4),
+    "unk7b_76": (0x7b, 6, 2),
+    "pcie_lane": (0x7b, 4, 2),
+    "pcie_speed": (0x7b, 2, 2),
+    "pcie_aspm": (0x7b, 0, 2),
+    "unk7c": (0x7c, 0, 8),
+    "disable_slow_enumeration": (0x7d, 7, 1),
+    "disable_2tb": (0x7d, 6, 1),
+    "disable_low_power_mode": (0x7d, 5, 1),
+    "disable_u1u2": (0x7d, 4, 1),
+    "disable_wtg": (0x7d, 3, 1),
+    "disable_two_leds": (0x7d, 2, 1),
+    "disable_eup": (0x7d, 1, 1),
+    "disable_usb_removable": (0x7d, 0, 1),
+}
+
+PCIE_LANE_NAMES = {
+    0: "x1",
+    1: "x2",
+    2: "x4",
+    3: "default",
+}
+
+PCIE_SPEED_NAMES = {
+    0: "gen_1",
+    1: "gen_2",
+    2: "gen_3",
+    3: "max",
+}
+
+# ASM236x firmware body: A u16 code size, the code, a magic byte, and a checksum
+# byte.
+BODY_MAGICS = {
+    0x4b: "ASM2364",
+    0x5a: "ASM2362",
+}
+BODY_CODE_OFFSET = 2
+VERSION_OFFSET = 0x200
+VERSION_LEN = 6
+
+# Where the firmware body's fields are in the flash of an ASM236x, which holds
+# the config followed by the body.
+FLASH_CODE_OFFSET = CONFIG_LEN + BODY_CODE_OFFSET
+FLASH_VERSION_OFFSET = FLASH_CODE_OFFSET + VERSION_OFFSET
+
+# ASM2464 firmware image: A u32 body size, the body, a magic byte, a checksum
+# byte, and a u32 CRC-32 of the body.
+ASM2464_MAGIC = 0xa5
+ASM2464_TRAILER = struct.Struct('<BBI')
+
+
+def checksum(data):
+    return sum(data) & 0xff
+
+def encode_string(s, size):
+    s = s.encode('ascii')
+    if len(s) > size:
+        raise ValueError("String of size {} is too large for field of size {}".format(len(s), size))
+
+    return s + b'\xff' * (size - len(s))
+
+def decode_string(data):
+    data = bytes(data)
+    end = data.find(b'\xff')
+    if end >= 0:
+        data = data[:end]
+    return data.decode('utf-8', errors='replace')
+
+# Writes "data" into "view" at "offset" and returns how much the 8-bit sum of
+# the view changed by, or None if nothing changed. Only the bytes that differ
+# are written.
+def _patch(view, offset, data):
+    old = view[offset:offset+len(data)]
+    if old == data:
+        return None
+    delta = checksum(data) - checksum(old)
+    for i, value in enumerate(data):
+        if old[i] != value:
+            old[i] = value
+    return delta
+
+# The (offset, size) of the bytes that hold a config field.
+def field_span(name):
+    if name in CONFIG_STRINGS:
+        return CONFIG_STRINGS[name]
+    if name in CONFIG_U16S:
+        return (CONFIG_U16S[name], 2)
+    if name in CONFIG_BITS:
+        return (CONFIG_BITS[name][0], 1)
+    raise KeyError(name)
+
+class Config:
+    def __init__(self, data):
+        self.data = memoryview(data)[:CONFIG_LEN]
+        if len(self.data) < CONFIG_LEN:
+            raise ValueError("Config is {} bytes long, expected {}.".format(len(self.data), CONFIG_LEN))
+
+    # An erased config with only the magic and checksum set.
+    @classmethod
+    def blank(cls):
+        data = bytearray(b'\xff' * CONFIG_LEN)
+        data[CONFIG_MAGIC_OFFSET] = CONFIG_MAGIC
+        data[CONFIG_CHECKSUM_OFFSET] = checksum(data[CONFIG_CHECKSUM_START:CONFIG_CHECKSUM_OFFSET])
+        return cls(data)
+
+    @property
+    def magic(self):
+        return self.data[CONFIG_MAGIC_OFFSET]
+
+    @property
+    def checksum(self):
+        return self.data[CONFIG_CHECKSUM_OFFSET]
+
+    def calculated_checksum(self):
+        return checksum(self.data[CONFIG_CHECKSUM_START:CONFIG_CHECKSUM_OFFSET])
+
+    def checksum_ok(self):
+        return self.checksum == self.calculated_checksum()
+
+    def update_checksum(self):
+        self.data[CONFIG_CHECKSUM_OFFSET] = self.calculated_checksum()
+
+    # Writes raw bytes into the checksummed part of the config and adjusts the
+    # checksum by the difference, so a valid checksum stays valid.
+    def patch(self, offset, data):
+        if offset < CONFIG_CHECKSUM_START or offset + len(data) > CONFIG_CHECKSUM_OFFSET:
+            raise ValueError("Patch at 0x{:02x}-0x{:02x} is outside of the checksummed config bytes.".format(offset, offset + len(data) - 1))
+        delta = _patch(self.data, offset, data)
+        if delta:
+            self.data[CONFIG_CHECKSUM_OFFSET] = (self.checksum + delta) & 0xff
+
+    # Reads a field by its name in "CONFIG_STRINGS", "CONFIG_U16S", or
+    # "CONFIG_BITS".
+    def get(self, name):
+        if name in CONFIG_STRINGS:
+            offset, size = CONFIG_STRINGS[name]
+            return decode_string(self.data[offset:offset+size])
+        if name in CONFIG_U16S:
+            return struct.unpack_from('<H', self.data, CONFIG_U16S[name])[0]
+        if name in CONFIG_BITS:
+            offset, shift, width = CONFIG_BITS[name]
+            return (self.data[offset] >> shift) & ((1 << width) - 1)
+        raise KeyError(name)
+
+    def set(self, name, value):
+        if name in CONFIG_STRINGS:
+            offset, size = CONFIG_STRINGS[name]
+            self.patch(offset, encode_string(value, size))
+        elif name in CONFIG_U16S:
+            self.patch(CONFIG_U16S[name], struct.pack('<H', value))
+        elif name in CONFIG_BITS:
+            offset, shift, width = CONFIG_BITS[name]
+            mask = (1 << width) - 1
+            if not 0 <= value <= mask:
+                raise ValueError("Value {} is too large for {}-bit field \"{}\"".format(value, width, name))
+            self.patch(offset, bytes([(self.data[offset] & ~(mask << shift)) | (value << shift)]))
+        else:
+            raise KeyError(name)
+
+class Body:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        if len(self.data) < 2:
+            raise ValueError("Firmware body is too short.")
+        self.size = struct.unpack_from('<H', self.data, 0)[0]
+        if len(self.data) < self.size + 4:
+            raise ValueError("Firmware body is truncated: Expected at least {} bytes, got {}.".format(self.size + 4, len(self.data)))
+        self.code = self.data[2:2+self.size]
+
+    # The size, code, magic, and checksum, without any padding after them.
+    def __len__(self):
+        return self.size + 4
+
+    @property
+    def magic(self):
+        return self.data[2+self.size]
+
+    @property
+    def checksum(self):
+        return self.data[2+self.size+1]
+
+    def calculated_checksum(self):
+        return checksum(self.code)
+
+    def checksum_ok(self):
+        return self.checksum == self.calculated_checksum()
+
+    @property
+    def version(self):
+        if self.size < VERSION_OFFSET + VERSION_LEN:
+            return None
+        return bytes(self.code[VERSION_OFFSET:VERSION_OFFSET+VERSION_LEN])
+
+    # Writes raw bytes into the code and adjusts the checksum by the difference.
+    def patch(self, offset, data):
+        if offset < 0 or offset + len(data) > self.size:
+            raise ValueError("Patch at 0x{:x}-0x{:x} is outside of the firmware code.".format(offset, offset + len(data) - 1))
+        delta = _patch(self.code, offset, data)
+        if delta:
+            self.data[2+self.size+1] = (self.checksum + delta) & 0xff
+
+    def set_version(self, version):
+        self.patch(VERSION_OFFSET, version)
+
+# Reads the parts of an ASM236x flash image that change whenever the firmware
+# body does, without reading the code itself. "read(offset, length)" reads from
+# the flash or from an image in memory. Returns the config, the code size, the
+# version (or None if the code is too short to have one), and the magic and
+# checksum bytes.
+def read_flash_fields(read):
+    header = read(0, FLASH_CODE_OFFSET)
+    code_size = struct.unpack_from('<H', header, CONFIG_LEN)[0]
+    version = None
+    if code_size >= VERSION_OFFSET + VERSION_LEN:
+        version = bytes(read(FLASH_VERSION_OFFSET, VERSION_LEN))
+    trailer = bytes(read(FLASH_CODE_OFFSET + code_size, 2))
+    return (bytes(header[:CONFIG_LEN]), code_size, version, trailer)
+
+# Builds a firmware body around "code", padded with zeros to a multiple of
+# "align" bytes.
+def build_body(code, magic, align=1):
+    length = 2 + len(code) + 2
+    data = bytearray(length + (-length % align))
+    struct.pack_into('<H', data, 0, len(code))
+    data[2:2+len(code)] = code
+    data[2+len(code)] = magic
+    data[2+len(code)+1] = checksum(code)
+    return data
+
+# An ASM236x image: The config header followed by the firmware body, or just the
+# body if "has_config" is false (like the images "make_image.py -t fw" makes).
+class Asm236xImage:
+    def __init__(self, data, has_config=True):
+        self.data = memoryview(data)
+        self.config = None
+        body_offset = 0
+        if has_config:
+            self.config = Config(self.data)
+            body_offset = CONFIG_LEN
+        self.body = Body(self.data[body_offset:])
+
+class Asm2464Image:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        if len(self.data) < 4:
+            raise ValueError("Image is too short.")
+        self.body_len = struct.unpack_from('<I', self.data, 0)[0]
+        if len(self.data) < 4 + self.body_len + ASM2464_TRAILER.size:
+            raise ValueError("Image is truncated: Expected at least {} bytes, got {}.".format(4 + self.body_len + ASM2464_TRAILER.size, len(self.data)))
+        self.body = self.data[4:4+self.body_len]
+        self._trailer_offset = 4 + self.body_len
+
+    def __len__(self):
+        return self._trailer_offset + ASM2464_TRAILER.size
+
+    @property
+    def magic(self):
+        return self.data[self._trailer_offset]
+
+    @property
+    def checksum(self):
+        return self.data[self._trailer_offset+1]
+
+    @property
+    def crc(self):
+        return struct.unpack_from('<I', self.data, self._trailer_offset+2)[0]
+
+    def calculated_checksum(self):
+        return checksum(self.body)
+
+    def calculated_crc(self):
+        return zlib.crc32(self.body)
+
+    def checksum_ok(self):
+        return self.checksum == self.calculated_checksum()
+
+    def crc_ok(self):
+        return self.crc == self.calculated_crc()
+
+    # Writes raw bytes into the body and updates the checksum and CRC. The
+    # checksum is adjusted by the difference, but the CRC has to be calculated
+    # again over the whole body.
+    def patch(self, offset, data):
+        if offset < 0 or offset + len(data) > self.body_len:
+            raise ValueError("Patch at 0x{:x}-0x{:x} is outside of the firmware body.".format(offset, offset + len(data) - 1))
+        delta = _patch(self.body, offset, data)
+        if delta is not None:
+            struct.pack_into('<BI', self.data, self._trailer_offset+1, (self.checksum + delta) & 0xff, self.calculated_crc())
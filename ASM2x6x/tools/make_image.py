@@ -2,7 +2,7 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 # make_image.py - Script to generate a firmware image from a raw binary.
-# Copyright (C) 2022-2023  Forest Crossman <cyrozap@gmail.com>
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
 #
 # This program is free software: you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -19,116 +19,237 @@
 
 
 import argparse
-import struct
+import csv
+import io
+import itertools
+import json
+import os
 import sys
+import tarfile
+import time
 
 from datetime import datetime, UTC
 
+import fw_image
+
 
 CHIP_INFO = {
     "ASM2362": (0x5a, 0x2362),
     "ASM2364": (0x4b, 0x2364),
 }
 
+# Names that can be given for these fields instead of their numeric values.
+FIELD_VALUE_NAMES = {
+    "pcie_lane": {name: value for value, name in fw_image.PCIE_LANE_NAMES.items()},
+    "pcie_speed": {name: value for value, name in fw_image.PCIE_SPEED_NAMES.items()},
+}
 
-def checksum(data : bytes):
-    return sum(data) & 0xff
-
-def gen_string(s : str, size : int):
-    s = s.encode('ascii')
-    if len(s) > size:
-        raise ValueError("String of size {} is too large for field of size {}".format(len(s), size))
+TAR_MODES = (
+    (".tar", "w|"),
+    (".tar.gz", "w|gz"),
+    (".tgz", "w|gz"),
+    (".tar.bz2", "w|bz2"),
+    (".tar.xz", "w|xz"),
+)
 
-    padding = b'\xff' * (size - len(s))
-    return s + padding
 
 def gen_config(chip : str):
     usb_pid = CHIP_INFO[chip][1]
 
-    # Unknown
-    config = b'\xff' * 4
+    config = fw_image.Config.blank()
 
     # Strings
-    config += gen_string("0" * 16, 20)  # Serial number
-    config += gen_string("ASMedia", 36)  # EP0 Manufacturer String
-    config += gen_string("ASMT", 8)  # T10 Manufacturer String
-    config += gen_string("ASM236x series", 32)  # EP0 Product String
-    config += gen_string("ASM236x NVMe", 16)  # T10 Product String
+    config.set("serial_number", "0" * 16)
+    config.set("ep0_manufacturer_string", "ASMedia")
+    config.set("t10_manufacturer_string", "ASMT")
+    config.set("ep0_product_string", "ASM236x series")
+    config.set("t10_product_string", "ASM236x NVMe")
 
     # USB VID, PID, and device BCD
-    config += struct.pack('<HHH', 0x174c, usb_pid, 0x0100)
-
-    lp_if_u3 = 3
-    lp_if_idle = 3
-    idle_timer = 3
-
-    unk7b_76 = 3
-    pcie_lane = 3
-    pcie_speed = 3
-    pcie_aspm = 3
-
-    unk7c = 2
-
-    disable_slow_enumeration = 1
-    disable_2tb = 1
-    disable_low_power_mode = 1
-    disable_u1u2 = 1
-    disable_wtg = 1
-    disable_two_leds = 1
-    disable_eup = 1
-    disable_usb_removable = 1
-
-    config += bytes([
-        (lp_if_u3 << 6) | (lp_if_idle << 4) | idle_timer,
-        (unk7b_76 << 6) | (pcie_lane << 4) | (pcie_speed << 2) | (pcie_aspm << 0),
-        unk7c,
-        (disable_slow_enumeration << 7) | (disable_2tb << 6) | (disable_low_power_mode << 5) | (disable_u1u2 << 4) |
-            (disable_wtg << 3) | (disable_two_leds << 2) | (disable_eup << 1) | (disable_usb_removable << 0),
-    ])
-
-    config += bytes([0x5a])  # Magic
-
-    config += bytes([checksum(config[4:])])  # Checksum
+    config.set("id_vendor", 0x174c)
+    config.set("id_product", usb_pid)
+    config.set("bcd_device", 0x0100)
+
+    config.set("lp_if_u3", 3)
+    config.set("lp_if_idle", 3)
+    config.set("idle_timer", 3)
+
+    config.set("unk7b_76", 3)
+    config.set("pcie_lane", 3)
+    config.set("pcie_speed", 3)
+    config.set("pcie_aspm", 3)
+
+    config.set("unk7c", 2)
+
+    config.set("disable_slow_enumeration", 1)
+    config.set("disable_2tb", 1)
+    config.set("disable_low_power_mode", 1)
+    config.set("disable_u1u2", 1)
+    config.set("disable_wtg", 1)
+    config.set("disable_two_leds", 1)
+    config.set("disable_eup", 1)
+    config.set("disable_usb_removable", 1)
 
     return config
 
 def gen_fw(chip : str, code : bytes):
     body_magic = CHIP_INFO[chip][0]
 
-    code = bytearray(code)
+    body = fw_image.Body(fw_image.build_body(code, body_magic, align=16))
     bcd_timestamp = bytes.fromhex(datetime.now(UTC).strftime('%y%m%d%H%M%S'))
-    struct.pack_into('6s', code, 0x200, bcd_timestamp)
-
-    data = struct.pack('<H', len(code)) + code + bytes([body_magic, checksum(code)])
+    body.set_version(bcd_timestamp)
+
+    return body
+
+def parse_field(name, value):
+    if name in fw_image.CONFIG_STRINGS:
+        return str(value)
+    if name not in fw_image.CONFIG_U16S and name not in fw_image.CONFIG_BITS:
+        raise ValueError("Unknown field \"{}\"".format(name))
+    if isinstance(value, int):
+        return value
+    named = FIELD_VALUE_NAMES.get(name, {})
+    if value in named:
+        return named[value]
+    return int(value, 0)
+
+# Yields a dict of config fields for each unit in a CSV file (with a header row)
+# or a JSONL file. Empty CSV cells and null JSON values are left out, so those
+# fields keep the template's values. The optional "name" field sets the unit's
+# file name.
+def read_units(f):
+    first = f.readline()
+    lines = itertools.chain([first], f)
+    if first.lstrip().startswith("{"):
+        rows = (json.loads(line) for line in lines if line.strip())
+    else:
+        rows = csv.DictReader(lines)
+    for row in rows:
+        yield {key: value for key, value in row.items() if value not in (None, "")}
+
+# Patches each unit's fields into the config of the "template" flash image and
+# yields (file name, image) for each unit. Fields are written in place, only the
+# bytes that differ from the previous unit are changed, and the checksum is
+# adjusted by the difference instead of being summed again. Every unit reuses
+# the template's buffer, so each image must be written out before the next one
+# is generated.
+def gen_units(template, units):
+    config = fw_image.Config(template)
+    if not config.checksum_ok():
+        raise ValueError("The template's config checksum is bad. Expected 0x{:02x}, calculated 0x{:02x}.".format(config.checksum, config.calculated_checksum()))
+    original = bytes(config.data)
+
+    previous = ()
+    for index, unit in enumerate(units):
+        name = unit.pop("name", None)
+        try:
+            values = {field: parse_field(field, value) for field, value in unit.items()}
+
+            # Fields that the previous unit set and this one doesn't go back to
+            # the template's values.
+            for field in previous:
+                if field not in values:
+                    offset, size = fw_image.field_span(field)
+                    config.patch(offset, original[offset:offset+size])
+            for field, value in values.items():
+                config.set(field, value)
+        except ValueError as e:
+            raise ValueError("Unit {}: {}".format(index + 1, e))
+        previous = list(values)
+
+        if name is None:
+            name = "{}.bin".format(values.get("serial_number") or "unit{:06d}".format(index + 1))
+        yield (name, template)
+
+# Writes the images to a directory, a tar archive, or (if there's only one of
+# them) stdout, and returns how many were written.
+def write_units(output, images):
+    count = 0
+    names = set()
+
+    def checked(images):
+        nonlocal count
+        for name, image in images:
+            if os.path.basename(name) != name or name in ("", ".", ".."):
+                raise ValueError("Bad unit file name: \"{}\"".format(name))
+            if name in names:
+                raise ValueError("More than one unit is named \"{}\"".format(name))
+            names.add(name)
+            count += 1
+            yield (name, image)
+
+    if output == "-":
+        for name, image in checked(images):
+            if count > 1:
+                raise ValueError("Only one image can be written to stdout, but there's more than one unit")
+            sys.stdout.buffer.write(image)
+        sys.stdout.buffer.flush()
+        return count
+
+    for suffix, mode in TAR_MODES:
+        if output.endswith(suffix):
+            mtime = time.time()
+            with tarfile.open(output, mode) as tar:
+                for name, image in checked(images):
+                    info = tarfile.TarInfo(name)
+                    info.size = len(image)
+                    info.mtime = mtime
+                    info.mode = 0o644
+                    tar.addfile(info, io.BytesIO(image))
+            return count
+
+    os.makedirs(output, exist_ok=True)
+    for name, image in checked(images):
+        with open(os.path.join(output, name), 'wb') as f:
+            f.write(image)
+    return count
+
+def batch(args):
+    template = bytearray(open(args.input, 'rb').read())
+    output = args.output or "units"
+    log = sys.stderr if output == "-" else sys.stdout
+
+    units_file = sys.stdin if args.batch == "-" else open(args.batch, 'r', newline='')
+    try:
+        start_ns = time.perf_counter_ns()
+        count = write_units(output, gen_units(template, read_units(units_file)))
+        elapsed = time.perf_counter_ns() - start_ns
+    except (ValueError, KeyError) as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        return 1
+    finally:
+        if units_file is not sys.stdin:
+            units_file.close()
 
-    padding_len = 16 - (len(data) % 16)
-    padding = bytes(padding_len)
-    if padding_len == 16:
-        padding = b''
+    print("Wrote {} images to \"{}\" in {:.6f} seconds.".format(count, output, elapsed/1e9), file=log)
 
-    return bytes(data) + padding
+    return 0
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("input", type=str, help="Input binary.")
+    parser.add_argument("input", type=str, help="Input binary, or the template flash image in batch mode.")
     parser.add_argument("-c", "--chip", type=str, choices=CHIP_INFO.keys(), default="ASM2362", help="Chip to target.")
     parser.add_argument("-t", "--type", type=str, choices=["flash", "fw"], default="fw", help="Image type.")
-    parser.add_argument("-o", "--output", type=str, default="firmware.bin", help="Output image.")
+    parser.add_argument("-b", "--batch", type=str, default=None, help="Batch mode: Make one flash image per unit in this CSV or JSONL file (or \"-\" for stdin) by setting the unit's config fields in the template image.")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Output image, or \"-\" for stdout. In batch mode, a directory, a tar archive (.tar, .tar.gz, .tgz, .tar.bz2, or .tar.xz), or \"-\" to write a single unit's image to stdout. Default: firmware.bin, or units in batch mode")
     args = parser.parse_args()
 
+    if args.batch:
+        return batch(args)
+
     binary = open(args.input, 'rb').read()
 
     if args.type == "fw":
-        image = gen_fw(args.chip, binary)
+        parts = (gen_fw(args.chip, binary).data,)
     elif args.type == "flash":
-        config = gen_config(args.chip)
-        image = config + binary
+        parts = (gen_config(args.chip).data, binary)
     else:
         print("Error: Unrecognized image type: {}".format(args.type))
         return 1
 
-    output = open(args.output, 'wb')
-    output.write(image)
+    output = sys.stdout.buffer if args.output == "-" else open(args.output or "firmware.bin", 'wb')
+    for part in parts:
+        output.write(part)
     output.close()
 
     return 0
@@ -0,0 +1,195 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# pcie_config.py - A caching accessor for the config space of a PCIe function.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import struct
+
+import pcie_topology
+
+
+# Registers that can change without being written, which are always read from
+# the device, as (offset, size) ranges.
+HEADER_VOLATILE = (
+    (0x06, 2),  # Status
+    (0x0f, 1),  # BIST
+    (0x1e, 2),  # Secondary Status (bridges only, but harmless for endpoints)
+)
+
+# Capability ID: ((offset in the capability, size), ...)
+CAP_VOLATILE = {
+    0x01: ((0x04, 2),),  # Power Management Control/Status
+    0x10: (  # PCI Express
+        (0x0a, 2),  # Device Status
+        (0x12, 2),  # Link Status
+        (0x1a, 2),  # Slot Status
+        (0x20, 4),  # Root Status
+        (0x32, 2),  # Link Status 2
+    ),
+}
+
+EXT_CAP_VOLATILE = {
+    0x0001: (  # Advanced Error Reporting
+        (0x04, 4),  # Uncorrectable Error Status
+        (0x10, 4),  # Correctable Error Status
+        (0x1c, 16),  # Header Log
+        (0x30, 4),  # Root Error Status
+    ),
+}
+
+# Device Control in the PCI Express capability, and its Initiate Function Level
+# Reset bit.
+PCIE_DEVICE_CONTROL = 0x08
+PCIE_DEVICE_CONTROL_FLR = 1 << 15
+
+
+# Caches the DWORDs of one function's config space. Byte and word reads are
+# served from the cached DWORDs, reads of several registers fetch all of the
+# missing DWORDs with as few block reads as possible, and writes go straight to
+# the device and drop only the DWORD they wrote from the cache. Registers that
+# change on their own (status registers, mostly) are never served from the
+# cache. The capability lists are only walked to find those registers once a
+# cached DWORD in the capability or extended capability area is about to be
+# used, so a fresh accessor doesn't read anything it wasn't asked for.
+#
+# "read_block(offset, count)" reads "count" DWORDs as little-endian bytes, and
+# "write(offset, value, size)" writes one register.
+class ConfigSpace:
+    def __init__(self, read_block, write):
+        self._read_block = read_block
+        self._write = write
+        self._cache = {}
+        self._volatile = list(HEADER_VOLATILE)
+        self._caps_walked = False
+        self._ext_caps_walked = False
+        self._pcie_cap = None
+        # The number of DWORDs read from and registers written to the device.
+        self.dwords_read = 0
+        self.writes = 0
+
+    def declare_volatile(self, offset, size):
+        self._volatile.append((offset, size))
+
+    def invalidate(self, offset=None, length=4):
+        if offset is None:
+            self._cache.clear()
+            return
+        for dword in range(offset & ~3, offset + length, 4):
+            self._cache.pop(dword, None)
+
+    def _find_volatile(self, end):
+        # Set the flags first, since walking the lists reads through the cache.
+        if end > 0x40 and not self._caps_walked:
+            self._caps_walked = True
+            header = self.read_bytes(0, pcie_topology.HEADER_DWORDS * 4)
+            for cap_id, offset, _ in pcie_topology.capabilities(self.read_dword, header):
+                if cap_id == pcie_topology.CAP_PCIE:
+                    self._pcie_cap = offset
+                for reg_offset, size in CAP_VOLATILE.get(cap_id, ()):
+                    self._volatile.append((offset + reg_offset, size))
+        if end > 0x100 and not self._ext_caps_walked:
+            self._ext_caps_walked = True
+            for cap_id, _, offset in pcie_topology.extended_capabilities(self.read_dword):
+                for reg_offset, size in EXT_CAP_VOLATILE.get(cap_id, ()):
+                    self._volatile.append((offset + reg_offset, size))
+
+    def _is_volatile(self, offset, size):
+        return any(offset < v_offset + v_size and v_offset < offset + size for v_offset, v_size in self._volatile)
+
+    # Makes sure the DWORDs covering each (offset, size) range are in the
+    # cache and up to date, fetching runs of adjacent DWORDs with one block read
+    # each.
+    def _fetch(self, ranges):
+        missing = set()
+        cached = False
+        for offset, size in ranges:
+            for dword in range(offset & ~3, offset + size, 4):
+                if dword in self._cache:
+                    cached = True
+                else:
+                    missing.add(dword)
+
+        if cached:
+            self._find_volatile(max(offset + size for offset, size in ranges))
+            for offset, size in ranges:
+                if self._is_volatile(offset, size):
+                    missing.update(range(offset & ~3, offset + size, 4))
+
+        missing = sorted(missing)
+        i = 0
+        while i < len(missing):
+            start = missing[i]
+            count = 1
+            while i + count < len(missing) and missing[i + count] == start + 4 * count:
+                count += 1
+            data = self._read_block(start, count)
+            for j in range(count):
+                self._cache[start + 4 * j] = struct.unpack_from('<I', data, 4 * j)[0]
+            self.dwords_read += count
+            i += count
+
+    def _cached_bytes(self, offset, length):
+        data = bytearray()
+        for dword in range(offset & ~3, offset + length, 4):
+            data += struct.pack('<I', self._cache[dword])
+        start = offset & 3
+        return bytes(data[start:start+length])
+
+    def read_bytes(self, offset, length):
+        assert 0 <= offset and offset + length <= 0x1000
+        self._fetch([(offset, length)])
+        return self._cached_bytes(offset, length)
+
+    def read_dword(self, offset):
+        return self.read(offset, 4)
+
+    # Reads a 1-, 2-, or 4-byte register that doesn't cross a DWORD boundary.
+    def read(self, offset, size=4):
+        assert size in (1, 2, 4) and (offset & 3) + size <= 4
+        return int.from_bytes(self.read_bytes(offset, size), 'little')
+
+    # Reads several registers at once, given as (offset, size) tuples.
+    def read_many(self, registers):
+        for offset, size in registers:
+            assert size in (1, 2, 4) and (offset & 3) + size <= 4
+        self._fetch(registers)
+        return [int.from_bytes(self._cached_bytes(offset, size), 'little') for offset, size in registers]
+
+    def write(self, offset, value, size=4):
+        assert size in (1, 2, 4) and (offset & 3) + size <= 4
+        # Find Device Control before writing, in case this is an FLR. If
+        # nothing is cached, there's nothing an FLR could make stale.
+        if self._cache:
+            self._find_volatile(offset + size)
+        self._write(offset, value, size)
+        self.writes += 1
+
+        # A Function Level Reset puts every register back to its default.
+        control = self._pcie_cap + PCIE_DEVICE_CONTROL if self._pcie_cap is not None else None
+        if control is not None and offset <= control + 1 < offset + size and \
+                (value << (8 * (offset & 3))) & (PCIE_DEVICE_CONTROL_FLR << (8 * (control & 3))):
+            self.invalidate()
+        else:
+            self.invalidate(offset, size)
+
+    # Read-modify-write: clears the bits in "clear", sets the bits in "set",
+    # and returns the new value. The read is served from the cache if it can
+    # be.
+    def update(self, offset, clear=0, set=0, size=4):
+        value = (self.read(offset, size) & ~clear) | set
+        self.write(offset, value, size)
+        return value
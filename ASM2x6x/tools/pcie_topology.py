@@ -0,0 +1,330 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# pcie_topology.py - Enumerate the PCIe functions behind a USB-to-PCIe bridge.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import json
+import struct
+
+from transport import PcieCompletionError
+
+
+# The standard header that every function has, in DWORDs.
+HEADER_DWORDS = 16
+
+CAP_PCIE = 0x10
+
+CAP_NAMES = {
+    0x01: "Power Management",
+    0x05: "MSI",
+    0x09: "Vendor Specific",
+    0x0d: "Subsystem ID",
+    0x10: "PCI Express",
+    0x11: "MSI-X",
+    0x12: "SATA",
+    0x13: "Advanced Features",
+}
+
+EXT_CAP_NAMES = {
+    0x0001: "Advanced Error Reporting",
+    0x0002: "Virtual Channel",
+    0x0003: "Device Serial Number",
+    0x0004: "Power Budgeting",
+    0x000b: "Vendor Specific",
+    0x000e: "ARI",
+    0x0010: "SR-IOV",
+    0x0015: "Resizable BAR",
+    0x0018: "Latency Tolerance Reporting",
+    0x0019: "Secondary PCI Express",
+    0x001e: "L1 PM Substates",
+    0x0025: "Data Link Feature",
+    0x0026: "Physical Layer 16.0 GT/s",
+    0x0027: "Lane Margining at the Receiver",
+}
+
+PORT_TYPES = {
+    0x0: "Endpoint",
+    0x1: "Legacy Endpoint",
+    0x4: "Root Port",
+    0x5: "Upstream Port",
+    0x6: "Downstream Port",
+    0x7: "PCIe-to-PCI Bridge",
+    0x8: "PCI-to-PCIe Bridge",
+    0x9: "Root Complex Integrated Endpoint",
+    0xa: "Root Complex Event Collector",
+}
+
+# Ports whose secondary bus is a link, so only device 0 can be on it.
+DOWNSTREAM_PORT_TYPES = (0x4, 0x6)
+
+LINK_SPEEDS = {
+    1: "2.5",
+    2: "5",
+    3: "8",
+    4: "16",
+    5: "32",
+    6: "64",
+}
+
+# (Base class, subclass): (description, name prefix)
+CLASSES = {
+    (0x01, 0x00): ("SCSI storage controller", "scsi"),
+    (0x01, 0x06): ("SATA controller", "sata"),
+    (0x01, 0x08): ("Non-Volatile memory controller", "nvme"),
+    (0x02, 0x00): ("Ethernet controller", "eth"),
+    (0x02, 0x80): ("Network controller", "net"),
+    (0x03, 0x00): ("VGA compatible controller", "gpu"),
+    (0x03, 0x02): ("3D controller", "gpu"),
+    (0x04, 0x03): ("Audio device", "audio"),
+    (0x06, 0x04): ("PCI bridge", "bridge"),
+    (0x0c, 0x03): ("USB controller", "usb"),
+}
+
+
+def bdf_to_string(bdf):
+    return "{:02x}:{:02x}.{:x}".format(*bdf)
+
+def class_info(class_code):
+    return CLASSES.get((class_code >> 16, (class_code >> 8) & 0xff), ("Class {:04x}".format(class_code >> 8), "dev"))
+
+# Reads the header of a function and returns it as bytes, or None if there's no
+# function there. Only the vendor/device ID DWORD is read first, so absent
+# functions only cost one request. "read_block(bdf, offset, count)" reads
+# "count" config DWORDs and raises "PcieCompletionError" if the request fails.
+# Only an Unsupported Request means there's no function: any other error is
+# passed on, so a failed scan is never mistaken for a smaller topology.
+def read_header(read_block, bdf):
+    try:
+        ids = read_block(bdf, 0, 1)
+    except PcieCompletionError as e:
+        if e.status != PcieCompletionError.UNSUPPORTED_REQUEST:
+            raise
+        return None
+
+    vendor_id = struct.unpack_from('<H', ids, 0)[0]
+    if vendor_id in (0xffff, 0x0000):
+        return None
+
+    return ids + read_block(bdf, 4, HEADER_DWORDS - 1)
+
+# Walks the capability list, yielding (ID, offset, first DWORD) for each
+# capability. Each step only reads one DWORD, so callers that are looking for
+# one capability can stop as soon as they find it.
+def capabilities(read_dword, header):
+    status = struct.unpack_from('<H', header, 0x06)[0]
+    if not status & 0x10:
+        return
+
+    seen = set()
+    offset = header[0x34] & 0xfc
+    while offset >= 0x40 and offset not in seen:
+        seen.add(offset)
+        dword = read_dword(offset)
+        yield (dword & 0xff, offset, dword)
+        offset = (dword >> 8) & 0xfc
+
+# Walks the extended capability list, yielding (ID, version, offset).
+def extended_capabilities(read_dword):
+    seen = set()
+    offset = 0x100
+    while offset >= 0x100 and offset not in seen:
+        seen.add(offset)
+        dword = read_dword(offset)
+        if dword in (0x00000000, 0xffffffff):
+            return
+        yield (dword & 0xffff, (dword >> 16) & 0xf, offset)
+        offset = (dword >> 20) & 0xffc
+
+def decode_bars(header, count):
+    bars = []
+    index = 0
+    while index < count:
+        low = struct.unpack_from('<I', header, 0x10 + 4 * index)[0]
+        bar = {"index": index}
+        if low & 0x1:
+            bar.update(type="io", address=low & 0xfffffffc, prefetchable=False)
+            width = 1
+        elif (low >> 1) & 0x3 == 0x2 and index + 1 < count:
+            high = struct.unpack_from('<I', header, 0x10 + 4 * (index + 1))[0]
+            bar.update(type="mem64", address=(high << 32) | (low & 0xfffffff0), prefetchable=bool(low & 0x8))
+            width = 2
+        else:
+            bar.update(type="mem32", address=low & 0xfffffff0, prefetchable=bool(low & 0x8))
+            width = 1
+        if low:
+            bars.append(bar)
+        index += width
+    return bars
+
+# Decodes a function's header into a dict. The capability list is only walked
+# as far as the PCI Express capability, unless "walk_all" is set, in which case
+# both capability lists are walked all the way.
+def describe(read_dword, bdf, header, walk_all=False):
+    vendor_id, device_id = struct.unpack_from('<HH', header, 0x00)
+    class_rev = struct.unpack_from('<I', header, 0x08)[0]
+    header_type = header[0x0e]
+    function = {
+        "bdf": bdf_to_string(bdf),
+        "vendor_id": vendor_id,
+        "device_id": device_id,
+        "revision": class_rev & 0xff,
+        "class_code": class_rev >> 8,
+        "header_type": header_type & 0x7f,
+        "multifunction": bool(header_type & 0x80),
+    }
+
+    if header_type & 0x7f == 0x00:
+        function["subsystem"] = list(struct.unpack_from('<HH', header, 0x2c))
+        function["bars"] = decode_bars(header, 6)
+    elif header_type & 0x7f == 0x01:
+        function["bars"] = decode_bars(header, 2)
+        function["primary_bus"], function["secondary_bus"], function["subordinate_bus"] = header[0x18:0x1b]
+
+    caps = []
+    for cap_id, offset, dword in capabilities(read_dword, header):
+        caps.append([cap_id, offset])
+        if cap_id == CAP_PCIE:
+            link_cap = read_dword(offset + 0x0c)
+            link_status = read_dword(offset + 0x10) >> 16
+            function["pcie"] = {
+                "port_type": (dword >> 20) & 0xf,
+                "link_cap_speed": link_cap & 0xf,
+                "link_cap_width": (link_cap >> 4) & 0x3f,
+                "link_speed": link_status & 0xf,
+                "link_width": (link_status >> 4) & 0x3f,
+            }
+            if not walk_all:
+                break
+
+    if walk_all:
+        function["capabilities"] = caps
+        function["extended_capabilities"] = []
+        if "pcie" in function:
+            function["extended_capabilities"] = [[cap_id, version, offset] for cap_id, version, offset in extended_capabilities(read_dword)]
+
+    return function
+
+# Enumerates the functions behind the bridge, starting with device 0 on bus 0
+# (the other end of the bridge's link). Function 0 is read first, and the other
+# functions of a device are only probed if it's a multi-function device. The
+# buses behind bridges are scanned if their bus numbers have been assigned:
+# only device 0 behind root and downstream ports, since those buses are links,
+# and all 32 devices behind other bridges, like the internal bus of a switch.
+# Returns the list of function dicts, each with a "name" like "nvme0".
+def scan(read_block, read_dword, walk_all=False):
+    functions = []
+    scanned_buses = set()
+
+    def scan_bus(bus, devices):
+        scanned_buses.add(bus)
+        for dev in devices:
+            header = read_header(read_block, (bus, dev, 0))
+            if header is None:
+                continue
+
+            fns = range(8) if header[0x0e] & 0x80 else range(1)
+            for fn in fns:
+                if fn != 0:
+                    header = read_header(read_block, (bus, dev, fn))
+                    if header is None:
+                        continue
+
+                bdf = (bus, dev, fn)
+                function = describe(lambda offset: read_dword(bdf, offset), bdf, header, walk_all)
+                functions.append(function)
+
+                secondary = function.get("secondary_bus", 0)
+                if secondary > bus and secondary not in scanned_buses:
+                    port_type = function.get("pcie", {}).get("port_type")
+                    scan_bus(secondary, range(1) if port_type in DOWNSTREAM_PORT_TYPES else range(32))
+
+    scan_bus(0, range(1))
+
+    counts = {}
+    for function in functions:
+        prefix = class_info(function["class_code"])[1]
+        function["name"] = "{}{}".format(prefix, counts.get(prefix, 0))
+        counts[prefix] = counts.get(prefix, 0) + 1
+
+    return functions
+
+# Finds a function in a topology by its name ("nvme0") or its vendor and device
+# IDs ("144d:a808", the first match). Returns None if there's no match.
+def find(functions, spec):
+    for function in functions:
+        if function["name"] == spec:
+            return function
+
+    vendor, sep, device = spec.partition(":")
+    if sep and len(vendor) == 4 and len(device) == 4:
+        try:
+            ids = (int(vendor, 16), int(device, 16))
+        except ValueError:
+            return None
+        for function in functions:
+            if (function["vendor_id"], function["device_id"]) == ids:
+                return function
+
+    return None
+
+def function_to_lines(function):
+    description = class_info(function["class_code"])[0]
+    lines = ["{} {:<8} [{:04x}] {:04x}:{:04x} (rev {:02x}) {}".format(
+        function["bdf"], function["name"], function["class_code"] >> 8,
+        function["vendor_id"], function["device_id"], function["revision"], description)]
+
+    if "subsystem" in function:
+        lines.append("  Subsystem: {:04x}:{:04x}".format(*function["subsystem"]))
+    if "secondary_bus" in function:
+        lines.append("  Bus: primary={:02x}, secondary={:02x}, subordinate={:02x}".format(
+            function["primary_bus"], function["secondary_bus"], function["subordinate_bus"]))
+    for bar in function.get("bars", []):
+        kind = {"io": "I/O ports", "mem32": "Memory (32-bit)", "mem64": "Memory (64-bit)"}[bar["type"]]
+        lines.append("  BAR{}: {} at 0x{:x}{}".format(bar["index"], kind, bar["address"], ", prefetchable" if bar["prefetchable"] else ""))
+
+    pcie = function.get("pcie")
+    if pcie is not None:
+        lines.append("  PCI Express {}: Link capable of {} GT/s x{}, running at {} GT/s x{}".format(
+            PORT_TYPES.get(pcie["port_type"], "Unknown port type 0x{:x}".format(pcie["port_type"])),
+            LINK_SPEEDS.get(pcie["link_cap_speed"], "?"), pcie["link_cap_width"],
+            LINK_SPEEDS.get(pcie["link_speed"], "?"), pcie["link_width"]))
+    for cap_id, offset in function.get("capabilities", []):
+        lines.append("  Capability 0x{:02x} at 0x{:02x}: {}".format(cap_id, offset, CAP_NAMES.get(cap_id, "Unknown")))
+    for cap_id, version, offset in function.get("extended_capabilities", []):
+        lines.append("  Extended capability 0x{:04x} v{} at 0x{:03x}: {}".format(cap_id, version, offset, EXT_CAP_NAMES.get(cap_id, "Unknown")))
+
+    return lines
+
+# The cache maps each bridge's key (see "bridge_key" in asm2x6x_tool.py) to the
+# list of functions that were found behind it.
+def load_cache(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(path, cache):
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f, indent=2)
+            f.write("\n")
+        tmp_path.replace(path)
+    except OSError:
+        pass
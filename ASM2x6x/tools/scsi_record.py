@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# scsi_record.py - Record SCSI sessions to a file and replay them.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# File format (all integers are little-endian):
+#
+# - Header: "ASMR", a version byte, three padding bytes, the length of the
+#   metadata, and the metadata as JSON.
+# - Frames: "FRAM", the compressed and uncompressed lengths, and the number of
+#   records, followed by that many records, compressed together with zlib.
+#   Each frame can be decompressed on its own.
+# - Index (only if the recording was closed cleanly): "INDX", the number of
+#   frames, and the file offset and first record number of each frame,
+#   followed by the offset of the index and "ASMI".
+#
+# Each record is a header (flags, CDB length, data-out length, data-in length,
+# status, and latency in nanoseconds) followed by the CDB, the data sent, and
+# the data received. If the command raised an exception, the flags say which
+# kind, and the data received is the exception's message.
+
+
+import argparse
+import atexit
+import json
+import signal
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from transport import CheckConditionError, Transport, TransportError, check_sgio_types
+
+
+MAGIC = b"ASMR"
+VERSION = 1
+
+FILE_HEADER = struct.Struct('<4sB3xI')
+FRAME_HEADER = struct.Struct('<4sIII')
+RECORD = struct.Struct('<BBxxIIiQ')
+INDEX_HEADER = struct.Struct('<4sI')
+INDEX_ENTRY = struct.Struct('<QQ')
+TRAILER = struct.Struct('<Q4s')
+
+FLAG_ERROR_CHECK_CONDITION = 0x01
+FLAG_ERROR_OTHER = 0x02
+FLAG_ERROR_MASK = 0x03
+FLAG_DATA_OUT = 0x04
+FLAG_DATA_IN = 0x08
+
+FRAME_RECORDS = 1024
+FRAME_BYTES = 1 << 18
+# Seconds between flushes of a partial frame, so a session that hangs or is
+# killed loses at most this much of its last commands.
+FLUSH_INTERVAL = 1.0
+
+
+# Writes records in frames. A frame is written when it's full, and a partial
+# frame is written by a background thread every "flush_interval" seconds. If the
+# recording isn't closed before the interpreter exits, it's closed by an atexit
+# handler.
+class RecordWriter:
+    def __init__(self, path, metadata=None, flush_interval=FLUSH_INTERVAL):
+        self._file = open(path, 'wb')
+        meta = json.dumps(metadata or {}).encode('utf-8')
+        self._file.write(FILE_HEADER.pack(MAGIC, VERSION, len(meta)))
+        self._file.write(meta)
+        self._file.flush()
+        self._frame = bytearray()
+        self._frame_records = 0
+        self._record_count = 0
+        # (file offset, first record number) of each frame
+        self._index = []
+
+        # Reentrant, so a signal that exits the interpreter in the middle of a
+        # write can still close the recording from the atexit handler.
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+        if flush_interval:
+            threading.Thread(target=self._flush_periodically, args=(flush_interval,), daemon=True).start()
+        atexit.register(self.close)
+
+    def _flush_periodically(self, interval):
+        while not self._closed.wait(interval):
+            self.flush()
+
+    def write(self, cdb, data_out, data_in, status, latency_ns, error=None):
+        flags = 0
+        if data_out is not None:
+            flags |= FLAG_DATA_OUT
+        if data_in is not None:
+            flags |= FLAG_DATA_IN
+
+        data_in_bytes = bytes(data_in) if data_in is not None else b""
+        if error is not None:
+            flags |= FLAG_ERROR_CHECK_CONDITION if isinstance(error, CheckConditionError) else FLAG_ERROR_OTHER
+            data_in_bytes = str(error).encode('utf-8')
+            status = -1
+        data_out_bytes = bytes(data_out) if data_out is not None else b""
+
+        with self._lock:
+            self._frame += RECORD.pack(flags, len(cdb), len(data_out_bytes), len(data_in_bytes), status, latency_ns)
+            self._frame += cdb
+            self._frame += data_out_bytes
+            self._frame += data_in_bytes
+            self._frame_records += 1
+            self._record_count += 1
+
+            if self._frame_records >= FRAME_RECORDS or len(self._frame) >= FRAME_BYTES:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._closed.is_set():
+                self._flush()
+
+    def _flush(self):
+        if not self._frame_records:
+            return
+        compressed = zlib.compress(self._frame)
+        self._index.append((self._file.tell(), self._record_count - self._frame_records))
+        self._file.write(FRAME_HEADER.pack(b"FRAM", len(compressed), len(self._frame), self._frame_records))
+        self._file.write(compressed)
+        self._file.flush()
+        self._frame = bytearray()
+        self._frame_records = 0
+
+    def close(self):
+        with self._lock:
+            if self._closed.is_set():
+                return
+            self._closed.set()
+            self._flush()
+            self._write_index()
+        atexit.unregister(self.close)
+
+    def _write_index(self):
+        index_offset = self._file.tell()
+        self._file.write(INDEX_HEADER.pack(b"INDX", len(self._index)))
+        for offset, first in self._index:
+            self._file.write(INDEX_ENTRY.pack(offset, first))
+        self._file.write(TRAILER.pack(index_offset, b"ASMI"))
+        self._file.close()
+
+# Makes SIGTERM and SIGHUP exit the interpreter normally, so the atexit
+# handlers close any open recordings. Only works from the main thread.
+def exit_on_signals():
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        if signal.getsignal(signum) == signal.SIG_DFL:
+            signal.signal(signum, lambda signum, frame: sys.exit(128 + signum))
+
+class Record:
+    __slots__ = ("cdb", "data_out", "data_in", "status", "latency_ns", "flags")
+
+    def __init__(self, cdb, data_out, data_in, status, latency_ns, flags):
+        self.cdb = cdb
+        self.data_out = data_out
+        self.data_in = data_in
+        self.status = status
+        self.latency_ns = latency_ns
+        self.flags = flags
+
+    def raise_error(self):
+        kind = self.flags & FLAG_ERROR_MASK
+        if kind == FLAG_ERROR_CHECK_CONDITION:
+            raise CheckConditionError(self.data_in.decode('utf-8', 'replace'))
+        if kind == FLAG_ERROR_OTHER:
+            raise TransportError("Recorded error: {}".format(self.data_in.decode('utf-8', 'replace')))
+
+class RecordReader:
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        magic, version, meta_len = FILE_HEADER.unpack(self._file.read(FILE_HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("\"{}\" is not a SCSI recording.".format(path))
+        self.metadata = json.loads(self._file.read(meta_len))
+        self._frames_start = self._file.tell()
+        self.index = self._read_index()
+
+    def _read_index(self):
+        self._file.seek(0, 2)
+        end = self._file.tell()
+        if end - self._frames_start >= TRAILER.size:
+            self._file.seek(end - TRAILER.size)
+            index_offset, magic = TRAILER.unpack(self._file.read(TRAILER.size))
+            if magic == b"ASMI":
+                self._file.seek(index_offset)
+                _, count = INDEX_HEADER.unpack(self._file.read(INDEX_HEADER.size))
+                return [INDEX_ENTRY.unpack(self._file.read(INDEX_ENTRY.size)) for _ in range(count)]
+
+        # The recording wasn't closed cleanly, so find the frames that made it
+        # to the file.
+        index = []
+        offset = self._frames_start
+        first = 0
+        while True:
+            self._file.seek(offset)
+            header = self._file.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                break
+            magic, compressed_len, _, count = FRAME_HEADER.unpack(header)
+            if magic != b"FRAM":
+                break
+            if len(self._file.read(compressed_len)) < compressed_len:
+                break
+            index.append((offset, first))
+            offset += FRAME_HEADER.size + compressed_len
+            first += count
+        return index
+
+    def _frame_records(self, offset):
+        self._file.seek(offset)
+        _, compressed_len, _, count = FRAME_HEADER.unpack(self._file.read(FRAME_HEADER.size))
+        frame = zlib.decompress(self._file.read(compressed_len))
+        pos = 0
+        for _ in range(count):
+            flags, cdb_len, out_len, in_len, status, latency_ns = RECORD.unpack_from(frame, pos)
+            pos += RECORD.size
+            cdb = frame[pos:pos+cdb_len]
+            pos += cdb_len
+            data_out = frame[pos:pos+out_len] if flags & FLAG_DATA_OUT else None
+            pos += out_len
+            data_in = frame[pos:pos+in_len]
+            pos += in_len
+            yield Record(cdb, data_out, data_in, status, latency_ns, flags)
+
+    # Yields the records starting from record number "start", decompressing
+    # only the frames that are needed.
+    def records(self, start=0):
+        for i, (offset, first) in enumerate(self.index):
+            next_first = self.index[i + 1][1] if i + 1 < len(self.index) else None
+            if next_first is not None and next_first <= start:
+                continue
+            for n, record in enumerate(self._frame_records(offset), first):
+                if n >= start:
+                    yield record
+
+    def close(self):
+        self._file.close()
+
+# Wraps another transport and records every command sent through it.
+class RecordingTransport(Transport):
+    def __init__(self, inner, path, metadata=None):
+        self.inner = inner
+        self.writer = RecordWriter(path, metadata)
+
+    def execute(self, cdb, data_out, data_in):
+        start_ns = time.perf_counter_ns()
+        try:
+            status = self.inner.execute(cdb, data_out, data_in)
+        except Exception as e:
+            self.writer.write(bytes(cdb), data_out, data_in, 0, time.perf_counter_ns() - start_ns, e)
+            raise
+        self.writer.write(bytes(cdb), data_out, data_in, status, time.perf_counter_ns() - start_ns)
+        return status
+
+    def execute_many(self, commands):
+        pending = []
+
+        def submitted():
+            for cdb, data_out, data_in in commands:
+                # Copy the CDB, since the caller may reuse its buffer.
+                pending.append((time.perf_counter_ns(), bytes(cdb), data_out, data_in))
+                yield (cdb, data_out, data_in)
+
+        statuses = self.inner.execute_many(submitted())
+        while True:
+            try:
+                status = next(statuses)
+            except StopIteration:
+                return
+            except Exception as e:
+                start_ns, cdb, data_out, data_in = pending.pop(0)
+                self.writer.write(cdb, data_out, data_in, 0, time.perf_counter_ns() - start_ns, e)
+                raise
+            start_ns, cdb, data_out, data_in = pending.pop(0)
+            self.writer.write(cdb, data_out, data_in, status, time.perf_counter_ns() - start_ns)
+            yield status
+
+    def close(self):
+        self.writer.close()
+        self.inner.close()
+
+# Answers commands with the responses from a recording, in order. Each command
+# must match the recorded one, so a replay that goes differently from the
+# recorded session fails at the first difference instead of returning wrong
+# data. If "realtime" is set, each command takes as long as it did when it was
+# recorded.
+class ReplayTransport(Transport):
+    def __init__(self, path, start=0, realtime=False):
+        self.reader = RecordReader(path)
+        self.metadata = self.reader.metadata
+        self.realtime = realtime
+        self.position = start
+        self._records = self.reader.records(start)
+
+    def execute(self, cdb, data_out, data_in):
+        check_sgio_types(cdb, data_out, data_in)
+        record = next(self._records, None)
+        if record is None:
+            raise TransportError("Replay ran out of recorded commands after {} commands.".format(self.position))
+        if record.cdb != bytes(cdb) or (data_out is not None and record.data_out != bytes(data_out)):
+            raise TransportError("Replay diverged at command {}: recorded CDB {}, got {}.".format(
+                self.position, record.cdb.hex(), bytes(cdb).hex()))
+        self.position += 1
+
+        if self.realtime:
+            time.sleep(record.latency_ns / 1e9)
+
+        record.raise_error()
+
+        if data_in is not None:
+            memoryview(data_in).cast('B')[:len(record.data_in)] = record.data_in
+
+        return record.status
+
+    def close(self):
+        self.reader.close()
+
+def info(args):
+    reader = RecordReader(args.recording)
+    print("Metadata: {}".format(json.dumps(reader.metadata)))
+    count = 0
+    latency_ns = 0
+    for record in reader.records():
+        count += 1
+        latency_ns += record.latency_ns
+    print("{} commands in {} frames, {:.6f} seconds of device time.".format(count, len(reader.index), latency_ns / 1e9))
+    reader.close()
+
+    return 0
+
+def dump(args):
+    reader = RecordReader(args.recording)
+    for n, record in enumerate(reader.records(args.start), args.start):
+        if args.count is not None and n >= args.start + args.count:
+            break
+        line = "{:8d} {:<32} status={:<3} {:>9.1f} us".format(n, record.cdb.hex(), record.status, record.latency_ns / 1e3)
+        if record.flags & FLAG_ERROR_MASK:
+            line += " error: {}".format(record.data_in.decode('utf-8', 'replace'))
+        else:
+            if record.data_out is not None:
+                line += " out: {}".format(record.data_out[:32].hex())
+            if record.flags & FLAG_DATA_IN:
+                line += " in: {}".format(record.data_in[:32].hex())
+        print(line)
+    reader.close()
+
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True, help="Subcommands.")
+
+    parser_info = subparsers.add_parser("info")
+    parser_info.add_argument("recording", help="The recording to summarize.")
+    parser_info.set_defaults(func=info)
+
+    parser_dump = subparsers.add_parser("dump")
+    parser_dump.add_argument("-s", "--start", type=int, default=0, help="The number of the first command to print. Default: 0")
+    parser_dump.add_argument("-n", "--count", type=int, default=None, help="The number of commands to print. Default: all of them")
+    parser_dump.add_argument("recording", help="The recording to print.")
+    parser_dump.set_defaults(func=dump)
+
+    args = parser.parse_args()
+
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
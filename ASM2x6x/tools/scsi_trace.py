@@ -0,0 +1,239 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# scsi_trace.py - Trace and profile the SCSI commands sent by the tools.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+from transport import Transport
+
+
+# The tracer that "operation" reports to, or None if tracing is off.
+_active = None
+_local = threading.local()
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+# Marks a device method as a high-level operation, so the commands it sends are
+# attributed to it. When operations are nested, commands are attributed to the
+# outermost one. When tracing is off, this only costs one extra function call.
+def operation(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = _active
+            if tracer is None:
+                return func(*args, **kwargs)
+
+            stack = _stack()
+            stack.append(name)
+            start_ns = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                end_ns = time.perf_counter_ns()
+                stack.pop()
+                tracer.record_operation(name, start_ns, end_ns, len(stack))
+        return wrapper
+    return decorator
+
+def current_operation():
+    stack = getattr(_local, "stack", None)
+    return stack[0] if stack else None
+
+# Latency histograms use power-of-two buckets of microseconds: bucket N holds
+# latencies from 2**(N-1) up to 2**N microseconds.
+def _bucket(latency_ns):
+    return (latency_ns // 1000).bit_length()
+
+def _bucket_label(bucket):
+    if bucket == 0:
+        return "<1 us"
+    return "{}-{} us".format(1 << (bucket - 1), 1 << bucket)
+
+class Histogram:
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def add(self, latency_ns):
+        self.buckets[_bucket(latency_ns)] += 1
+        self.count += 1
+        self.total_ns += latency_ns
+        if latency_ns > self.max_ns:
+            self.max_ns = latency_ns
+
+    # An estimate of a percentile, from the upper bound of its bucket.
+    def percentile_us(self, fraction):
+        target = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return 1 << bucket
+        return 0
+
+    def export(self):
+        return {
+            "count": self.count,
+            "total_us": self.total_ns / 1e3,
+            "mean_us": self.total_ns / 1e3 / self.count if self.count else 0,
+            "p50_us_max": self.percentile_us(0.5),
+            "p99_us_max": self.percentile_us(0.99),
+            "max_us": self.max_ns / 1e3,
+            "buckets": {_bucket_label(b): n for b, n in sorted(self.buckets.items())},
+        }
+
+class Tracer:
+    # "decode(cdb)" returns the target address of a CDB, or None. If
+    # "keep_records" is false, only the histograms are kept, so the memory
+    # used doesn't grow with the number of commands.
+    def __init__(self, decode=None, keep_records=True):
+        self.decode = decode
+        self.keep_records = keep_records
+        self.by_opcode = collections.defaultdict(Histogram)
+        self.by_operation = collections.defaultdict(Histogram)
+        self.operation_times = collections.defaultdict(Histogram)
+        # (start_ns, end_ns, cdb, direction, length, status, operation, thread)
+        self.commands = []
+        # (name, start_ns, end_ns, depth, thread)
+        self.operations = []
+        self._lock = threading.Lock()
+        self.start_ns = time.perf_counter_ns()
+
+    def install(self):
+        global _active
+        _active = self
+
+    def uninstall(self):
+        global _active
+        if _active is self:
+            _active = None
+
+    def record_command(self, start_ns, end_ns, cdb, data_out, data_in, status, op):
+        if data_out is not None:
+            direction, length = "out", len(data_out)
+        elif data_in is not None:
+            direction, length = "in", len(data_in)
+        else:
+            direction, length = "none", 0
+
+        latency_ns = end_ns - start_ns
+        with self._lock:
+            self.by_opcode[cdb[0]].add(latency_ns)
+            self.by_operation[op or "(none)"].add(latency_ns)
+            if self.keep_records:
+                self.commands.append((start_ns, end_ns, bytes(cdb), direction, length, status, op, threading.get_ident()))
+
+    def record_operation(self, name, start_ns, end_ns, depth):
+        with self._lock:
+            if depth == 0:
+                self.operation_times[name].add(end_ns - start_ns)
+            if self.keep_records:
+                self.operations.append((name, start_ns, end_ns, depth, threading.get_ident()))
+
+    def write_summary(self, stream):
+        def table(title, items):
+            stream.write("{}:\n".format(title))
+            for name, h in items:
+                stream.write("  {:<20} {:>8} calls {:>12.1f} us total {:>10.1f} us mean {:>8} us p99 {:>10.1f} us max\n".format(
+                    name, h.count, h.total_ns / 1e3, h.total_ns / 1e3 / h.count, h.percentile_us(0.99), h.max_ns / 1e3))
+                peak = max(h.buckets.values())
+                for bucket, n in sorted(h.buckets.items()):
+                    stream.write("    {:>16} {:>8} {}\n".format(_bucket_label(bucket), n, "#" * max(1, 40 * n // peak)))
+
+        table("Commands by opcode", (("0x{:02X}".format(opcode), h) for opcode, h in sorted(self.by_opcode.items())))
+        table("Commands by operation", sorted(self.by_operation.items()))
+        table("Operations", sorted(self.operation_times.items()))
+
+    # Exports the records in the Chrome trace event format, which can be opened
+    # in Perfetto or chrome://tracing. Commands are async events, since several
+    # of them can be in flight at once.
+    def export_chrome_trace(self):
+        pid = os.getpid()
+        events = []
+        for name, start_ns, end_ns, depth, thread in self.operations:
+            events.append({
+                "name": name, "cat": "operation", "ph": "X", "pid": pid, "tid": thread,
+                "ts": (start_ns - self.start_ns) / 1e3, "dur": (end_ns - start_ns) / 1e3,
+            })
+        for i, (start_ns, end_ns, cdb, direction, length, status, op, thread) in enumerate(self.commands):
+            address = self.decode(cdb) if self.decode is not None else None
+            args = {
+                "cdb": cdb.hex(),
+                "address": "0x{:x}".format(address) if address is not None else None,
+                "direction": direction,
+                "length": length,
+                "status": status,
+                "operation": op,
+            }
+            name = "0x{:02X}".format(cdb[0])
+            common = {"name": name, "cat": "scsi", "id": i, "pid": pid, "tid": thread}
+            events.append(dict(common, ph="b", ts=(start_ns - self.start_ns) / 1e3, args=args))
+            events.append(dict(common, ph="e", ts=(end_ns - self.start_ns) / 1e3))
+        return {"traceEvents": events, "displayTimeUnit": "ns"}
+
+    def write_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.export_chrome_trace(), f)
+
+# Wraps another transport and records every command sent through it. Queued
+# commands are timed from when they're handed to the inner transport to when
+# their status comes back, so their latency includes time spent in the queue.
+class TracingTransport(Transport):
+    def __init__(self, inner, tracer):
+        self.inner = inner
+        self.tracer = tracer
+
+    def execute(self, cdb, data_out, data_in):
+        op = current_operation()
+        start_ns = time.perf_counter_ns()
+        status = "error"
+        try:
+            status = self.inner.execute(cdb, data_out, data_in)
+            return status
+        finally:
+            self.tracer.record_command(start_ns, time.perf_counter_ns(), cdb, data_out, data_in, status, op)
+
+    def execute_many(self, commands):
+        op = current_operation()
+        pending = collections.deque()
+
+        def submitted():
+            for cdb, data_out, data_in in commands:
+                # Copy the CDB, since the caller may reuse its buffer.
+                pending.append((time.perf_counter_ns(), bytes(cdb), data_out, data_in))
+                yield (cdb, data_out, data_in)
+
+        for status in self.inner.execute_many(submitted()):
+            start_ns, cdb, data_out, data_in = pending.popleft()
+            self.tracer.record_command(start_ns, time.perf_counter_ns(), cdb, data_out, data_in, status, op)
+            yield status
+
+    def close(self):
+        self.inner.close()
@@ -0,0 +1,38 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# conftest.py - Shared fixtures for the ASM2x6x tool tests.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+
+import pytest
+
+# The tools are standalone scripts, not a package, so make them importable.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asm2x6x_sim
+import asm2x6x_tool
+
+
+@pytest.fixture
+def sim():
+    return asm2x6x_sim.Asm2x6xSimulator("ASM2364")
+
+@pytest.fixture
+def dev(sim):
+    return asm2x6x_tool.Asm236x(sim)
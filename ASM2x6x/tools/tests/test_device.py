@@ -0,0 +1,181 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# test_device.py - Tests of the device fast paths against the simulator.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+
+import pytest
+
+import transport
+
+
+# Fails every command, like a device that was unplugged.
+class FailingTransport(transport.Transport):
+    def execute(self, cdb, data_out, data_in):
+        raise transport.TransportError("Device is gone.")
+
+
+def test_readinto_matches_xdata(sim, dev):
+    data = os.urandom(1000)
+    sim.xdata[0x1000:0x1000+len(data)] = data
+
+    for stride in (1, 7, 255):
+        buf = bytearray(len(data))
+        assert dev.readinto(0x1000, buf, stride) == len(data)
+        assert buf == data
+
+def test_readinto_slices_without_queueing(sim, dev):
+    # Without a queue, each chunk is read into a bytearray and copied into the
+    # destination.
+    data = os.urandom(1000)
+    sim.xdata[0x1000:0x1000+len(data)] = data
+
+    buf = bytearray(1200)
+    assert dev.readinto(0x1000, memoryview(buf)[100:1100], 255) == len(data)
+    assert buf == bytes(100) + data + bytes(100)
+
+def test_readinto_uses_one_command_per_stride(sim, dev):
+    buf = bytearray(1000)
+    before = sim.command_counts[0xe4]
+    dev.readinto(0x1000, buf, 255)
+    assert sim.command_counts[0xe4] - before == 4
+
+def test_write_then_read(sim, dev):
+    dev.write(0x2000, b"\x01\x02\x03")
+    assert dev.read(0x2000, 3) == b"\x01\x02\x03"
+    assert sim.xdata[0x2000:0x2003] == b"\x01\x02\x03"
+
+def test_shadow_elides_unchanged_cacheable_writes(sim, dev):
+    dev.enable_shadow()
+
+    dev.write(0xB254, b"\x0f")
+    before = sim.command_counts[0xe5]
+    dev.write(0xB254, b"\x0f")
+    assert sim.command_counts[0xe5] == before
+    assert dev.shadow.elided == 1
+
+    # Volatile registers are always written.
+    dev.write(0xB220, b"\x00")
+    dev.write(0xB220, b"\x00")
+    assert sim.command_counts[0xe5] == before + 2
+
+def test_shadow_forgets_failed_writes(sim, dev):
+    dev.enable_shadow()
+    dev.write(0xB254, b"\x0f")
+
+    dev._transport = FailingTransport()
+    with pytest.raises(transport.TransportError):
+        dev.write(0xB254, b"\x01")
+    dev._transport = sim
+
+    # The failed value must not be treated as written.
+    before = sim.command_counts[0xe5]
+    dev.write(0xB254, b"\x01")
+    assert sim.command_counts[0xe5] == before + 1
+    assert sim.xdata[0xB254] == 0x01
+
+def test_shadow_is_invalidated_by_reload(sim, dev):
+    dev.enable_shadow()
+    dev.write(0xB254, b"\x0f")
+    dev.reload()
+    before = sim.command_counts[0xe5]
+    dev.write(0xB254, b"\x0f")
+    assert sim.command_counts[0xe5] == before + 1
+
+def test_pcie_cfg_read_block_matches_config_space(sim, dev):
+    config = sim.pcie_functions[(0, 0, 0)].config
+    assert dev.pcie_cfg_read_block(0, 64, bus=0, cfgreq_type=0) == bytes(config[:256])
+    assert dev.pcie_cfg_read_block(0x100, 1, bus=0, cfgreq_type=0) == bytes(config[0x100:0x104])
+
+def test_pcie_cfg_read_block_matches_single_requests(dev):
+    block = dev.pcie_cfg_read_block(0x40, 4, bus=0, cfgreq_type=0)
+    for i in range(4):
+        value = dev.pcie_cfg_req(0x40 + 4 * i, bus=0, cfgreq_type=0)
+        assert block[4*i:4*i+4] == value.to_bytes(4, 'little')
+
+def test_pcie_missing_function_raises_unsupported_request(dev):
+    with pytest.raises(transport.PcieCompletionError) as excinfo:
+        dev.pcie_cfg_read_block(0, 1, bus=0, dev=1, cfgreq_type=0)
+    assert excinfo.value.status == transport.PcieCompletionError.UNSUPPORTED_REQUEST
+
+@pytest.mark.parametrize("address", [0x10000, 0x10001, 0x10002, 0x10003, 0x10ffe])
+@pytest.mark.parametrize("length", [0, 1, 2, 3, 4, 5, 9, 1000])
+def test_pcie_mem_write_block_round_trip(dev, address, length):
+    data = os.urandom(length)
+    dev.pcie_mem_write_block(address, data)
+    assert dev.pcie_mem_read_block(address, length) == data
+
+def test_pcie_mem_write_block_leaves_neighbors_alone(dev):
+    dev.pcie_mem_write_block(0x20000, b"\xaa" * 16)
+    dev.pcie_mem_write_block(0x20003, b"\x55" * 9)
+    assert dev.pcie_mem_read_block(0x20000, 16) == b"\xaa" * 3 + b"\x55" * 9 + b"\xaa" * 4
+
+def test_pcie_mem_write_block_only_rewrites_changed_bytes(sim, dev):
+    dev.pcie_mem_write_block(0x30000, bytes(4))
+    before = sim.command_counts[0xe5]
+    dev.pcie_mem_write_block(0x30000, bytes(4096))
+    per_dword = (sim.command_counts[0xe5] - before) / 1024
+    # The data register only has to be written once, and most DWORDs only
+    # change one address byte, so most TLPs cost an address byte and the send.
+    assert per_dword < 3
+
+def test_pcie_mem_read_block_to_stream(sim, dev):
+    data = os.urandom(3 * 4096)
+    for i in range(3):
+        sim.pcie_memory[0x40 + i] = bytearray(data[4096*i:4096*(i+1)])
+
+    class Sink:
+        def __init__(self):
+            self.data = bytearray()
+
+        def write(self, chunk):
+            self.data += chunk
+
+    sink = Sink()
+    assert dev.pcie_mem_read_block(0x40000, len(data), out=sink, flush_len=1024) is None
+    assert sink.data == data
+
+def test_pcie_config_space_caches_and_writes_through(sim, dev):
+    config = dev.pcie_config_space(0, 0, 0)
+    function = sim.pcie_functions[(0, 0, 0)]
+
+    assert config.read_many([(0x00, 2), (0x02, 2), (0x08, 4)]) == [0x144d, 0xa808, 0x01080200]
+    reads = config.dwords_read
+    assert config.read(0x00, 2) == 0x144d
+    assert config.dwords_read == reads
+
+    config.update(0x04, clear=0x6, set=0x6, size=2)
+    assert function.config[0x04] & 0x6 == 0x6
+    assert config.read(0x04, 2) & 0x6 == 0x6
+
+    # Status is volatile, so it's always read from the device.
+    config.read(0x06, 2)
+    function.config[0x06] |= 0x08
+    assert config.read(0x06, 2) & 0x08
+
+def test_sim_rejects_what_sgio_rejects(sim):
+    cdb = bytes.fromhex("e4 04 00 10 00 00")
+    with pytest.raises(TypeError):
+        sim.execute(cdb, None, memoryview(bytearray(4)))
+    with pytest.raises(TypeError):
+        sim.execute(bytes.fromhex("e3 00 00 00 00 04"), memoryview(bytes(4)), None)
+    assert sim.execute(cdb, None, bytearray(4)) == 0
+
+def test_transport_is_abstract():
+    with pytest.raises(TypeError):
+        transport.Transport()
@@ -0,0 +1,106 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# test_dumpio.py - Tests of resumable dumps.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import dumpio
+
+
+LENGTH = 16384
+CHUNK_LEN = 4096
+
+
+def read_zeros(offset, view, stride):
+    view[:] = bytes(len(view))
+
+def test_fresh_dump_truncates_stale_output(tmp_path):
+    path = str(tmp_path / "dump.bin")
+    with open(path, 'wb') as f:
+        f.write(b"\xaa" * LENGTH)
+
+    # "--resume" with no journal starts over.
+    journal = dumpio.Journal(path, {"length": LENGTH}, resume=True)
+    assert not journal.resumed
+    writer = dumpio.DumpWriter(path, LENGTH, progress=False, resume=journal.resumed)
+    dumpio.read_chunks(writer, journal, LENGTH, CHUNK_LEN, 4, read_zeros)
+    writer.close()
+    journal.complete()
+
+    with open(path, 'rb') as f:
+        assert f.read() == bytes(LENGTH)
+
+def test_resume_skips_done_chunks_and_overwrites_the_rest(tmp_path):
+    path = str(tmp_path / "dump.bin")
+    params = {"length": LENGTH}
+
+    journal = dumpio.Journal(path, params)
+    writer = dumpio.DumpWriter(path, LENGTH, progress=False, resume=journal.resumed)
+    writer.write_at(0, b"\x11" * CHUNK_LEN)
+    journal.mark_done(0)
+    writer.close()
+    journal.close()
+
+    # Stale data where the next chunks go.
+    with open(path, 'r+b') as f:
+        f.seek(CHUNK_LEN)
+        f.write(b"\xaa" * (LENGTH - CHUNK_LEN))
+
+    read = []
+    def read_chunk(offset, view, stride):
+        read.append(offset)
+        read_zeros(offset, view, stride)
+
+    journal = dumpio.Journal(path, params, resume=True)
+    assert journal.resumed
+    writer = dumpio.DumpWriter(path, LENGTH, progress=False, resume=journal.resumed)
+    assert dumpio.read_chunks(writer, journal, LENGTH, CHUNK_LEN, 4, read_chunk) == LENGTH - CHUNK_LEN
+    writer.close()
+    journal.complete()
+
+    assert read == [CHUNK_LEN, 2 * CHUNK_LEN, 3 * CHUNK_LEN]
+    with open(path, 'rb') as f:
+        assert f.read() == b"\x11" * CHUNK_LEN + bytes(LENGTH - CHUNK_LEN)
+
+def test_resume_rejects_other_dump(tmp_path):
+    path = str(tmp_path / "dump.bin")
+    dumpio.Journal(path, {"length": LENGTH}).close()
+    try:
+        dumpio.Journal(path, {"length": LENGTH * 2}, resume=True)
+    except dumpio.JournalMismatchError:
+        pass
+    else:
+        assert False, "A journal for a different dump was accepted."
+
+def test_read_chunks_retries_with_smaller_stride(tmp_path):
+    path = str(tmp_path / "dump.bin")
+    journal = dumpio.Journal(path, {})
+    writer = dumpio.DumpWriter(path, CHUNK_LEN, progress=False)
+    strides = []
+    def read_chunk(offset, view, stride):
+        strides.append(stride)
+        if len(strides) == 1:
+            raise OSError("Flaky")
+        view[:] = b"\x22" * len(view)
+
+    class Log:
+        def write(self, s):
+            pass
+
+    dumpio.read_chunks(writer, journal, CHUNK_LEN, CHUNK_LEN, 64, read_chunk, log=Log())
+    writer.close()
+    journal.complete()
+    assert strides == [64, 32]
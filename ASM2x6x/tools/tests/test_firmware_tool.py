@@ -0,0 +1,82 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# test_firmware_tool.py - Tests of the firmware index scanner.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import argparse
+import json
+import os
+import struct
+import zipfile
+import zlib
+
+import firmware_tool
+import fw_image
+
+
+def make_asm2464_image(body, checksum=None, crc=None):
+    if checksum is None:
+        checksum = sum(body) & 0xff
+    if crc is None:
+        crc = zlib.crc32(body)
+    return struct.pack('<I', len(body)) + body + struct.pack('<BBI', fw_image.ASM2464_MAGIC, checksum, crc)
+
+def test_scan_type_asm2464():
+    body = os.urandom(0x100)
+    assert firmware_tool.scan_type(make_asm2464_image(body)) == "asm2464"
+
+def test_scan_type_asm2464_one_bad_check():
+    # Corrupted images are still indexed, as long as one of the checks passes.
+    body = os.urandom(0x100)
+    crc = zlib.crc32(body)
+    assert firmware_tool.scan_type(make_asm2464_image(body, crc=crc ^ 1)) == "asm2464"
+    assert firmware_tool.scan_type(make_asm2464_image(body, checksum=(sum(body) + 1) & 0xff)) == "asm2464"
+
+def test_scan_type_rejects_magic_only():
+    # A length and a magic byte in the right place isn't enough.
+    body = os.urandom(0x100)
+    data = make_asm2464_image(body, checksum=(sum(body) + 1) & 0xff, crc=zlib.crc32(body) ^ 1)
+    assert firmware_tool.scan_type(data) is None
+
+def test_scan_type_rejects_empty_body():
+    assert firmware_tool.scan_type(struct.pack('<I', 0) + bytes([fw_image.ASM2464_MAGIC]) + bytes(5)) is None
+
+def test_scan_skips_unreadable_files(tmp_path, capsys):
+    corpus = tmp_path / "corpus"
+    corpus.mkdir()
+    (corpus / "good.bin").write_bytes(make_asm2464_image(os.urandom(0x100)))
+
+    # A zip archive with a corrupted central directory.
+    with zipfile.ZipFile(corpus / "bad.zip", 'w') as zf:
+        zf.writestr("fw.bin", b"\x00" * 16)
+    data = bytearray((corpus / "bad.zip").read_bytes())
+    central = data.rindex(b"PK\x01\x02")
+    data[central:central+4] = b"XXXX"
+    (corpus / "bad.zip").write_bytes(data)
+
+    entries, error = firmware_tool.index_file(str(corpus / "bad.zip"))
+    assert entries == [] and "BadZipFile" in error
+
+    index_path = str(tmp_path / "index.json")
+    args = argparse.Namespace(index=index_path, firmware=[str(corpus)], jobs=1)
+    assert firmware_tool.scan(args) == 0
+    assert "bad.zip" in capsys.readouterr().err
+
+    with open(index_path) as f:
+        index = json.load(f)
+    assert len(index["images"]) == 1
+    assert list(index["files"]) == [str(corpus / "good.bin")]
@@ -0,0 +1,159 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# test_flash.py - Tests of flash comparison and incremental updates.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import mmap
+import os
+
+import asm2x6x_sim
+import asm2x6x_tool
+
+
+def test_find_mismatches_equal():
+    data = os.urandom(10000)
+    assert asm2x6x_tool.find_mismatches(data, bytes(data)) == []
+
+def test_find_mismatches_ranges():
+    expected = bytearray(20000)
+    actual = bytearray(expected)
+    actual[5] = 1
+    actual[4096] = 1
+    actual[4100] = 1
+    actual[19999] = 1
+
+    assert asm2x6x_tool.find_mismatches(expected, actual) == [
+        [5, 6, 1],
+        [4096, 4101, 2],
+        [19999, 20000, 1],
+    ]
+
+def test_find_mismatches_merge_gap():
+    expected = bytes(100)
+    actual = bytearray(expected)
+    actual[10] = 1
+    actual[40] = 1
+    assert len(asm2x6x_tool.find_mismatches(expected, actual, merge_gap=16)) == 2
+    assert asm2x6x_tool.find_mismatches(expected, actual, merge_gap=64) == [[10, 41, 2]]
+
+def test_flash_read_matches_flash(sim, dev):
+    sim.flash[0x1000:0x3000] = os.urandom(0x2000)
+    assert dev.flash_read(0x1000, 0x2000, stride=128) == bytes(sim.flash[0x1000:0x3000])
+
+def test_flash_dump_into_mmap(sim, dev):
+    sim.flash[:0x2000] = os.urandom(0x2000)
+    with mmap.mmap(-1, 0x2000) as buf:
+        assert dev.flash_dump_into(buf) == 0x2000
+        assert buf[:] == sim.flash[:0x2000]
+
+def test_asm246x_flash_dump_into_view(monkeypatch):
+    monkeypatch.setattr(asm2x6x_tool.time, "sleep", lambda seconds: None)
+    sim = asm2x6x_sim.Asm2x6xSimulator("ASM2464")
+    dev = asm2x6x_tool.Asm246x(sim)
+    sim.flash[:0x18000] = os.urandom(0x18000)
+
+    buf = bytearray(0x18100)
+    assert dev.flash_dump_into(memoryview(buf)[0x100:]) == 0x18000
+    assert buf[0x100:] == sim.flash[:0x18000]
+    assert sim.command_counts[0xe2] == 2
+
+def test_flash_reader_dumps_the_start_once(sim, dev):
+    sim.flash[:0x2000] = os.urandom(0x2000)
+    read = asm2x6x_tool.flash_reader(dev)
+
+    assert read(0, 0x82) == sim.flash[:0x82]
+    assert read(0x282, 6) == sim.flash[0x282:0x288]
+    assert read(0xff0, 0x10) == sim.flash[0xff0:0x1000]
+    assert sim.command_counts[0xe2] == 1
+
+    assert read(0x1800, 0x20) == sim.flash[0x1800:0x1820]
+    assert sim.command_counts[0xe2] == 1
+
+def test_flash_matches_firmware(sim, dev):
+    import fw_image
+
+    body = fw_image.build_body(os.urandom(0x3000), 0x4b)
+    config = bytearray(fw_image.Config.blank().data)
+    sim.flash[4:0x80] = config[4:]
+    sim.flash[0x80:0x80+len(body)] = body
+    assert asm2x6x_tool.flash_matches_firmware(dev, config, body)
+    assert sim.command_counts[0xe2] == 1
+
+    changed = bytearray(body)
+    changed[0x2000] ^= 0xff
+    assert not asm2x6x_tool.flash_matches_firmware(dev, config, changed, check="full")
+
+def test_fw_write_image_file(sim, dev, tmp_path):
+    import argparse
+    import fw_image
+
+    body = fw_image.build_body(os.urandom(0x3000), 0x4b)
+    path = tmp_path / "fw.bin"
+    path.write_bytes(bytes(fw_image.Config.blank().data) + body)
+
+    args = argparse.Namespace(fw_file=str(path), raw=False, force=False, check="sample")
+    assert asm2x6x_tool.fw_write(args, dev) == 0
+    assert sim.command_counts[0xe3] == 1
+    assert sim.flash[0x80:0x80+len(body)] == body
+
+    # The flash now holds the image, so it isn't written again.
+    assert asm2x6x_tool.fw_write(args, dev) == 0
+    assert sim.command_counts[0xe3] == 1
+
+def make_flash_image(length=0x10000):
+    import fw_image
+
+    body = fw_image.build_body(os.urandom(0x3000), 0x4b)
+    image = bytearray(length)
+    image[:0x80] = fw_image.Config.blank().data
+    image[0x80:0x80+len(body)] = body
+    return image
+
+def flash_update_args(tmp_path, image, **kwargs):
+    import argparse
+
+    path = tmp_path / "previous.bin"
+    path.write_bytes(image)
+    args = dict(previous=str(path), previous_manifest=None, block_size=0x1000, stride=128, fast=False,
+        output=str(tmp_path / "updated.bin"), delta=None, manifest=None)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+def test_flash_update_dumps_once(sim, dev, tmp_path):
+    image = make_flash_image()
+    sim.flash[:len(image)] = image
+    sim.flash[0x9000] ^= 0xff
+
+    e4_before = sim.command_counts[0xe4]
+    assert asm2x6x_tool.flash_update(flash_update_args(tmp_path, image), dev) == 0
+    assert sim.command_counts[0xe2] == 1
+    assert sim.command_counts[0xe4] == e4_before
+    assert (tmp_path / "updated.bin").read_bytes() == sim.flash[:len(image)]
+
+def test_flash_update_fast_reads_priority_blocks(sim, dev, tmp_path):
+    import flash_manifest
+
+    image = make_flash_image()
+    sim.flash[:len(image)] = image
+    sim.flash[0x9000] ^= 0xff
+
+    args = flash_update_args(tmp_path, image, fast=True, manifest=str(tmp_path / "manifest.json"))
+    assert asm2x6x_tool.flash_update(args, dev) == 0
+    assert sim.command_counts[0xe2] == 0
+    # The change is outside of the priority blocks, so it isn't seen.
+    assert (tmp_path / "updated.bin").read_bytes() == image
+    assert flash_manifest.load(args.manifest)["blocks"][9] is None
@@ -0,0 +1,62 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# test_fleet.py - Tests of the fleet mode scheduler.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import threading
+
+import asm2x6x_tool
+
+
+def test_busy_hub_does_not_block_other_hubs():
+    targets = [("a0", "hub-a", "a0"), ("a1", "hub-a", "a1"), ("b0", "hub-b", "b0")]
+    released = threading.Event()
+
+    def run(target):
+        label, hub, _ = target
+        if hub == "hub-b":
+            released.set()
+            return label
+        # "a1" can't start until "a0" is done, but "b0" can, and it lets "a0"
+        # finish.
+        return released.wait(5)
+
+    results = asm2x6x_tool.run_per_hub(targets, run, jobs=2, per_hub=1, cancel_event=threading.Event())
+    assert results == [True, True, "b0"]
+
+def test_per_hub_limit():
+    targets = [("a{}".format(i), "hub-a", None) for i in range(6)] + [("sim{}".format(i), "unknown", None) for i in range(4)]
+    lock = threading.Lock()
+    running = {"hub-a": 0, "unknown": 0}
+    peak = {"hub-a": 0, "unknown": 0}
+    barrier = threading.Barrier(2, timeout=5)
+
+    def run(target):
+        hub = target[1]
+        with lock:
+            running[hub] += 1
+            peak[hub] = max(peak[hub], running[hub])
+        if hub == "unknown":
+            # Two unknown-hub devices run at once, next to the hub-a ones.
+            barrier.wait()
+        with lock:
+            running[hub] -= 1
+        return target[0]
+
+    results = asm2x6x_tool.run_per_hub(targets, run, jobs=4, per_hub=2, cancel_event=threading.Event())
+    assert results == [label for label, _, _ in targets]
+    assert peak["hub-a"] <= 2
@@ -0,0 +1,93 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# test_fw_image.py - Tests of the in-place firmware image model.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import struct
+import zlib
+
+import pytest
+
+import fw_image
+
+
+def make_asm236x_image(code_len=0x400):
+    config = fw_image.Config.blank()
+    body = fw_image.build_body(os.urandom(code_len), 0x4b)
+    return bytearray(config.data) + body
+
+def test_blank_config_checksum():
+    assert fw_image.Config.blank().checksum_ok()
+
+def test_config_set_keeps_checksum_valid():
+    image = fw_image.Asm236xImage(make_asm236x_image())
+    config = image.config
+
+    config.set("serial_number", "0123456789")
+    config.set("id_vendor", 0x174c)
+    config.set("pcie_lane", 2)
+    config.set("disable_eup", 1)
+
+    assert config.checksum == config.calculated_checksum()
+    assert config.get("serial_number") == "0123456789"
+    assert config.get("id_vendor") == 0x174c
+    assert config.get("pcie_lane") == 2
+    assert config.get("disable_eup") == 1
+
+def test_config_set_rejects_bad_values():
+    config = fw_image.Config.blank()
+    with pytest.raises(ValueError):
+        config.set("pcie_lane", 4)
+    with pytest.raises(ValueError):
+        config.set("t10_manufacturer_string", "x" * 9)
+
+def test_body_patch_keeps_checksum_valid():
+    data = make_asm236x_image()
+    image = fw_image.Asm236xImage(data)
+    assert image.body.checksum_ok()
+
+    image.body.set_version(bytes.fromhex("230101000000"))
+    image.body.patch(0x10, os.urandom(32))
+
+    assert image.body.checksum_ok()
+    assert image.body.version == bytes.fromhex("230101000000")
+    # Edits go straight into the buffer.
+    assert data[fw_image.CONFIG_LEN+2+0x200:fw_image.CONFIG_LEN+2+0x206] == bytes.fromhex("230101000000")
+
+def test_body_patch_bounds():
+    image = fw_image.Asm236xImage(make_asm236x_image(0x100))
+    with pytest.raises(ValueError):
+        image.body.patch(0xff, b"\x00\x00")
+
+def test_asm2464_patch_updates_checksum_and_crc():
+    body = os.urandom(0x1000)
+    data = bytearray(struct.pack('<I', len(body)) + body + struct.pack('<BBI', fw_image.ASM2464_MAGIC, sum(body) & 0xff, zlib.crc32(body)))
+    image = fw_image.Asm2464Image(data)
+    assert image.checksum_ok() and image.crc_ok()
+
+    image.patch(0x123, b"\x01\x02\x03")
+    assert image.checksum_ok() and image.crc_ok()
+
+def test_read_flash_fields_matches_image():
+    data = make_asm236x_image()
+    image = fw_image.Asm236xImage(data)
+    config, code_size, version, trailer = fw_image.read_flash_fields(lambda offset, length: data[offset:offset+length])
+    assert config == bytes(image.config.data)
+    assert code_size == image.body.size
+    assert version == image.body.version
+    assert trailer == bytes([image.body.magic, image.body.checksum])
@@ -0,0 +1,62 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# test_memmap.py - Tests of the XDATA memory map prober.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import argparse
+
+import asm2x6x_tool
+import xdata_map
+
+
+def memmap_args(**kwargs):
+    args = dict(size=None, read_only=False, page_size=xdata_map.PAGE_SIZE, probe_offset=None, exclude=[],
+        write_known=False, chip=None, output=None)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+def record_writes(sim, monkeypatch):
+    written = []
+    xdata_write = sim.xdata_write
+    def write(addr, value):
+        written.append(addr)
+        xdata_write(addr, value)
+    monkeypatch.setattr(sim, "xdata_write", write)
+    return written
+
+def in_ranges(addr, ranges):
+    return any(start <= addr < end for start, end in ranges)
+
+def test_memmap_leaves_known_ram_and_mmio_alone(sim, dev, monkeypatch):
+    written = record_writes(sim, monkeypatch)
+    assert asm2x6x_tool.memmap(memmap_args(), dev) == 0
+
+    protected = xdata_map.protected_ranges(xdata_map.ASM2364_MAP)
+    assert written
+    assert not any(in_ranges(addr, protected) for addr in written)
+
+def test_memmap_write_known(sim, dev, monkeypatch):
+    written = record_writes(sim, monkeypatch)
+    assert asm2x6x_tool.memmap(memmap_args(write_known=True), dev) == 0
+    protected = xdata_map.protected_ranges(xdata_map.ASM2364_MAP)
+    assert any(in_ranges(addr, protected) for addr in written)
+
+def test_probe_classifies_excluded_pages_by_contents(sim, dev):
+    sim.xdata[0x0000:0x0100] = bytes(range(256))
+    regions = xdata_map.probe(dev, 0x10000, exclude=[(0x0000, 0x1000)])
+    assert regions[0] == (0x0000, 0x0100, xdata_map.UNPROBED, None)
+    assert (0x0100, 0x0700, xdata_map.ZERO, None) in regions
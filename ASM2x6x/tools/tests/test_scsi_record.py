@@ -0,0 +1,136 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# test_scsi_record.py - Tests of recording and replaying SCSI sessions.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+import asm2x6x_sim
+import asm2x6x_tool
+import scsi_record
+import transport
+
+
+def session(dev):
+    version = dev.get_fw_version_data()
+    dev.write(0x2000, b"\x12\x34")
+    data = dev.read(0x2000, 2)
+    dev.pcie_mem_write_block(0x1000, b"\x01\x02\x03\x04\x05")
+    mem = dev.pcie_mem_read_block(0x1000, 5)
+    cfg = dev.pcie_cfg_read_block(0, 4, bus=0, cfgreq_type=0)
+    return (version, data, mem, cfg)
+
+def test_record_replay_round_trip(tmp_path):
+    path = str(tmp_path / "session.rec")
+
+    recorder = scsi_record.RecordingTransport(asm2x6x_sim.Asm2x6xSimulator("ASM2364"), path, {"device": "sim"})
+    recorded = session(asm2x6x_tool.Asm236x(recorder))
+    recorder.close()
+
+    replay = scsi_record.ReplayTransport(path)
+    assert replay.metadata == {"device": "sim"}
+    assert session(asm2x6x_tool.Asm236x(replay)) == recorded
+
+    # Nothing is left over.
+    with pytest.raises(transport.TransportError):
+        replay.execute(bytes(16), None, None)
+    replay.close()
+
+def test_replay_spans_frames(tmp_path):
+    path = str(tmp_path / "long.rec")
+    sim = asm2x6x_sim.Asm2x6xSimulator("ASM2364")
+    sim.xdata[0x1000:0x2000] = os.urandom(0x1000)
+
+    recorder = scsi_record.RecordingTransport(sim, path)
+    expected = asm2x6x_tool.Asm236x(recorder).read(0x1000, 0x1000, stride=1)
+    recorder.close()
+
+    reader = scsi_record.RecordReader(path)
+    assert len(reader.index) > 1
+    reader.close()
+
+    replay = scsi_record.ReplayTransport(path)
+    assert asm2x6x_tool.Asm236x(replay).read(0x1000, 0x1000, stride=1) == expected
+    replay.close()
+
+def test_replay_detects_divergence(tmp_path):
+    path = str(tmp_path / "session.rec")
+    recorder = scsi_record.RecordingTransport(asm2x6x_sim.Asm2x6xSimulator("ASM2364"), path)
+    asm2x6x_tool.Asm236x(recorder).read(0x2000, 1)
+    recorder.close()
+
+    replay = scsi_record.ReplayTransport(path)
+    with pytest.raises(transport.TransportError):
+        asm2x6x_tool.Asm236x(replay).read(0x3000, 1)
+    replay.close()
+
+def test_replay_reproduces_errors(tmp_path):
+    path = str(tmp_path / "error.rec")
+    recorder = scsi_record.RecordingTransport(asm2x6x_sim.Asm2x6xSimulator("ASM2364"), path)
+    with pytest.raises(transport.CheckConditionError):
+        recorder.execute(bytes([0xff]) + bytes(15), None, None)
+    recorder.close()
+
+    replay = scsi_record.ReplayTransport(path)
+    with pytest.raises(transport.CheckConditionError):
+        replay.execute(bytes([0xff]) + bytes(15), None, None)
+    replay.close()
+
+def test_partial_frames_are_flushed(tmp_path):
+    path = str(tmp_path / "session.rec")
+    writer = scsi_record.RecordWriter(path, flush_interval=0.01)
+    for i in range(3):
+        writer.write(bytes([0xe4, 1, 0, 0, i, 0]), None, bytearray(1), 0, 1000)
+
+    # Without closing the writer, like a session that hung.
+    count = 0
+    for _ in range(200):
+        reader = scsi_record.RecordReader(path)
+        count = len(list(reader.records()))
+        reader.close()
+        if count == 3:
+            break
+        time.sleep(0.01)
+    assert count == 3
+    writer.close()
+
+def test_recording_is_closed_on_sigterm(tmp_path):
+    path = str(tmp_path / "session.rec")
+    script = """
+import os, signal, sys, time
+sys.path.insert(0, {tools!r})
+import asm2x6x_sim, asm2x6x_tool, scsi_record
+scsi_record.exit_on_signals()
+transport = scsi_record.RecordingTransport(asm2x6x_sim.Asm2x6xSimulator("ASM2364"), {path!r})
+asm2x6x_tool.Asm236x(transport).read(0x2000, 16)
+os.kill(os.getpid(), signal.SIGTERM)
+time.sleep(10)
+""".format(tools=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), path=path)
+    result = subprocess.run([sys.executable, "-c", script], timeout=10)
+    assert result.returncode == 128 + signal.SIGTERM
+
+    with open(path, 'rb') as f:
+        assert f.read()[-4:] == b"ASMI"
+    reader = scsi_record.RecordReader(path)
+    assert len(list(reader.records())) == 1
+    reader.close()
@@ -0,0 +1,90 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# test_server.py - Tests of the device server.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import asm2x6x_server
+import asm2x6x_tool
+
+
+def serve_args(socket_path):
+    return argparse.Namespace(socket=str(socket_path), device=["sim:ASM2364"], queue_depth=8, shadow_regs=False)
+
+def test_serve_refuses_live_socket(tmp_path):
+    path = tmp_path / "live.sock"
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(str(path))
+    listener.listen(1)
+    try:
+        assert asm2x6x_server.socket_in_use(str(path))
+        assert asm2x6x_server.serve(serve_args(path)) == 1
+        assert path.exists()
+    finally:
+        listener.close()
+
+def test_serve_refuses_non_socket(tmp_path):
+    path = tmp_path / "file"
+    path.write_bytes(b"keep me")
+    assert asm2x6x_server.serve(serve_args(path)) == 1
+    assert path.read_bytes() == b"keep me"
+
+def test_stale_socket_not_in_use(tmp_path):
+    path = tmp_path / "stale.sock"
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(str(path))
+    sock.close()
+    assert not asm2x6x_server.socket_in_use(str(path))
+
+def test_client_requires_op(tmp_path, capsys):
+    path = tmp_path / "server.sock"
+    dev = asm2x6x_tool.get_asm2x6x_dev("sim:ASM2364", 8)
+    handles = {"dev0": asm2x6x_server.DeviceHandle("dev0", "sim:ASM2364", dev)}
+    server = asm2x6x_server.Asm2x6xServer(str(path), handles)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        args = argparse.Namespace(socket=str(path), target=None, request=['{"address": 1024}', '{"op": "read", "address": 1024, "length": 2}'])
+        assert asm2x6x_server.client(args) == 1
+        out, err = capsys.readouterr()
+        assert "\"op\" key" in err
+        assert json.loads(out)["data"] == dev.read(1024, 2).hex()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_client_does_not_load_the_tool():
+    tools = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = "import sys; sys.path.insert(0, {!r}); import asm2x6x_server; print('asm2x6x_tool' in sys.modules)".format(tools)
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "False"
+
+def test_repl_parse_pcie_address():
+    assert asm2x6x_server.parse_pcie_address("10") == (0x10, 4)
+    assert asm2x6x_server.parse_pcie_address("6.w") == (0x6, 2)
+    assert asm2x6x_server.parse_pcie_address("f.B") == (0xf, 1)
+    with pytest.raises(ValueError):
+        asm2x6x_server.parse_pcie_address("10.q")
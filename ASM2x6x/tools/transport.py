@@ -0,0 +1,273 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# transport.py - SCSI command transports for the ASM2x6x and RTL921x tools.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import abc
+import ctypes
+import os
+import select
+import sys
+
+try:
+    import sgio
+except ModuleNotFoundError:
+    sgio = None
+
+
+if sgio is not None:
+    CheckConditionError = sgio.CheckConditionError
+else:
+    class CheckConditionError(Exception):
+        pass
+
+
+def require_sgio():
+    if sgio is None:
+        sys.stderr.write("Error: Failed to import \"sgio\". Please install \"cython-sgio\", then try running this script again.\n")
+        sys.exit(1)
+
+
+# Raises the TypeError that "sgio.execute" raises for arguments it doesn't
+# accept, so simulated transports only take what a real device would.
+def check_sgio_types(cdb, data_out, data_in):
+    for value in (cdb, data_out):
+        if value is not None and not isinstance(value, (bytes, bytearray)):
+            raise TypeError("expected bytes, {} found".format(type(value).__name__))
+    if data_in is not None and not isinstance(data_in, bytearray):
+        raise TypeError("Argument 'data_in' has incorrect type (expected bytearray, got {})".format(type(data_in).__name__))
+
+
+class TransportError(Exception):
+    pass
+
+# A PCIe request got a completion with an unsuccessful status, or one that
+# doesn't match the request. "status" is the 3-bit Completion Status field.
+class PcieCompletionError(Exception):
+    UNSUPPORTED_REQUEST = 0b001
+    RETRY_STATUS = 0b010
+    COMPLETER_ABORT = 0b100
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+# Device classes send all of their commands through a Transport instead of
+# calling SG_IO directly, so the same code can run against a real bridge, the
+# simulator in "asm2x6x_sim.py", or anything else that can answer CDBs.
+class Transport(abc.ABC):
+    # Send one CDB. "data_out" is the payload to send (or None), and "data_in"
+    # is a bytearray to receive data into (or None). Like "sgio.execute", the
+    # CDB and "data_out" must be bytes or a bytearray. Returns the SCSI status,
+    # which is zero on success.
+    @abc.abstractmethod
+    def execute(self, cdb, data_out, data_in):
+        pass
+
+    # Send a sequence of (cdb, data_out, data_in) commands, yielding the status
+    # of each one in order. Unlike "execute", the data can be in any buffer,
+    # including memoryview slices of a larger one. Transports that can keep
+    # several commands in flight do so, but a command is always taken from
+    # "commands" before the next one is requested, so callers may reuse a CDB
+    # buffer between them.
+    def execute_many(self, commands):
+        for cdb, data_out, data_in in commands:
+            if data_out is not None and not isinstance(data_out, (bytes, bytearray)):
+                data_out = bytes(data_out)
+            if data_in is None or isinstance(data_in, bytearray):
+                yield self.execute(cdb, data_out, data_in)
+                continue
+            # "execute" only reads into a bytearray, so other buffers are
+            # filled from a copy.
+            scratch = bytearray(len(memoryview(data_in).cast('B')))
+            status = self.execute(cdb, data_out, scratch)
+            memoryview(data_in).cast('B')[:] = scratch
+            yield status
+
+    def close(self):
+        pass
+
+# From <scsi/sg.h>
+SG_DXFER_NONE = -1
+SG_DXFER_TO_DEV = -2
+SG_DXFER_FROM_DEV = -3
+
+SCSI_STATUS_CHECK_CONDITION = 0x02
+SG_DRIVER_SENSE = 0x08
+
+SG_MAX_QUEUE = 16
+
+class SgIoHdr(ctypes.Structure):
+    _fields_ = [
+        ("interface_id", ctypes.c_int),
+        ("dxfer_direction", ctypes.c_int),
+        ("cmd_len", ctypes.c_ubyte),
+        ("mx_sb_len", ctypes.c_ubyte),
+        ("iovec_count", ctypes.c_ushort),
+        ("dxfer_len", ctypes.c_uint),
+        ("dxferp", ctypes.c_void_p),
+        ("cmdp", ctypes.c_void_p),
+        ("sbp", ctypes.c_void_p),
+        ("timeout", ctypes.c_uint),
+        ("flags", ctypes.c_uint),
+        ("pack_id", ctypes.c_int),
+        ("usr_ptr", ctypes.c_void_p),
+        ("status", ctypes.c_ubyte),
+        ("masked_status", ctypes.c_ubyte),
+        ("msg_status", ctypes.c_ubyte),
+        ("sb_len_wr", ctypes.c_ubyte),
+        ("host_status", ctypes.c_ushort),
+        ("driver_status", ctypes.c_ushort),
+        ("resid", ctypes.c_int),
+        ("duration", ctypes.c_uint),
+        ("info", ctypes.c_uint),
+    ]
+
+# Submits commands with the asynchronous write()/read() interface of the Linux
+# sg v3 driver, keeping up to "depth" of them outstanding on the same fd.
+class SgQueue:
+    def __init__(self, fd, depth=8, timeout_ms=60000):
+        assert 0 < depth <= SG_MAX_QUEUE
+        self._fd = fd
+        self._depth = depth
+        self._timeout_ms = timeout_ms
+        self._poll = select.poll()
+        self._poll.register(fd, select.POLLIN)
+        self._next_id = 0
+        # pack_id -> (header, buffers to keep alive until completion)
+        self._pending = {}
+        self._done = {}
+
+    def _submit(self, cdb, data_out, data_in):
+        hdr = SgIoHdr()
+        hdr.interface_id = ord('S')
+        hdr.timeout = self._timeout_ms
+        hdr.pack_id = self._next_id
+        self._next_id = (self._next_id + 1) & 0x7fffffff
+
+        cmd_buf = ctypes.create_string_buffer(bytes(cdb), len(cdb))
+        hdr.cmd_len = len(cdb)
+        hdr.cmdp = ctypes.addressof(cmd_buf)
+
+        sense_buf = ctypes.create_string_buffer(32)
+        hdr.mx_sb_len = len(sense_buf)
+        hdr.sbp = ctypes.addressof(sense_buf)
+
+        data_buf = None
+        hdr.dxfer_direction = SG_DXFER_NONE
+        if data_out is not None and len(data_out):
+            data_buf = ctypes.create_string_buffer(bytes(data_out), len(data_out))
+            hdr.dxfer_direction = SG_DXFER_TO_DEV
+            hdr.dxfer_len = len(data_out)
+            hdr.dxferp = ctypes.addressof(data_buf)
+        elif data_in is not None and len(data_in):
+            # The kernel writes straight into the caller's buffer.
+            data_buf = (ctypes.c_char * len(data_in)).from_buffer(data_in)
+            hdr.dxfer_direction = SG_DXFER_FROM_DEV
+            hdr.dxfer_len = len(data_in)
+            hdr.dxferp = ctypes.addressof(data_buf)
+
+        os.write(self._fd, hdr)
+        self._pending[hdr.pack_id] = (hdr, (cmd_buf, sense_buf, data_buf))
+        return hdr.pack_id
+
+    def _reap(self):
+        while True:
+            try:
+                raw = os.read(self._fd, ctypes.sizeof(SgIoHdr))
+                break
+            except BlockingIOError:
+                self._poll.poll()
+        hdr = SgIoHdr.from_buffer_copy(raw)
+        _, (_, sense_buf, _) = self._pending.pop(hdr.pack_id)
+        self._done[hdr.pack_id] = (hdr, sense_buf.raw[:hdr.sb_len_wr])
+
+    def _status(self, pack_id):
+        while pack_id not in self._done:
+            self._reap()
+        hdr, sense = self._done.pop(pack_id)
+        if hdr.status == SCSI_STATUS_CHECK_CONDITION or hdr.driver_status & SG_DRIVER_SENSE:
+            raise CheckConditionError(sense)
+        if hdr.host_status or (hdr.driver_status & ~SG_DRIVER_SENSE):
+            raise TransportError("SG_IO failed: host_status=0x{:x}, driver_status=0x{:x}".format(
+                hdr.host_status, hdr.driver_status))
+        return hdr.status
+
+    def drain(self):
+        # Wait for every outstanding command so no buffer is still in use.
+        while self._pending:
+            self._reap()
+        self._done.clear()
+
+    def run(self, commands):
+        in_flight = []
+        try:
+            for cdb, data_out, data_in in commands:
+                in_flight.append(self._submit(cdb, data_out, data_in))
+                if len(in_flight) >= self._depth:
+                    yield self._status(in_flight.pop(0))
+            while in_flight:
+                yield self._status(in_flight.pop(0))
+        finally:
+            self.drain()
+
+# Wraps another transport and counts the commands and bytes sent through it.
+class CountingTransport(Transport):
+    def __init__(self, inner):
+        self.inner = inner
+        self.commands = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _count(self, cdb, data_out, data_in):
+        self.commands += 1
+        if data_out is not None:
+            self.bytes_out += len(data_out)
+        if data_in is not None:
+            self.bytes_in += len(data_in)
+
+    def execute(self, cdb, data_out, data_in):
+        self._count(cdb, data_out, data_in)
+        return self.inner.execute(cdb, data_out, data_in)
+
+    def execute_many(self, commands):
+        def counted():
+            for command in commands:
+                self._count(*command)
+                yield command
+        return self.inner.execute_many(counted())
+
+    def close(self):
+        self.inner.close()
+
+class SgioTransport(Transport):
+    def __init__(self, dev_path, queue_depth=8):
+        require_sgio()
+        self._file = os.fdopen(os.open(dev_path, os.O_RDWR | os.O_NONBLOCK))
+        self.queue_depth = queue_depth
+
+    def execute(self, cdb, data_out, data_in):
+        return sgio.execute(self._file, cdb, data_out, data_in)
+
+    def execute_many(self, commands):
+        if self.queue_depth <= 1:
+            return super().execute_many(commands)
+        return SgQueue(self._file.fileno(), self.queue_depth).run(commands)
+
+    def close(self):
+        self._file.close()
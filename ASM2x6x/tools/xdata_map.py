@@ -0,0 +1,274 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# xdata_map.py - XDATA memory maps of ASM2x6x chips, and a prober to find them.
+# Copyright (C) 2022-2024  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import json
+import struct
+
+
+RAM = "ram"
+ROM = "rom"
+ZERO = "zero"
+MMIO = "mmio"
+UNPROBED = "unprobed"
+
+# How each region is filled in by a map-driven dump.
+READ = "read"
+SYNTHESIZED = "synthesized"
+COPIED = "copied"
+SKIPPED = "skipped"
+
+PAGE_SIZE = 0x100
+
+# The XDATA memory map of the ASM2364, from "doc/Notes.md". Each entry is
+# (start, end, kind, mirror_of), where "end" is exclusive and "mirror_of" is
+# the start address of the region this one mirrors (or None).
+ASM2364_MAP = (
+    (0x0000, 0x6000, RAM, None),
+    (0x6000, 0x7000, ZERO, None),
+    (0x7000, 0x8000, RAM, None),  # SPI flash controller read/write buffer
+    (0x8000, 0x9000, RAM, None),
+    (0x9000, 0x9400, MMIO, None),
+    (0x9400, 0x9800, MMIO, 0x9000),
+    (0x9800, 0x9C00, MMIO, 0x9000),
+    (0x9C00, 0x9E00, MMIO, 0x9000),
+    (0x9E00, 0xA000, RAM, None),
+    (0xA000, 0xB000, RAM, None),
+    (0xB000, 0xB200, RAM, None),
+    (0xB200, 0xB800, MMIO, None),  # PCIe
+    (0xB800, 0xC000, RAM, None),
+    (0xC000, 0xD000, MMIO, None),  # UART, flash controller, timers, etc.
+    (0xD000, 0xD400, RAM, None),
+    (0xD400, 0xD800, RAM, 0xD000),
+    (0xD800, 0xE000, RAM, None),
+    (0xE000, 0xE300, RAM, 0xD800),
+    (0xE300, 0xE800, MMIO, None),
+    (0xE800, 0xEA00, RAM, None),
+    (0xEA00, 0xEC00, RAM, 0xE800),
+    (0xEC00, 0xEE00, RAM, 0xE800),
+    (0xEE00, 0xF000, RAM, 0xE800),
+    (0xF000, 0x10000, RAM, None),
+)
+
+BUILTIN_MAPS = {
+    "ASM2364": (0x10000, ASM2364_MAP),
+}
+
+# The (start, end) ranges of the RAM and MMIO regions in a map. The RAM holds
+# the running firmware's variables and the MMIO regions are hardware registers,
+# so "probe" only writes to them when asked to.
+def protected_ranges(regions):
+    return [(start, end) for start, end, kind, _ in regions if kind in (RAM, MMIO)]
+
+
+def to_json(chip, size, regions, page_size=PAGE_SIZE):
+    return {
+        "chip": chip,
+        "size": size,
+        "page_size": page_size,
+        "regions": [{"start": start, "end": end, "kind": kind, "mirror_of": mirror_of} for start, end, kind, mirror_of in regions],
+    }
+
+def from_json(data):
+    return [(r["start"], r["end"], r["kind"], r["mirror_of"]) for r in data["regions"]]
+
+def load(path):
+    with open(path, 'r') as f:
+        return from_json(json.load(f))
+
+def save(path, chip, size, regions, page_size=PAGE_SIZE):
+    with open(path, 'w') as f:
+        json.dump(to_json(chip, size, regions, page_size), f, indent=2)
+        f.write("\n")
+
+# Loads a map from a JSON file written by "memmap", or returns a built-in map if
+# "name" is the name of a chip that has one.
+def load_map(name):
+    builtin = BUILTIN_MAPS.get(name.upper())
+    if builtin is not None:
+        return builtin
+    with open(name, 'r') as f:
+        data = json.load(f)
+    return (data["size"], from_json(data))
+
+# Decides how each region should be filled in by a dump: zero-filled regions
+# are synthesized, mirrors are copied from the region they mirror (which must
+# come before them in the map), MMIO is skipped unless "read_mmio" is set, and
+# everything else is read. Returns a list of (start, end, kind, mirror_of,
+# action) tuples.
+def plan_dump(regions, read_mmio=False):
+    plan = []
+    for start, end, kind, mirror_of in regions:
+        if mirror_of is not None:
+            # Mirrors of regions that weren't read are handled like them, and
+            # mirrors of regions that aren't in the map yet are just read.
+            action = READ
+            for b_start, b_end, _, _, b_action in plan:
+                if b_start <= mirror_of < b_end:
+                    action = COPIED if b_action in (READ, COPIED) else b_action
+                    break
+        elif kind == ZERO:
+            action = SYNTHESIZED
+        elif kind == MMIO and not read_mmio:
+            action = SKIPPED
+        else:
+            action = READ
+        plan.append((start, end, kind, mirror_of, action))
+
+    return plan
+
+def region_to_string(region):
+    start, end, kind, mirror_of = region
+    s = "0x{:04X}-0x{:04X}: {}".format(start, end - 1, kind)
+    if mirror_of is not None:
+        s += " (mirror of 0x{:04X}-0x{:04X})".format(mirror_of, mirror_of + end - start - 1)
+    return s
+
+# Merges a list of per-page (kind, base_page) tuples into regions. "base_page"
+# is None unless the page is a mirror of another page.
+def regions_from_pages(pages, page_size=PAGE_SIZE):
+    regions = []
+    for page, (kind, base) in enumerate(pages):
+        if regions:
+            start, end, prev_kind, mirror_of = regions[-1]
+            contiguous_mirror = mirror_of is not None and base is not None and \
+                base * page_size == mirror_of + end - start
+            if kind == prev_kind and ((mirror_of is None and base is None) or contiguous_mirror):
+                regions[-1] = (start, end + page_size, kind, mirror_of)
+                continue
+        mirror_of = base * page_size if base is not None else None
+        regions.append((page * page_size, (page + 1) * page_size, kind, mirror_of))
+
+    return regions
+
+# Picks a 16-bit signature for each page that is unique and differs from the
+# page's current contents at the probe offset.
+def _signatures(pages, snapshot, offset, page_size):
+    used = set()
+    signatures = {}
+    for page in pages:
+        original = snapshot[page * page_size + offset:page * page_size + offset + 2]
+        key = 0
+        while True:
+            signature = struct.pack('>H', (0x5AA5 ^ (page + key * len(snapshot) // page_size)) & 0xffff)
+            key += 1
+            if signature != original and signature not in used:
+                break
+        used.add(signature)
+        signatures[page] = signature
+    return signatures
+
+def _classify_by_contents(pages, candidates, snapshot, page_size):
+    seen = {}
+    for page in candidates:
+        contents = bytes(snapshot[page * page_size:(page + 1) * page_size])
+        if not any(contents):
+            pages[page] = (ZERO, None)
+        elif contents in seen:
+            pages[page] = (UNPROBED, seen[contents])
+        else:
+            seen[contents] = page
+            pages[page] = (UNPROBED, None)
+    return pages
+
+# Probes "size" bytes of XDATA and returns its regions. The space is read twice
+# with full-stride reads to find pages whose contents change on their own
+# (MMIO). Then a unique two-byte signature is written into each of the other
+# pages at "probe_offset", the space is read once more, and the original bytes
+# are written back. A page that reads back:
+#
+# - its own signature is RAM,
+# - another page's signature is a mirror of that page,
+# - its original value is read-only (zero-filled or ROM),
+# - anything else, or whose other bytes changed, is MMIO.
+#
+# Pages in the "exclude" list of (start, end) ranges are never written, and are
+# classified from their contents like a read-only probe does. The probe takes about three full reads plus four single-byte writes per page,
+# instead of the millions of commands that a byte-by-byte memtest would take.
+#
+# If "write" is false, nothing is written: stable pages that are all zeros are
+# reported as zero-filled, and the rest are unprobed, with pages that have the
+# same contents as an earlier page reported as likely mirrors of it.
+def probe(dev, size, page_size=PAGE_SIZE, probe_offset=None, exclude=(), write=True):
+    if probe_offset is None:
+        probe_offset = page_size - 2
+    assert 0 <= probe_offset <= page_size - 2
+
+    page_count = size // page_size
+    before = dev.read(0, size)
+    snapshot = dev.read(0, size)
+
+    pages = [None] * page_count
+    candidates = []
+    excluded = []
+    for page in range(page_count):
+        start = page * page_size
+        end = start + page_size
+        if before[start:end] != snapshot[start:end]:
+            pages[page] = (MMIO, None)
+        elif any(start < ex_end and ex_start < end for ex_start, ex_end in exclude):
+            excluded.append(page)
+        else:
+            candidates.append(page)
+
+    if not write:
+        return regions_from_pages(_classify_by_contents(pages, sorted(excluded + candidates), snapshot, page_size), page_size)
+
+    _classify_by_contents(pages, excluded, snapshot, page_size)
+
+    signatures = _signatures(candidates, snapshot, probe_offset, page_size)
+    for page in candidates:
+        dev.write(page * page_size + probe_offset, signatures[page])
+
+    after = dev.read(0, size)
+
+    writers = {signature: page for page, signature in signatures.items()}
+    groups = {}
+    restore = []
+    for page in candidates:
+        start = page * page_size
+        probe_start = start + probe_offset
+        observed = after[probe_start:probe_start+2]
+        original = snapshot[probe_start:probe_start+2]
+        if observed != original:
+            restore.append(page)
+
+        others_changed = after[start:probe_start] != snapshot[start:probe_start] or \
+            after[probe_start+2:start+page_size] != snapshot[probe_start+2:start+page_size]
+        if others_changed:
+            pages[page] = (MMIO, None)
+        elif observed == original:
+            zero = not any(snapshot[start:start+page_size])
+            pages[page] = (ZERO if zero else ROM, None)
+        elif observed in writers:
+            groups.setdefault(observed, []).append(page)
+        else:
+            pages[page] = (MMIO, None)
+
+    # Every page that reads back the same signature is backed by the same
+    # memory, and the lowest one is treated as the original.
+    for group in groups.values():
+        base = min(group)
+        for page in group:
+            pages[page] = (RAM, None if page == base else base)
+
+    for page in reversed(restore):
+        probe_start = page * page_size + probe_offset
+        dev.write(probe_start, snapshot[probe_start:probe_start+2])
+
+    return regions_from_pages(pages, page_size)
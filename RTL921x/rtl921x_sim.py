@@ -0,0 +1,84 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# rtl921x_sim.py - A software model of an RTL921x device's memory read command.
+# Copyright (C) 2023  Forest Crossman <cyrozap@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import struct
+import time
+from collections import Counter
+
+from transport import CheckConditionError, Transport, check_sgio_types
+
+
+READ_CDB = struct.Struct('<IIII')
+
+FW_INFO_ADDR = 0xac004000
+
+
+class Rtl921xSimulator(Transport):
+    def __init__(self, latency=0.0):
+        # Seconds to sleep for each command, to model the USB round trip.
+        self.latency = latency
+
+        self.command_counts = Counter()
+
+        # Sparse 4 kB pages of the 32-bit address space. Unwritten memory
+        # reads as zeros.
+        self.memory = {}
+
+        # Firmware version 1.0.0, built 2023-01-01.
+        info = bytearray(96)
+        struct.pack_into('<III', info, 0x4c, 1, 0, 0)
+        struct.pack_into('<I', info, 0x5c, 20230101)
+        self.mem_write(FW_INFO_ADDR, info)
+
+    def _page(self, addr):
+        page = self.memory.get(addr >> 12)
+        if page is None:
+            page = bytearray(4096)
+            self.memory[addr >> 12] = page
+        return page
+
+    def mem_write(self, addr, data):
+        for i, value in enumerate(data):
+            self._page(addr + i)[(addr + i) & 0xfff] = value
+
+    def mem_readinto(self, addr, view):
+        i = 0
+        while i < len(view):
+            offset = (addr + i) & 0xfff
+            count = min(4096 - offset, len(view) - i)
+            page = self.memory.get((addr + i) >> 12)
+            if page is None:
+                view[i:i+count] = bytes(count)
+            else:
+                view[i:i+count] = page[offset:offset+count]
+            i += count
+
+    def execute(self, cdb, data_out, data_in):
+        check_sgio_types(cdb, data_out, data_in)
+        self.command_counts[cdb[0]] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        opcode, subcommand, addr, length = READ_CDB.unpack(bytes(cdb))
+        if opcode != 0xe2 or subcommand != 0x92:
+            raise CheckConditionError("Unsupported command: {}".format(bytes(cdb).hex()))
+
+        self.mem_readinto(addr, memoryview(data_in).cast('B')[:length])
+
+        return 0
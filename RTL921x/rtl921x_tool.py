@@ -19,38 +19,68 @@
 
 
 import argparse
-import os
 import struct
 import sys
 import time
 
+# The SCSI transport layer is shared with the ASM2x6x tools, so
+# "ASM2x6x/tools" has to be on the module search path.
 try:
-    import sgio
-except ModuleNotFoundError:
-    sys.stderr.write("Error: Failed to import \"sgio\". Please install \"cython-sgio\", then try running this script again.\n")
+    import scsi_trace
+    import transport
+except ModuleNotFoundError as e:
+    sys.stderr.write("Error: Failed to import \"{}\". Please add the \"ASM2x6x/tools\" directory to PYTHONPATH, then try running this script again.\n".format(e.name))
     sys.exit(1)
 
 
+READ_CDB = struct.Struct('<IIII')
+
+
 class Rtl921x:
-    def __init__(self, dev_path):
-        self._file = os.fdopen(os.open(dev_path, os.O_RDWR | os.O_NONBLOCK))
+    def __init__(self, transport):
+        self._transport = transport
+
+    @scsi_trace.operation("read")
+    def readinto(self, start_addr, buf, stride=4096):
+        view = memoryview(buf).cast('B')
+        read_len = len(view)
+
+        cdb = bytearray(READ_CDB.size)
+        def commands():
+            for i in range(0, read_len, stride):
+                buf_len = min(stride, read_len - i)
+                READ_CDB.pack_into(cdb, 0, 0xe2, 0x92, start_addr + i, buf_len)
+                yield (cdb, None, view[i:i+buf_len])
+
+        for ret in self._transport.execute_many(commands()):
+            assert ret == 0
+
+        return read_len
 
     def read(self, start_addr, read_len, stride=4096):
         data = bytearray(read_len)
+        self.readinto(start_addr, data, stride)
+        return bytes(data)
 
-        for i in range(0, read_len, stride):
-            remaining = read_len - i
-            buf_len = min(stride, remaining)
-
-            cdb = struct.pack('<IIII', 0xe2, 0x92, start_addr + i, buf_len)
+# The target address of a read CDB, for traces.
+def cdb_address(cdb):
+    return READ_CDB.unpack(bytes(cdb))[2]
 
-            buf = bytearray(buf_len)
-            ret = sgio.execute(self._file, cdb, None, buf)
-            assert ret == 0
+def open_transport(device, queue_depth=8):
+    # "sim" selects the software simulator instead of a real device.
+    if device == "sim":
+        import rtl921x_sim
+        return rtl921x_sim.Rtl921xSimulator()
 
-            data[i:i+buf_len] = buf
+    # "replay:<file>" plays back a recording as fast as possible, and
+    # "replay-realtime:<file>" takes as long as the recorded session did.
+    if device.startswith("replay:") or device.startswith("replay-realtime:"):
+        import scsi_record
+        if device.startswith("replay:"):
+            return scsi_record.ReplayTransport(device.partition(":")[2])
+        return scsi_record.ReplayTransport(device.partition(":")[2], realtime=True)
 
-        return bytes(data)
+    return transport.SgioTransport(device, queue_depth)
 
 def info(args, dev):
     data = dev.read(0xac004000, 96)
@@ -73,33 +103,45 @@ def read(args, dev):
     stride = args.stride
     assert stride > 0
 
-    output = None
-    if args.output:
-        output = open(args.output, 'wb')
+    # Read several strides at a time so the commands can be queued, but never
+    # hold more than one chunk of the window in memory.
+    chunk_len = stride * 16
 
-    start_ns = time.perf_counter_ns()
-    data = bytearray(read_len)
-    for i in range(0, read_len, stride):
-        remaining = read_len - i
-        buf_len = min(stride, remaining)
+    def read_chunk(offset, view, chunk_stride):
+        dev.readinto(start_addr + offset, view, chunk_stride)
 
-        buf = dev.read(start_addr + i, buf_len, stride)
+        if not args.quiet:
+            data = bytes(view)
+            print("MEM[0x{:04X}:0x{:04X}]: {} {}".format(start_addr + offset, start_addr + offset + len(data), data.hex(), data))
 
-        if output:
-            output.write(buf)
+    start_ns = time.perf_counter_ns()
+    if args.output:
+        import dumpio
+        params = {"command": "read", "start": start_addr, "length": read_len, "chunk": chunk_len}
+        journal = dumpio.Journal(args.output, params, resume=args.resume)
+        output = dumpio.DumpWriter(args.output, read_len, resume=journal.resumed)
+        count = dumpio.read_chunks(output, journal, read_len, chunk_len, stride, read_chunk, args.retries)
+        output.close()
+        journal.complete()
+    else:
+        buf = bytearray(min(chunk_len, read_len))
+        for i in range(0, read_len, chunk_len):
+            read_chunk(i, memoryview(buf)[:min(chunk_len, read_len - i)], stride)
+        count = read_len
     end_ns = time.perf_counter_ns()
     elapsed = end_ns - start_ns
     print("Read {} bytes in {:.6f} seconds ({} bytes per second).".format(
-        len(data), elapsed/1e9, int(len(data)*1e9) // elapsed))
-
-    if not args.quiet:
-        print("MEM[0x{:04X}:0x{:04X}]: {} {}".format(start_addr, start_addr+read_len, data.hex(), data))
+        count, elapsed/1e9, int(count*1e9) // elapsed))
 
     return 0
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("-d", "--device", default="/dev/sg0", help="The RTL921x SCSI/SG_IO device. Default: /dev/sg0")
+    parser.add_argument("--queue-depth", type=int, default=8, help="The maximum number of SCSI commands to keep in flight at once. Min: 1, Max: 16, Default: 8")
+    parser.add_argument("--trace", type=str, default=None, help="The file to write a trace of every SCSI command to, in the Chrome trace event format (for Perfetto or chrome://tracing). Default: None")
+    parser.add_argument("--profile", action='store_true', default=False, help="Print per-opcode and per-operation SCSI command latency histograms to standard error when done. Default: False")
+    parser.add_argument("--record", type=str, default=None, help="The file to record every SCSI command and response to, for replaying with \"-d replay:<file>\". Default: None")
+    parser.add_argument("-d", "--device", default="/dev/sg0", help="The RTL921x SCSI/SG_IO device, \"sim\" for the simulator, or \"replay:<file>\" (or \"replay-realtime:<file>\") to play back a recording. Default: /dev/sg0")
 
     subparsers = parser.add_subparsers(dest="command", required=True, help="Subcommands.")
 
@@ -108,6 +150,8 @@ def main():
 
     parser_read = subparsers.add_parser("read")
     parser_read.add_argument("-o", "--output", type=str, default=None, help="The file to write the memory to.")
+    parser_read.add_argument("--resume", action='store_true', default=False, help="Continue an interrupted read into the output file from its journal instead of starting over. Default: False")
+    parser_read.add_argument("--retries", type=int, default=3, help="The number of times to retry a failed chunk before giving up. Default: 3")
     parser_read.add_argument("-q", "--quiet", action='store_true', default=False, help="Don't print memory contents. Default: False")
     parser_read.add_argument("-s", "--stride", type=int, default=4096, help="The number of bytes to read with each SCSI command. Min: 1, Max: Unknown, Default: 4096")
     parser_read.add_argument("-l", "--length", type=int, default=1, help="The total number of bytes to read. Default: 1")
@@ -117,9 +161,34 @@ def main():
     args = parser.parse_args()
 
     # Initialize the device object.
-    dev = Rtl921x(args.device)
-
-    return args.func(args, dev)
+    dev_transport = open_transport(args.device, args.queue_depth)
+
+    recorder = None
+    if args.record:
+        import scsi_record
+        scsi_record.exit_on_signals()
+        metadata = {"tool": "rtl921x_tool", "device": args.device, "argv": sys.argv[1:], "time": time.time()}
+        dev_transport = recorder = scsi_record.RecordingTransport(dev_transport, args.record, metadata)
+
+    tracer = None
+    if args.trace or args.profile:
+        tracer = scsi_trace.Tracer(cdb_address, keep_records=bool(args.trace))
+        tracer.install()
+        dev_transport = scsi_trace.TracingTransport(dev_transport, tracer)
+
+    dev = Rtl921x(dev_transport)
+
+    try:
+        return args.func(args, dev)
+    finally:
+        if recorder is not None:
+            recorder.writer.close()
+        if tracer is not None:
+            tracer.uninstall()
+            if args.profile:
+                tracer.write_summary(sys.stderr)
+            if args.trace:
+                tracer.write_chrome_trace(args.trace)
 
 
 if __name__ == "__main__":